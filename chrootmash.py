@@ -1,21 +1,81 @@
 #!/usr/bin/env python3
+import time
+_IMPORT_STARTED = time.perf_counter()
 import os
 import sys
-import readline
-import getpass
-import yaml
-import time
-import random
 import signal
-import subprocess
 from pathlib import Path
+from contextlib import contextmanager
+
+# readline, getpass, random, subprocess, json и yaml (через mashfs.config)
+# импортируются там, где нужны: пакетной сессии без логотипа и без TTY
+# большая часть из них не требуется (см. --profile-startup)
+
+# Утилиты bin/, которые работают через mashfs.storage: в сессии в памяти
+# (MASHFS_STORAGE=memory) они выполняются внутри процесса шелла
+STORAGE_TOOLS = {'cat', 'head', 'tail', 'wc', 'grep', 'find', 'locate', 'du', 'mkdir', 'rm', 'rmdir', 'trash', 'pwd'}
+# В overlay-сессии запускаются только они, packman (работает с верхним слоем)
+# и команды пакетов: остальные утилиты писали бы в общий нижний корень
+OVERLAY_TOOLS = STORAGE_TOOLS | {'packman'}
+# Пути корня под наблюдением шелла и что устаревает при их изменении:
+# данные перечитываются при следующем обращении, а не при каждом
+WATCHED = ('etc', 'bin', 'opt/packman/enabled')
+CHANGE_KEYS = {
+    'passwd': ['etc/shadow'],
+    'users': ['etc/passwd'],
+    'theme': ['etc/theme.yml', 'etc/omm'],
+    'config': ['etc/config.yml', 'etc/lore/config.yml'],
+    'commands': ['bin', 'opt/packman/enabled'],
+}
+# Снимок запуска (mashfs.snapshot) зависит от этих файлов и от каждой записи bin/;
+# тема добавляет свои. etc/shadow в снимок не попадает и читается при первом обращении
+SNAPSHOT_SOURCES = ('etc/passwd', 'etc/config.yml', 'etc/lore/config.yml',
+                    'etc/packman/config.yml', 'opt/packman/config.yml')
+_IMPORTED = time.perf_counter()
+
+
+class StartupProfile:
+    """Время фаз запуска шелла для --profile-startup"""
 
-class MashShell:
     def __init__(self):
+        self.phases = [('import chrootmash', _IMPORTED - _IMPORT_STARTED)]
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def report(self):
+        width = max(len(name) for name, _ in self.phases)
+        lines = ["Запуск шелла (без старта интерпретатора), мс:"]
+        lines += [f"  {name:<{width}}  {elapsed * 1000:7.2f}" for name, elapsed in self.phases]
+        lines.append(f"  {'всего':<{width}}  {sum(elapsed for _, elapsed in self.phases) * 1000:7.2f}")
+        return '\n'.join(lines)
+
+
+class MashShell:
+    def __init__(self, profile=None):
+        self.profile = profile or StartupProfile()
+        phase = self.profile.phase
         self.root = Path(os.environ.get('MASHFS_ROOT', 'filesfs')).absolute()
         self.cwd = Path(os.environ.get('MASHFS_CWD', 'home/mash'))
         self.user = os.environ.get('USER', 'mash')
-        self.hostname = "hardmash"
+        shared_lib = self.root / 'usr' / 'lib'
+        if str(shared_lib) not in sys.path:
+            sys.path.append(str(shared_lib))
+        with phase('import mashfs'):
+            from mashfs.storage import open_storage
+            from mashfs.expand import GlobMatcher
+        with phase('storage'):
+            self.fs = open_storage(self.root)
+            self.globber = GlobMatcher(self.fs)
+        # Конфиг грузится при первом обращении: имя хоста и предупреждения есть в снимке
+        self._config = None
+        self.hostname = None
+        self.config_hostname = None
         self.commands = {
             'cd': self._cd,
             'ls': self._ls,
@@ -32,6 +92,7 @@ class MashShell:
             'userdel': self._userdel,
             'passwd': self._passwd,
             'hostname': self._hostname,
+            'watch': self._watch,
         }
         
         self.logos = [
@@ -90,32 +151,45 @@ class MashShell:
             "Машенька, привет!"
         ]
         
-        self.passwd_db = {}
-        self.users_db = {}
-        self.shadow_file = self.root / 'etc' / 'shadow'
-        self.users_file = self.root / 'etc' / 'passwd'
+        # None - etc/shadow еще не читался
+        self._passwd_db = None
+        self._users_db = {}
+        self.bin_commands = None
+        self._themes = None
+        self.shadow_file = 'etc/shadow'
+        self.users_file = 'etc/passwd'
         self.sudo_users = ['root']
+        self.sudo_verified_at = None
+        self.registry = None
+        self.registry_root = None
         
-        self._setup_dirs()
-        self._load_passwd()
-        self._load_users()
-        self._load_theme()
+        with phase('dirs'):
+            self._setup_dirs()
+        with phase('snapshot'):
+            restored = self._restore_snapshot()
+        if not restored:
+            with phase('snapshot rebuild'):
+                self._rebuild_snapshot()
+        with phase('change feed'):
+            self._open_change_feed()
         
         signal.signal(signal.SIGINT, self._handle_sigint)
         signal.signal(signal.SIGTERM, self._handle_sigterm)
         
-        self.setup_readline()
-        
     def setup_readline(self):
-        readline.set_completer(self._completer)
-        readline.parse_and_bind("tab: complete")
+        import readline
+        readline.set_history_length(self.config.shell.history_size)
+        if self.config.shell.tab_completion:
+            readline.set_completer(self._completer)
+            readline.parse_and_bind("tab: complete")
         
     def _completer(self, text, state):
+        import readline
         line = readline.get_line_buffer().strip()
         parts = line.split()
         
         if not parts:
-            cmds = list(self.commands.keys()) + [x for x in os.listdir(self.root / 'bin') if os.access(self.root / 'bin' / x, os.X_OK)]
+            cmds = list(self.commands.keys()) + self._bin_commands()
             if text:
                 cmds = [cmd for cmd in cmds if cmd.startswith(text)]
             try:
@@ -124,7 +198,7 @@ class MashShell:
                 return None
         
         if len(parts) == 1 and not line.endswith(' '):
-            cmds = list(self.commands.keys()) + [x for x in os.listdir(self.root / 'bin') if os.access(self.root / 'bin' / x, os.X_OK)]
+            cmds = list(self.commands.keys()) + self._bin_commands()
             if text:
                 cmds = [cmd for cmd in cmds if cmd.startswith(text)]
             try:
@@ -137,24 +211,24 @@ class MashShell:
             path_to_complete = '.'
             
         if path_to_complete.startswith('/'):
-            full_path = self.root / path_to_complete[1:]
+            full_path = Path(path_to_complete[1:])
         else:
-            full_path = self.root / self.cwd / path_to_complete
+            full_path = self.cwd / path_to_complete
             
         try:
             dir_path = full_path.parent if full_path.name else full_path
             file_prefix = full_path.name
             
-            if not dir_path.exists() or not dir_path.is_dir():
+            if not self.fs.is_dir(dir_path):
                 return None
                 
-            files = os.listdir(dir_path)
+            files = self.fs.listdir(dir_path)
             if file_prefix:
                 files = [f for f in files if f.startswith(file_prefix)]
                 
             if state < len(files):
                 comp_file = files[state]
-                if (dir_path / comp_file).is_dir():
+                if self.fs.is_dir(dir_path / comp_file):
                     if path_to_complete.endswith('/'):
                         return f"{path_to_complete}{comp_file}/"
                     elif path_to_complete == '.':
@@ -177,43 +251,69 @@ class MashShell:
         
         return None
         
+    def _bin_commands(self):
+        # Автодополнение спрашивает на каждый Tab: список перечитывается по событию
+        if self.bin_commands is None or self.changes.take('commands'):
+            try:
+                self.bin_commands = [x for x in self.fs.listdir('bin') if self.fs.is_executable(f"bin/{x}")]
+            except OSError:
+                return []
+        return self.bin_commands
+
     def _setup_dirs(self):
+        if self.fs.read_only:
+            # Образ только для чтения: в нем уже есть все, что было при упаковке
+            return
         for d in [
-            self.root / 'home' / self.user,
-            self.root / 'etc',
-            self.root / 'bin',
-            self.root / 'usr' / 'bin',
-            self.root / 'usr' / 'local' / 'bin',
-            self.root / 'var' / 'log',
-            self.root / 'opt',
+            f"home/{self.user}",
+            'etc',
+            'bin',
+            'usr/bin',
+            'usr/local/bin',
+            'var/log',
+            'opt',
         ]:
-            d.mkdir(exist_ok=True, parents=True)
+            self.fs.mkdir(d, exist_ok=True, parents=True)
             
+    @property
+    def passwd_db(self):
+        if self.changes.take('passwd') or self._passwd_db is None:
+            self._load_passwd()
+        return self._passwd_db
+
+    @property
+    def users_db(self):
+        if self.changes.take('users'):
+            self._load_users()
+        return self._users_db
+
     def _load_passwd(self):
-        if self.shadow_file.exists():
-            with open(self.shadow_file, 'r') as f:
+        self._passwd_db = {}
+        if self.fs.exists(self.shadow_file):
+            with self.fs.open(self.shadow_file, 'r') as f:
                 for line in f:
                     if line.strip() and not line.startswith('#'):
                         parts = line.strip().split(':')
                         if len(parts) >= 2:
-                            self.passwd_db[parts[0]] = parts[1]
+                            self._passwd_db[parts[0]] = parts[1]
         else:
-            with open(self.shadow_file, 'w') as f:
+            with self.fs.open(self.shadow_file, 'w') as f:
                 f.write("root:toor\n")
                 f.write("mash:mashka\n")
                 f.write("arbung:kadzimoment\n")
-            self.passwd_db['root'] = 'toor'
-            self.passwd_db['mash'] = 'mashka'
-            self.passwd_db['arbung'] = 'kadzimoment'
+            self._passwd_db['root'] = 'toor'
+            self._passwd_db['mash'] = 'mashka'
+            self._passwd_db['arbung'] = 'kadzimoment'
             
     def _load_users(self):
-        if self.users_file.exists():
-            with open(self.users_file, 'r') as f:
+        self._users_db = {}
+        if self.fs.exists(self.users_file):
+            with self.fs.open(self.users_file, 'r') as f:
                 for line in f:
                     if line.strip() and not line.startswith('#'):
                         parts = line.strip().split(':')
                         if len(parts) >= 7:
-                            self.users_db[parts[0]] = {
+                            self._users_db[parts[0]] = {
                                 'uid': parts[2],
                                 'gid': parts[3],
                                 'name': parts[4],
@@ -221,60 +321,108 @@ class MashShell:
                                 'shell': parts[6]
                             }
         else:
-            with open(self.users_file, 'w') as f:
+            with self.fs.open(self.users_file, 'w') as f:
                 f.write("root:x:0:0:Root:/home/root:/bin/mash\n")
                 f.write("mash:x:1000:1000:Mash User:/home/mash:/bin/mash\n")
                 f.write("arbung:x:1001:1001:ARBUNG:/home/arbung:/bin/mash\n")
-            self.users_db['root'] = {'uid': '0', 'gid': '0', 'name': 'Root', 'home': '/home/root', 'shell': '/bin/mash'}
-            self.users_db['mash'] = {'uid': '1000', 'gid': '1000', 'name': 'Mash User', 'home': '/home/mash', 'shell': '/bin/mash'}
-            self.users_db['arbung'] = {'uid': '1001', 'gid': '1001', 'name': 'ARBUNG', 'home': '/home/arbung', 'shell': '/bin/mash'}
+            self._users_db['root'] = {'uid': '0', 'gid': '0', 'name': 'Root', 'home': '/home/root', 'shell': '/bin/mash'}
+            self._users_db['mash'] = {'uid': '1000', 'gid': '1000', 'name': 'Mash User', 'home': '/home/mash', 'shell': '/bin/mash'}
+            self._users_db['arbung'] = {'uid': '1001', 'gid': '1001', 'name': 'ARBUNG', 'home': '/home/arbung', 'shell': '/bin/mash'}
             
+    @property
+    def themes(self):
+        # Движок тем нужен только для перезагрузки темы: из снимка тема берется готовой
+        if self._themes is None:
+            from mashfs.theme import ThemeEngine
+            self._themes = ThemeEngine(self.root, storage=self.fs)
+        return self._themes
+
     def _load_theme(self):
-        self.theme_file = self.root / 'etc' / 'theme.yml'
-        if not self.theme_file.exists():
-            self.theme = {
-                'prompt': "\033[1;32m%s\033[0m@\033[1;34m%s\033[0m:\033[1;36m%s\033[0m$ ",
-                'error': "\033[1;31m%s\033[0m",
-                'success': "\033[1;32m%s\033[0m",
-                'info': "\033[1;36m%s\033[0m",
-                'warning': "\033[1;33m%s\033[0m"
-            }
-            with open(self.theme_file, 'w') as f:
-                yaml.dump({
-                    'name': 'default',
-                    'description': 'Default MashFS theme',
-                    'colors': self.theme
-                }, f)
-        else:
+        self.theme = self.themes.theme
+
+    @property
+    def config(self):
+        if self._config is None:
+            from mashfs.config import load_config
+            self._config = load_config(self.root, self.fs)
+        return self._config
+
+    def _snapshot_key(self):
+        # Без etc/omm/current_theme имя темы берется из MASHFS_THEME
+        return (os.environ.get('MASHFS_THEME', ''),)
+
+    def _restore_snapshot(self):
+        """Пользователи, тема и команды bin/ из снимка запуска одним чтением; False, если его нет
+        или он устарел. Снимок ведется только для корня на диске без слоев"""
+        if self.fs.name != 'host':
+            return False
+        from mashfs.snapshot import load_snapshot
+        state = load_snapshot(self.root, self._snapshot_key())
+        if state is None:
+            return False
+        from mashfs.theme import Theme
+        self._users_db = state['users']
+        theme = state['theme']
+        self.theme = Theme(name=theme['name'], prompt=theme['prompt'],
+                           ansi={role: tuple(pair) for role, pair in theme['ansi'].items()},
+                           styles=theme['styles'])
+        self.bin_commands = state['commands']
+        self.hostname = self.config_hostname = state['hostname']
+        for warning in state['config_warnings']:
+            print(f"config: {warning}")
+        return True
+
+    def _rebuild_snapshot(self):
+        from mashfs.snapshot import dir_stamps, save_snapshot, stamps
+        sources = stamps(self.root, SNAPSHOT_SOURCES) + dir_stamps(self.root, 'bin')
+        self._reload_config()
+        self._load_users()
+        self._load_theme()
+        if self.fs.name != 'host':
+            return
+        # Отметки файлов темы ThemeEngine снял до ее сборки
+        sources += self.themes.stamps
+        state = {
+            'users': self._users_db,
+            'theme': {'name': self.theme.name, 'prompt': self.theme.prompt,
+                      'ansi': self.theme.ansi, 'styles': self.theme.styles},
+            'commands': [x for x in self.fs.listdir('bin') if self.fs.is_executable(f"bin/{x}")],
+            'hostname': self.config_hostname,
+            'config_warnings': self.config.warnings,
+        }
+        self.bin_commands = state['commands']
+        save_snapshot(self.root, self._snapshot_key(), sources, state)
+
+    def _open_change_feed(self):
+        from mashfs.watch import ChangeFeed, WatchError, open_watcher
+        watched = [path for path in WATCHED if self.fs.exists(path)]
+        watcher = None
+        if watched and not self.fs.read_only:
             try:
-                with open(self.theme_file, 'r') as f:
-                    theme_data = yaml.safe_load(f)
-                self.theme = theme_data.get('colors', {})
-                
-                for key, value in self.theme.items():
-                    self.theme[key] = value.replace('\\033', '\x1b')
-                    
-            except Exception as e:
-                print(f"Error loading theme: {e}")
-                self.theme = {
-                    'prompt': "\033[1;32m%s\033[0m@\033[1;34m%s\033[0m:\033[1;36m%s\033[0m$ ",
-                    'error': "\033[1;31m%s\033[0m",
-                    'success': "\033[1;32m%s\033[0m",
-                    'info': "\033[1;36m%s\033[0m",
-                    'warning': "\033[1;33m%s\033[0m"
-                }
+                watcher = open_watcher(self.fs, watched)
+            except (WatchError, OSError):
+                pass
+        self.changes = ChangeFeed(watcher, CHANGE_KEYS)
+
+    def _reload_config(self):
+        self._config = None
+        for warning in self.config.warnings:
+            print(f"config: {warning}")
+        # Имя, заданное командой hostname, живет до смены system.hostname в конфиге
+        if self.config.system.hostname != self.config_hostname:
+            self.hostname = self.config_hostname = self.config.system.hostname
                 
     def error(self, msg):
-        return self.theme.get('error', '%s') % msg
+        return self.theme.paint('error', msg)
         
     def success(self, msg):
-        return self.theme.get('success', '%s') % msg
+        return self.theme.paint('success', msg)
         
     def info(self, msg):
-        return self.theme.get('info', '%s') % msg
+        return self.theme.paint('info', msg)
         
     def warning(self, msg):
-        return self.theme.get('warning', '%s') % msg
+        return self.theme.paint('warning', msg)
             
     def _handle_sigint(self, signum, frame):
         print("\nUse 'exit' to quit")
@@ -284,13 +432,36 @@ class MashShell:
         sys.exit(0)
         
     def _get_prompt(self):
+        # Изменения других сессий (useradd, passwd, omm theme) подхватываются на лету
+        self.changes.poll()
+        if self.changes.take('config'):
+            self._reload_config()
+        if self.changes.take('theme'):
+            self.themes.reload_if_changed()
+            self.theme = self.themes.theme
         pwd = str(self.cwd)
-        return self.theme.get('prompt', '%s@%s:%s$ ') % (self.user, self.hostname, pwd)
+        return self.theme.prompt % (self.user, self.hostname, pwd)
         
+    def _home(self, user):
+        """Домашний каталог для ~ и ~user; None, если пользователя нет"""
+        if not user:
+            return f"/home/{self.user}"
+        if user in self.users_db:
+            return self.users_db[user]['home']
+        return None
+
+    def _session_env(self):
+        return dict(os.environ, USER=self.user, HOME=f"/home/{self.user}", PWD=f"/{self.cwd}")
+
+    def _expand(self, cmd_line):
+        """Кавычки, ~, $VAR и шаблоны по корню MashFS -> список слов команды"""
+        from mashfs.expand import expand_words
+        return expand_words(cmd_line, self._session_env(), str(self.cwd), self.globber, self._home)
+
     def _cd(self, args):
         if not args:
             home_dir = Path(f"home/{self.user}")
-            if (self.root / home_dir).exists():
+            if self.fs.is_dir(home_dir):
                 self.cwd = home_dir
             return
             
@@ -315,51 +486,61 @@ class MashShell:
                 else:
                     new_path = new_path / part
         
-        new_path_abs = self.root / new_path
-        
-        if not new_path_abs.exists():
+        if not self.fs.exists(new_path):
             print(self.error(f"cd: {path}: No such file or directory"))
-        elif not new_path_abs.is_dir():
+        elif not self.fs.is_dir(new_path):
             print(self.error(f"cd: {path}: Not a directory"))
-        elif not os.access(new_path_abs, os.R_OK):
-            print(self.error(f"cd: {path}: Permission denied"))
+        elif self.fs.escapes_root(new_path):
+            print(self.error(f"cd: {path}: Access denied (cannot leave MashFS root)"))
         else:
-            if not str(new_path_abs).startswith(str(self.root)):
-                print(self.error(f"cd: {path}: Access denied (cannot leave MashFS root)"))
-            else:
-                self.cwd = new_path
-                os.environ['MASHFS_CWD'] = str(self.cwd)
+            try:
+                self.fs.listdir(new_path)
+            except PermissionError:
+                print(self.error(f"cd: {path}: Permission denied"))
+                return
+            self.cwd = new_path
+            os.environ['MASHFS_CWD'] = str(self.cwd)
         
     def _ls(self, args):
-        path = "."
-        if args:
-            path = args[0]
-            
-        target_path = self.cwd
-        if path.startswith('/'):
-            target_path = Path(path[1:])
-        else:
-            target_path = self.cwd / path
-            
-        full_path = self.root / target_path
-        
-        if not full_path.exists():
-            print(self.error(f"ls: {path}: No such file or directory"))
-        elif not full_path.is_dir():
+        # Операндов может быть несколько (ls /etc/*.yml после раскрытия шаблона):
+        # как в coreutils, сначала файлы, затем каталоги с заголовком "<путь>:"
+        paths = args or ["."]
+        files, dirs = [], []
+        for path in paths:
+            if path.startswith('/'):
+                target_path = Path(path[1:])
+            else:
+                target_path = self.cwd / path
+
+            if not self.fs.exists(target_path):
+                print(self.error(f"ls: {path}: No such file or directory"))
+            elif not self.fs.is_dir(target_path):
+                files.append(target_path)
+            else:
+                dirs.append((path, target_path))
+
+        for target_path in files:
             print(target_path.name)
-        else:
-            try:
-                for item in sorted(os.listdir(full_path)):
-                    if (full_path / item).is_dir():
-                        print(f"{self.info(item)}/")
+        for i, (path, target_path) in enumerate(dirs):
+            if len(paths) > 1:
+                if files or i:
+                    print()
+                print(f"{path}:")
+            self._ls_dir(path, target_path)
+
+    def _ls_dir(self, path, target_path):
+        try:
+            for item in sorted(self.fs.listdir(target_path)):
+                if self.fs.is_dir(target_path / item):
+                    print(f"{self.info(item)}/")
+                else:
+                    if self.fs.is_executable(target_path / item):
+                        print(f"{self.success(item)}*")
                     else:
-                        if os.access(full_path / item, os.X_OK):
-                            print(f"{self.success(item)}*")
-                        else:
-                            print(item)
-            except PermissionError:
-                print(self.error(f"ls: {path}: Permission denied"))
-                
+                        print(item)
+        except PermissionError:
+            print(self.error(f"ls: {path}: Permission denied"))
+
     def _pwd(self, args):
         print(f"/{self.cwd}")
         
@@ -372,17 +553,15 @@ class MashShell:
             print(f"  {cmd}")
             
         print("\nExternal commands:")
-        bin_path = self.root / 'bin'
-        if bin_path.exists() and bin_path.is_dir():
-            for cmd in sorted(os.listdir(bin_path)):
-                if os.access(bin_path / cmd, os.X_OK):
-                    print(f"  {cmd}")
+        for cmd in sorted(self._bin_commands()):
+            print(f"  {cmd}")
                     
     def _exit(self, args):
         print("Goodbye! 👋")
         sys.exit(0)
         
     def _su(self, args):
+        import getpass
         target_user = 'root'
         if args:
             target_user = args[0]
@@ -398,18 +577,20 @@ class MashShell:
             return
             
         self.user = target_user
+        self.sudo_verified_at = None
         
         if target_user in self.users_db:
             home_dir = self.users_db[target_user]['home']
             if home_dir.startswith('/'):
                 home_dir = home_dir[1:]
             home_path = Path(home_dir)
-            if (self.root / home_path).exists():
+            if self.fs.is_dir(home_path):
                 self.cwd = home_path
                 
         os.environ['USER'] = self.user
         
     def _sudo(self, args):
+        import getpass
         if not args:
             print(self.error("sudo: no command specified"))
             return
@@ -423,9 +604,12 @@ class MashShell:
             else:
                 self._run_external_command(cmd, cmd_args)
         else:
-            password = getpass.getpass("[sudo] password for %s: " % self.user)
+            if not self._sudo_authenticated():
+                password = getpass.getpass("[sudo] password for %s: " % self.user)
+                if self.passwd_db.get(self.user) == password:
+                    self.sudo_verified_at = time.monotonic()
             
-            if self.passwd_db.get(self.user) == password:
+            if self._sudo_authenticated():
                 cmd = args[0]
                 cmd_args = args[1:]
                 
@@ -436,6 +620,14 @@ class MashShell:
             else:
                 print(self.error("sudo: Authentication failure"))
                 
+    def _sudo_authenticated(self):
+        # Пароль не спрашивается повторно в течение security.sudo_timeout секунд
+        if not self.config.security.password_auth:
+            return True
+        if self.sudo_verified_at is None:
+            return False
+        return time.monotonic() - self.sudo_verified_at < self.config.security.sudo_timeout
+
     def _whoami(self, args):
         print(self.user)
         
@@ -454,6 +646,7 @@ class MashShell:
         print(f"uid={uid}({target_user}) gid={gid}({target_user})")
         
     def _useradd(self, args):
+        import getpass
         if self.user != 'root':
             print(self.error("useradd: Permission denied (must be root)"))
             return
@@ -479,17 +672,16 @@ class MashShell:
             'shell': '/bin/mash'
         }
         
-        with open(self.users_file, 'a') as f:
+        with self.fs.open(self.users_file, 'a') as f:
             f.write(f"{username}:x:{uid}:{uid}:{username.capitalize()}:{home_dir}:/bin/mash\n")
             
         password = getpass.getpass(f"New password for {username}: ")
         self.passwd_db[username] = password
         
-        with open(self.shadow_file, 'a') as f:
+        with self.fs.open(self.shadow_file, 'a') as f:
             f.write(f"{username}:{password}\n")
             
-        home_path = Path(home_dir[1:])
-        (self.root / home_path).mkdir(exist_ok=True, parents=True)
+        self.fs.mkdir(home_dir, exist_ok=True, parents=True)
         
         print(self.success(f"User {username} added successfully"))
         
@@ -546,22 +738,23 @@ class MashShell:
             self.sudo_users.remove(username)
             
         lines = []
-        with open(self.users_file, 'r') as f:
+        with self.fs.open(self.users_file, 'r') as f:
             lines = [line for line in f if not line.startswith(f"{username}:")]
             
-        with open(self.users_file, 'w') as f:
+        with self.fs.open(self.users_file, 'w') as f:
             f.writelines(lines)
             
         lines = []
-        with open(self.shadow_file, 'r') as f:
+        with self.fs.open(self.shadow_file, 'r') as f:
             lines = [line for line in f if not line.startswith(f"{username}:")]
             
-        with open(self.shadow_file, 'w') as f:
+        with self.fs.open(self.shadow_file, 'w') as f:
             f.writelines(lines)
             
         print(self.success(f"User {username} deleted successfully"))
         
     def _passwd(self, args):
+        import getpass
         target_user = self.user
         if args:
             target_user = args[0]
@@ -588,7 +781,7 @@ class MashShell:
         self.passwd_db[target_user] = new_password
         
         lines = []
-        with open(self.shadow_file, 'r') as f:
+        with self.fs.open(self.shadow_file, 'r') as f:
             lines = []
             for line in f:
                 if line.startswith(f"{target_user}:"):
@@ -596,7 +789,7 @@ class MashShell:
                 else:
                     lines.append(line)
                     
-        with open(self.shadow_file, 'w') as f:
+        with self.fs.open(self.shadow_file, 'w') as f:
             f.writelines(lines)
             
         print(self.success(f"Password for {target_user} changed successfully"))
@@ -611,8 +804,106 @@ class MashShell:
         else:
             print(self.hostname)
             
+    def _watch(self, args):
+        """watch [-p] <путь>...: печатает события файловой системы до Ctrl-C"""
+        from mashfs.watch import OVERFLOW, WatchError, open_watcher
+        polling = '-p' in args
+        paths = [arg for arg in args if arg != '-p']
+        if not paths:
+            print("Usage: watch [-p] <путь>...  (-p - опрос вместо inotify)")
+            return
+        targets = []
+        for path in paths:
+            target = Path(path[1:]) if path.startswith('/') else self.cwd / path
+            if self.fs.escapes_root(target):
+                print(self.error(f"watch: {path}: Access denied (cannot leave MashFS root)"))
+                return
+            targets.append(target)
+        try:
+            watcher = open_watcher(self.fs, targets, polling=polling)
+        except (WatchError, OSError) as e:
+            print(self.error(f"watch: {e}"))
+            return
+        print(self.info(f"watch: {', '.join(paths)} ({watcher.backend}), Ctrl-C - выход"))
+        # Шелл глушит SIGINT; на время watch он снова прерывает ожидание
+        saved = signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            while True:
+                for event in watcher.wait():
+                    stamp = time.strftime('%H:%M:%S')
+                    if event.kind == OVERFLOW:
+                        print(self.warning(f"{stamp} overflow: часть событий потеряна"))
+                    else:
+                        print(f"{stamp} {event.kind:8} /{event.path}{'/' if event.is_dir else ''}", flush=True)
+        except KeyboardInterrupt:
+            print()
+        finally:
+            signal.signal(signal.SIGINT, saved)
+            watcher.close()
+
+    def _command_registry(self):
+        if not self.fs.on_disk:
+            # Реестр команд packman живет на диске; в памяти команды берутся из bin/
+            return None
+        # В overlay-сессии реестр переезжает в верхний слой после первого packman
+        registry_file = self.fs.host_path('opt/packman/binaries.json')
+        registry_root = registry_file.parents[2] if registry_file else self.root
+        if self.registry is None or registry_root != self.registry_root:
+            self.registry_root = registry_root
+            lib_path = self.root / 'opt' / 'packman' / 'lib'
+            if str(lib_path) not in sys.path:
+                sys.path.append(str(lib_path))
+            try:
+                from binary_registry import BinaryRegistry
+                self.registry = BinaryRegistry(registry_root)
+            except Exception:
+                self.registry = False
+        elif self.registry:
+            self.registry.reload_if_changed()
+        return self.registry
+
+    def _find_command(self, cmd):
+        registry = self._command_registry()
+        if registry:
+            target = registry.target(cmd)
+            if target is not None and target.is_file():
+                return target
+        return self.fs.host_path(f"bin/{cmd}") or self.root / 'bin' / cmd
+            
+    def _run_in_process(self, cmd, args):
+        """Запускает утилиту из bin/ внутри шелла, чтобы она работала с тем же хранилищем"""
+        from mashfs.storage import set_default_storage
+        code = compile(self.fs.read_text(f"bin/{cmd}"), f"/bin/{cmd}", 'exec')
+        saved_argv, saved_env = sys.argv, dict(os.environ)
+        sys.argv = [cmd] + args
+        os.environ.update(MASHFS_ROOT=str(self.root), MASHFS_CWD=str(self.cwd), USER=self.user)
+        set_default_storage(self.fs)
+        try:
+            exec(code, {'__name__': '__main__', '__file__': f"/bin/{cmd}"})
+        except SystemExit:
+            pass
+        finally:
+            set_default_storage(None)
+            sys.argv = saved_argv
+            os.environ.clear()
+            os.environ.update(saved_env)
+
     def _run_external_command(self, cmd, args):
-        cmd_path = self.root / 'bin' / cmd
+        import subprocess
+        if not self.fs.on_disk:
+            if not self.fs.is_executable(f"bin/{cmd}"):
+                print(self.error(f"Command not found: {cmd}"))
+            elif cmd not in STORAGE_TOOLS:
+                print(self.error(f"{cmd}: недоступна в сессии в памяти (хранилище {self.fs.name})"))
+            else:
+                self._run_in_process(cmd, args)
+            return
+        if self.fs.name == 'overlay' and cmd not in OVERLAY_TOOLS:
+            registry = self._command_registry()
+            if not (registry and registry.target(cmd) is not None):
+                print(self.error(f"{cmd}: недоступна в overlay-сессии (изменила бы общий нижний корень)"))
+                return
+        cmd_path = self._find_command(cmd)
         if cmd_path.exists() and cmd_path.is_file() and os.access(cmd_path, os.X_OK):
             # Устанавливаем переменные окружения для команды
             env = os.environ.copy()
@@ -632,6 +923,7 @@ class MashShell:
             print(self.error(f"Command not found: {cmd}"))
             
     def show_logo(self):
+        import random
         logo = random.choice(self.logos)
         
         colors = [
@@ -655,12 +947,19 @@ class MashShell:
         time.sleep(0.5)
         
     def run(self):
-        readline.clear_history()
+        interactive = sys.stdin.isatty()
+        if interactive:
+            # readline нужен только для ввода с терминала
+            import readline
+            self.setup_readline()
+            readline.clear_history()
         os.environ['MASHFS_ROOT'] = str(self.root)
         os.environ['MASHFS_CWD'] = str(self.cwd)
         os.environ['USER'] = self.user
         
-        self.show_logo()
+        if interactive:
+            # Логотип с анимацией и clear - только для терминала, не для пакетных сессий
+            self.show_logo()
         
         print(f"Welcome to MashFS Shell! 🚀 (Logged in as {self.user})")
         print("Type 'help' for available commands")
@@ -670,12 +969,15 @@ class MashShell:
         
         while True:
             try:
-                readline.set_startup_hook(lambda: readline.insert_text(""))
+                if interactive:
+                    readline.set_startup_hook(lambda: readline.insert_text(""))
                 cmd_line = input(self._get_prompt())
                 if not cmd_line:
                     continue
                     
-                parts = cmd_line.split()
+                parts = self._expand(cmd_line)
+                if not parts:
+                    continue
                 cmd = parts[0]
                 args = parts[1:]
                 
@@ -691,19 +993,37 @@ class MashShell:
             except Exception as e:
                 print(self.error(f"Error: {e}"))
 
+def recover_root_swap(root_dir):
+    """Доводит подмену корня, прерванную во время mashsys rollback, пока каталоги корня не пересозданы"""
+    journal = root_dir.parent / f".{root_dir.name}.swap.json"
+    if not journal.exists():
+        return
+    import json
+    candidates = [root_dir]
+    try:
+        with open(journal) as f:
+            data = json.load(f)
+        candidates += [Path(data['staging']), Path(data['previous'])]
+    except (OSError, ValueError, KeyError):
+        pass
+    for candidate in candidates:
+        lib_path = candidate / 'opt' / 'mashsys' / 'lib'
+        if lib_path.is_dir():
+            sys.path.append(str(lib_path))
+            break
+    from rollback import recover_swap
+    if recover_swap(root_dir):
+        print("Завершена прерванная подмена корня после mashsys rollback")
+
 def ensure_chroot_env():
     root_dir = Path(os.environ.get('MASHFS_ROOT', 'filesfs')).absolute()
+    recover_root_swap(root_dir)
+    if os.environ.get('MASHFS_STORAGE', 'host') != 'host':
+        # Корень в памяти: каталоги создаст MashShell в своем хранилище
+        return root_dir
     
-    for d in [
-        root_dir / 'home' / 'mash',
-        root_dir / 'etc',
-        root_dir / 'bin',
-        root_dir / 'usr' / 'bin',
-        root_dir / 'usr' / 'local' / 'bin',
-        root_dir / 'var' / 'log',
-        root_dir / 'opt',
-    ]:
-        d.mkdir(exist_ok=True, parents=True)
+    # Остальные каталоги корня создает MashShell._setup_dirs
+    (root_dir / 'home' / 'mash').mkdir(exist_ok=True, parents=True)
     
     bin_dir = root_dir / 'bin'
     if not (bin_dir / 'mash').exists():
@@ -712,9 +1032,17 @@ def ensure_chroot_env():
     return root_dir
 
 def main():
-    root_dir = ensure_chroot_env()
+    profile = StartupProfile()
+    with profile.phase('chroot env'):
+        root_dir = ensure_chroot_env()
     
-    shell = MashShell()
+    shell = MashShell(profile)
+    if '--profile-startup' in sys.argv[1:]:
+        # Разбивка запуска до первого приглашения, без входа в цикл команд
+        with profile.phase('first prompt'):
+            shell._get_prompt()
+        print(profile.report())
+        return
     shell.run()
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import os
+import gzip
+import shutil
+import tarfile
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from snapshots import SNAPSHOT_PREFIX, lock_partial
+
+STREAM_BUFSIZE = 1024 * 1024
+
+# zstd и xz - внешние многопоточные компрессоры (-T0 - по числу ядер), gzip - встроенный
+COMPRESSORS = {
+    'zstd': {
+        'suffix': '.tar.zst',
+        'compress': ['zstd', '-T0', '-q', '-c'],
+        'decompress': ['zstd', '-d', '-q', '-c'],
+    },
+    'xz': {
+        'suffix': '.tar.xz',
+        'compress': ['xz', '-T0', '-q', '-c'],
+        'decompress': ['xz', '-d', '-q', '-c'],
+    },
+    'gzip': {
+        'suffix': '.tar.gz',
+    },
+}
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def pick_compressor(preferred: Optional[str] = None) -> str:
+    """Первый доступный компрессор: preferred, затем zstd, xz; gzip есть всегда"""
+    for name in ([preferred] if preferred else []) + ['zstd', 'xz']:
+        if name == 'gzip' or (name in COMPRESSORS and shutil.which(name)):
+            return name
+    return 'gzip'
+
+
+def compressor_for(archive: Path) -> str:
+    for name, spec in COMPRESSORS.items():
+        if Path(archive).name.endswith(spec['suffix']):
+            return name
+    raise ArchiveError(f"Неизвестный формат архива: {archive}")
+
+
+def create_archive(root: Path, parent: Optional[Path] = None, compressor: Optional[str] = None) -> Tuple[Path, Dict]:
+    """Пишет root в сжатый tar потоком, без промежуточной копии.
+
+    tar пишется в stdin компрессора, компрессор - сразу в файл архива;
+    архив появляется под своим именем только после успешного завершения.
+    """
+    root = Path(root)
+    parent = Path(parent or root.parent)
+    compressor = pick_compressor(compressor)
+    spec = COMPRESSORS[compressor]
+    name = SNAPSHOT_PREFIX + datetime.now().strftime('%Y%m%d_%H%M%S')
+    dest = parent / f"{name}{spec['suffix']}"
+    if dest.exists():
+        raise ArchiveError(f"Резервная копия {dest} уже существует")
+    tmp = parent / f".{dest.name}.partial"
+
+    stats = {'compressor': compressor, 'files': 0, 'bytes_total': 0}
+
+    def count(tarinfo):
+        if tarinfo.isfile():
+            stats['files'] += 1
+            stats['bytes_total'] += tarinfo.size
+        return tarinfo
+
+    proc = None
+    try:
+        with open(tmp, 'wb') as out:
+            lock_partial(out.fileno())
+            if compressor == 'gzip':
+                stream = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6)
+            else:
+                proc = subprocess.Popen(spec['compress'], stdin=subprocess.PIPE, stdout=out)
+                stream = proc.stdin
+            try:
+                with tarfile.open(fileobj=stream, mode='w|', bufsize=STREAM_BUFSIZE) as tar:
+                    for entry in sorted(os.listdir(root)):
+                        tar.add(root / entry, arcname=entry, filter=count)
+            finally:
+                stream.close()
+            if proc is not None and proc.wait() != 0:
+                raise ArchiveError(f"{compressor} завершился с кодом {proc.returncode}")
+        os.rename(tmp, dest)
+    except BaseException:
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        tmp.unlink(missing_ok=True)
+        raise
+    stats['bytes_compressed'] = dest.stat().st_size
+    return dest, stats
+
+
+def extract_archive(archive: Path, dest: Path) -> None:
+    """Потоково распаковывает архив резервной копии в dest"""
+    archive, dest = Path(archive), Path(dest)
+    compressor = compressor_for(archive)
+    dest.mkdir(parents=True, exist_ok=True)
+    # Симлинки корня могут быть абсолютными, поэтому фильтр 'tar', а не 'data'
+    extract_args = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+
+    if compressor == 'gzip':
+        with tarfile.open(archive, mode='r|gz', bufsize=STREAM_BUFSIZE) as tar:
+            tar.extractall(dest, **extract_args)
+        return
+
+    if not shutil.which(COMPRESSORS[compressor]['decompress'][0]):
+        raise ArchiveError(f"Для распаковки {archive.name} нужен {compressor}")
+    proc = subprocess.Popen(COMPRESSORS[compressor]['decompress'] + [str(archive)], stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|', bufsize=STREAM_BUFSIZE) as tar:
+            tar.extractall(dest, **extract_args)
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise ArchiveError(f"{compressor} завершился с кодом {proc.returncode}")
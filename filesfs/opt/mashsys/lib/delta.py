@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = 8
+MANIFEST_VERSION = 2
+CHUNK_SIZE = 1024 * 1024
+
+
+def manifest_file(root: Path) -> Path:
+    """Какие файлы поставил последний upgrade: по нему находятся файлы, удаленные в апстриме"""
+    return Path(root) / 'var' / 'lib' / 'mashsys' / 'upstream.json'
+
+
+def load_upstream_manifest(root: Path) -> Dict[str, Dict]:
+    try:
+        with open(manifest_file(root)) as f:
+            return json.load(f).get('files', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_upstream_manifest(root: Path, files: Dict[str, Dict]) -> None:
+    path = manifest_file(root)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f)
+    os.replace(tmp, path)
+
+
+def git_blob_id(path: Path, object_format: str = 'sha1') -> str:
+    """Id содержимого файла так, как его считает git: hash(b"blob <размер>\\0" + данные)"""
+    h = hashlib.new(object_format)
+    h.update(b'blob %d\0' % os.path.getsize(path))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_tree(base: Path) -> Dict[str, Dict]:
+    """Файлы и симлинки дерева: {путь: {'size', 'mtime_ns'} | {'symlink': цель}}"""
+    entries = {}
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(Path(base) / rel_dir) as it:
+            for entry in it:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if entry.is_symlink():
+                    entries[rel] = {'symlink': os.readlink(entry.path)}
+                elif entry.is_dir():
+                    stack.append(rel)
+                elif entry.is_file():
+                    st = entry.stat(follow_symlinks=False)
+                    entries[rel] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    return entries
+
+
+def compute_changeset(new_root: Path, root: Path, is_preserved: Callable[[str], bool],
+                      workers: int = DEFAULT_WORKERS, blobs: Optional[Dict[str, str]] = None) -> Dict:
+    """Сравнивает новое дерево с установленным.
+
+    mtime из git archive - время коммита, по нему ничего не сравнить, поэтому
+    файлы одного размера сравниваются по id git blob. Для нового дерева id
+    берутся из blobs (git ls-tree), для установленного - из манифеста, если
+    файл с прошлого upgrade не трогали; считаются (параллельно) только
+    недостающие. Симлинки в корне и сохраняемые конфиги не трогаются.
+    Удаляются только файлы, поставленные прошлым upgrade и пропавшие из
+    нового дерева, и только если их не меняли локально.
+    """
+    new_root, root = Path(new_root), Path(root)
+    manifest = load_upstream_manifest(root)
+    new_entries = scan_tree(new_root)
+    changes = {'add': [], 'change': [], 'delete': [], 'symlink': [], 'kept': [], 'preserved': []}
+    blobs = dict(blobs or {})
+    object_format = 'sha256' if any(len(blob) == 64 for blob in blobs.values()) else 'sha1'
+    installed: Dict[str, str] = {}
+    to_hash = []
+
+    for rel, new in sorted(new_entries.items()):
+        dest = root / rel
+        if is_preserved(rel):
+            changes['preserved'].append(rel)
+            continue
+        if 'symlink' in new:
+            if not os.path.lexists(dest):
+                changes['symlink'].append(rel)
+            continue
+        if not os.path.lexists(dest):
+            changes['add'].append(rel)
+            continue
+        if dest.is_symlink() or not dest.is_file():
+            continue
+        st = dest.stat()
+        if st.st_size != new['size']:
+            changes['change'].append(rel)
+            continue
+        recorded = manifest.get(rel)
+        if recorded and recorded.get('blob') and recorded['size'] == st.st_size and recorded['mtime_ns'] == st.st_mtime_ns:
+            installed[rel] = recorded['blob']
+        else:
+            to_hash.append((installed, rel, dest))
+        if rel not in blobs:
+            to_hash.append((blobs, rel, new_root / rel))
+
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            digests = pool.map(lambda item: git_blob_id(item[2], object_format), to_hash)
+            for (target, rel, _), digest in zip(to_hash, digests):
+                target[rel] = digest
+    for rel in installed:
+        if installed[rel] != blobs.get(rel):
+            changes['change'].append(rel)
+    changes['change'].sort()
+
+    for rel, recorded in sorted(manifest.items()):
+        if rel in new_entries or is_preserved(rel):
+            continue
+        dest = root / rel
+        if not dest.is_file() or dest.is_symlink():
+            continue
+        st = dest.stat()
+        if st.st_size == recorded['size'] and st.st_mtime_ns == recorded['mtime_ns']:
+            changes['delete'].append(rel)
+        else:
+            changes['kept'].append(rel)
+
+    changes['new_entries'] = new_entries
+    changes['blobs'] = blobs
+    return changes
+
+
+def _install_file(src: Path, dest: Path) -> None:
+    # Через временный файл и rename: файл заменяется целиком, и читатель
+    # никогда не видит его наполовину записанным
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.parent / f".{dest.name}.mashsys-tmp"
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+
+def apply_changeset(changes: Dict, new_root: Path, root: Path, workers: int = DEFAULT_WORKERS) -> List[str]:
+    """Применяет изменения: копирование в пуле потоков, удаления, новые симлинки; возвращает ошибки"""
+    new_root, root = Path(new_root), Path(root)
+    errors = []
+
+    def install(rel):
+        try:
+            _install_file(new_root / rel, root / rel)
+        except OSError as e:
+            return f"{rel}: {e}"
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        errors += [error for error in pool.map(install, changes['add'] + changes['change']) if error]
+
+    for rel in changes['symlink']:
+        try:
+            (root / rel).parent.mkdir(parents=True, exist_ok=True)
+            os.symlink(changes['new_entries'][rel]['symlink'], root / rel)
+        except OSError as e:
+            errors.append(f"{rel}: {e}")
+
+    for rel in changes['delete']:
+        try:
+            (root / rel).unlink()
+            parent = (root / rel).parent
+            while parent != root and not any(parent.iterdir()):
+                parent.rmdir()
+                parent = parent.parent
+        except OSError as e:
+            errors.append(f"{rel}: {e}")
+    return errors
+
+
+def record_upstream(changes: Dict, root: Path, previous: Optional[Dict[str, Dict]] = None) -> None:
+    """Запоминает состояние поставленных из апстрима файлов после upgrade"""
+    root = Path(root)
+    previous = previous if previous is not None else load_upstream_manifest(root)
+    files = {}
+    copied = set(changes['add']) | set(changes['change'])
+    preserved = set(changes['preserved'])
+    for rel, new in changes['new_entries'].items():
+        dest = root / rel
+        if 'symlink' in new or dest.is_symlink() or not dest.is_file():
+            continue
+        st = dest.stat()
+        record = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        # id blob годится, только если на диске именно новое содержимое: файл
+        # совпал при сравнении или скопирован (copy2 сохраняет size и mtime)
+        if rel in copied:
+            same = st.st_size == new['size'] and st.st_mtime_ns == new['mtime_ns']
+        else:
+            same = rel not in preserved
+        if same and rel in changes['blobs']:
+            record['blob'] = changes['blobs'][rel]
+        files[rel] = record
+    # Локально измененные файлы, удаленные в апстриме, остаются под учетом
+    for rel in changes['kept']:
+        files[rel] = previous[rel]
+    save_upstream_manifest(root, files)
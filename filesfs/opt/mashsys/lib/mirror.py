@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tarfile
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional
+
+STREAM_BUFSIZE = 1024 * 1024
+FETCH_REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+
+
+class MirrorError(Exception):
+    pass
+
+
+def _git(args: List[str], cwd: Optional[Path] = None) -> str:
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    try:
+        result = subprocess.run(['git'] + args, cwd=cwd, env=env, capture_output=True, text=True)
+    except FileNotFoundError:
+        raise MirrorError("Git не установлен")
+    if result.returncode != 0:
+        raise MirrorError(result.stderr.strip() or f"git {args[0]} завершился с кодом {result.returncode}")
+    return result.stdout
+
+
+class GitMirror:
+    """Локальное bare-зеркало репозитория MashFS.
+
+    Ветки и теги скачиваются один раз и дальше только догоняются fetch'ем
+    (не чаще раза за запуск mashsys). Списки веток и тегов читаются из
+    сохраненных ссылок, дерево версии выгружается через git archive -
+    без сети, если зеркало уже есть.
+    """
+
+    def __init__(self, cache_dir: Path, url: str):
+        self.path = Path(cache_dir) / 'mashfs.git'
+        self.url = url
+        self.updated = False
+        self.offline_reason = None
+
+    def exists(self) -> bool:
+        return (self.path / 'HEAD').exists()
+
+    def update(self, source: Optional[Path] = None) -> bool:
+        """Догоняет зеркало из url или из source (локальный репозиторий или git bundle).
+
+        Возвращает False, если обновиться не удалось, но есть сохраненное
+        зеркало (работаем офлайн); без зеркала - MirrorError.
+        """
+        if self.updated:
+            return self.offline_reason is None
+        self.updated = True
+        fresh = not self.exists()
+        try:
+            if fresh:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                _git(['init', '--bare', '--quiet', str(self.path)])
+                _git(['remote', 'add', 'origin', self.url], cwd=self.path)
+            if source is not None:
+                _git(['fetch', '--quiet', str(source)] + FETCH_REFSPECS, cwd=self.path)
+            else:
+                _git(['fetch', '--quiet', '--prune', 'origin'] + FETCH_REFSPECS, cwd=self.path)
+            return True
+        except MirrorError as e:
+            if fresh:
+                shutil.rmtree(self.path, ignore_errors=True)
+                raise
+            self.offline_reason = str(e)
+            return False
+
+    def _refs(self, prefix: str) -> List[str]:
+        if not self.exists():
+            return []
+        output = _git(['for-each-ref', '--format=%(refname)', prefix], cwd=self.path)
+        return [line[len(prefix):] for line in output.splitlines() if line.startswith(prefix)]
+
+    def branches(self) -> List[str]:
+        return self._refs('refs/heads/')
+
+    def tags(self) -> List[str]:
+        return self._refs('refs/tags/')
+
+    def resolve(self, ref: str) -> str:
+        return _git(['rev-parse', '--verify', '--quiet', f"{ref}^{{commit}}"], cwd=self.path).strip()
+
+    def blobs(self, commit: str, prefix: str) -> Dict[str, str]:
+        """Id blob'ов файлов под prefix в коммите: {путь без prefix: id}, из дерева, без выгрузки"""
+        output = _git(['ls-tree', '-r', '-z', commit, '--', prefix], cwd=self.path)
+        blobs = {}
+        for line in output.split('\0'):
+            if not line:
+                continue
+            meta, path = line.split('\t', 1)
+            mode, kind, object_id = meta.split()
+            # Симлинки сравниваются по цели, подмодули не выгружаются
+            if kind != 'blob' or mode == '120000':
+                continue
+            blobs[path[len(prefix) + 1:]] = object_id
+        return blobs
+
+    def export(self, ref: str, dest: Path) -> str:
+        """Выгружает дерево ref в dest потоком git archive | tar; возвращает хэш коммита"""
+        commit = self.resolve(ref)
+        dest = Path(dest)
+        dest.mkdir(parents=True, exist_ok=True)
+        extract_args = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+        proc = subprocess.Popen(['git', 'archive', '--format=tar', commit], cwd=self.path,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|', bufsize=STREAM_BUFSIZE) as tar:
+                tar.extractall(dest, **extract_args)
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            stderr = proc.stderr.read().decode(errors='replace').strip()
+            proc.stderr.close()
+            proc.wait()
+        if proc.returncode != 0:
+            raise MirrorError(stderr or f"git archive завершился с кодом {proc.returncode}")
+        return commit
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import time
+import shutil
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from snapshots import list_backups, backup_time, partial_in_use, SNAPSHOT_PREFIX, PARTIAL_GRACE
+
+DEFAULT_POLICY = {
+    'keep_last': 5,
+    'keep_daily': 7,
+    'keep_weekly': 4,
+}
+
+
+def load_backup_config(root: Path) -> Dict:
+    """Секция backups из etc/config.yml: политика хранения и compression"""
+    from mashfs.config import load_config
+    backups = load_config(root).backups
+    return {
+        'keep_last': backups.keep_last,
+        'keep_daily': backups.keep_daily,
+        'keep_weekly': backups.keep_weekly,
+        'compression': backups.compression,
+    }
+
+
+def plan_prune(backups: List[Path], policy: Dict) -> Tuple[Dict[Path, List[str]], List[Path]]:
+    """Делит резервные копии на оставляемые (с причинами) и удаляемые.
+
+    keep_last - N последних; keep_daily / keep_weekly - самая новая копия
+    за каждый из N последних дней / недель, в которые копии делались.
+    """
+    ordered = sorted(backups, key=backup_time, reverse=True)
+    reasons = {backup: [] for backup in ordered}
+    for backup in ordered[:policy['keep_last']]:
+        reasons[backup].append('last')
+
+    periods = (
+        ('daily', policy['keep_daily'], lambda t: t.date()),
+        ('weekly', policy['keep_weekly'], lambda t: t.isocalendar()[:2]),
+    )
+    for reason, count, period_of in periods:
+        seen = set()
+        for backup in ordered:
+            if len(seen) >= count:
+                break
+            period = period_of(backup_time(backup))
+            if period not in seen:
+                seen.add(period)
+                reasons[backup].append(reason)
+
+    keep = {backup: why for backup, why in reasons.items() if why}
+    remove = [backup for backup in ordered if not reasons[backup]]
+    return keep, remove
+
+
+def _partial_alive(partial: Path) -> bool:
+    # Копию еще пишут: ее держит flock пишущего процесса или она только что создана
+    try:
+        if time.time() - partial.lstat().st_mtime < PARTIAL_GRACE:
+            return True
+    except OSError:
+        return True
+    return partial_in_use(partial)
+
+
+def prune(parent: Path, policy: Dict, dry_run: bool = False) -> List[Path]:
+    """Удаляет резервные копии вне политики и брошенные .partial; возвращает удаленное"""
+    _, remove = plan_prune(list_backups(parent), policy)
+    remove += [partial for partial in sorted(Path(parent).glob(f".{SNAPSHOT_PREFIX}*.partial"))
+               if not _partial_alive(partial)]
+    if not dry_run:
+        for backup in remove:
+            if backup.is_dir() and not backup.is_symlink():
+                shutil.rmtree(backup)
+            else:
+                backup.unlink()
+    return remove
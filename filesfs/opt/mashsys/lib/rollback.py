@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import os
+import json
+import fcntl
+import errno
+import shutil
+import ctypes
+import ctypes.util
+from pathlib import Path
+from typing import Dict
+
+from snapshots import MANIFEST_NAME, is_archive
+from archives import extract_archive
+
+FICLONE = 0x40049409
+RENAME_EXCHANGE = 2
+RENAME_SWAP = 2
+AT_FDCWD = -100
+
+
+def _libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return None
+
+
+def exchange_paths(a: Path, b: Path) -> bool:
+    """Атомарно меняет местами два пути; False, если ядро/ФС этого не умеют.
+
+    Linux - renameat2(RENAME_EXCHANGE), macOS - renamex_np(RENAME_SWAP).
+    """
+    libc = _libc()
+    if hasattr(libc, 'renameat2'):
+        func = libc.renameat2
+        func.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+        call = lambda: func(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE)
+    elif hasattr(libc, 'renamex_np'):
+        func = libc.renamex_np
+        func.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint]
+        call = lambda: func(os.fsencode(a), os.fsencode(b), RENAME_SWAP)
+    else:
+        return False
+    func.restype = ctypes.c_int
+    if call() == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+        return False
+    raise OSError(err, os.strerror(err), str(a))
+
+
+class _Cloner:
+    """Файл из снимка: reflink, если ФС умеет, иначе копия.
+
+    Жесткая ссылка не годится: восстановленный корень живой и пишется на месте
+    (etc/shadow, etc/passwd открываются на запись), и такая запись испортила
+    бы файл в самом снимке и во всех снимках, связанных с ним ссылками.
+    """
+
+    def __init__(self):
+        self.reflink = True
+        self.stats = {'reflinked': 0, 'copied': 0}
+
+    def clone(self, src: str, dst: Path) -> None:
+        if self.reflink:
+            try:
+                with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                shutil.copystat(src, dst)
+                self.stats['reflinked'] += 1
+                return
+            except OSError:
+                self.reflink = False
+                dst.unlink(missing_ok=True)
+        shutil.copy2(src, dst)
+        self.stats['copied'] += 1
+
+
+def link_farm(snapshot: Path, dest: Path) -> Dict:
+    """Собирает в dest дерево снимка; данные копируются, только если ФС не умеет reflink"""
+    snapshot, dest = Path(snapshot), Path(dest)
+    cloner = _Cloner()
+    dirs = {}
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        (dest / rel_dir).mkdir(parents=True, exist_ok=True)
+        dirs[rel_dir] = os.stat(snapshot / rel_dir).st_mode & 0o7777
+        with os.scandir(snapshot / rel_dir) as it:
+            for entry in it:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if rel == MANIFEST_NAME:
+                    continue
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), dest / rel)
+                elif entry.is_dir():
+                    stack.append(rel)
+                elif entry.is_file():
+                    cloner.clone(entry.path, dest / rel)
+    for rel_dir, mode in sorted(dirs.items(), key=lambda item: item[0].count('/') + bool(item[0]), reverse=True):
+        os.chmod(dest / rel_dir, mode)
+    return cloner.stats
+
+
+def stage_backup(backup: Path, staging: Path) -> Dict:
+    """Готовит восстановленное дерево рядом с корнем: архив распаковывается, снимок клонируется"""
+    if staging.exists():
+        shutil.rmtree(staging)
+    try:
+        if is_archive(backup):
+            extract_archive(backup, staging)
+            return {}
+        return link_farm(backup, staging)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def _journal_file(root: Path) -> Path:
+    return root.parent / f".{root.name}.swap.json"
+
+
+def swap_root(root: Path, staging: Path, previous: Path) -> None:
+    """Ставит staging на место root, старый корень переезжает в previous.
+
+    С exchange_paths() подмена атомарна; без него - два rename, между
+    которыми корня нет, поэтому шаги пишутся в журнал и при падении
+    доводятся recover_swap() при следующем запуске mashsys или chrootmash.
+    """
+    journal = _journal_file(root)
+    data = {
+        'root': str(root),
+        'staging': str(staging),
+        'previous': str(previous),
+        'staging_ino': staging.stat().st_ino,
+    }
+    tmp = journal.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, journal)
+
+    if exchange_paths(staging, root):
+        # staging теперь указывает на старый корень
+        os.rename(staging, previous)
+    else:
+        os.rename(root, previous)
+        os.rename(staging, root)
+    journal.unlink()
+
+
+def recover_swap(root: Path) -> bool:
+    """Доводит или отменяет подмену корня, прерванную падением; True, если было что делать"""
+    journal = _journal_file(root)
+    try:
+        with open(journal) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        journal.unlink()
+        return False
+
+    staging, previous = Path(data['staging']), Path(data['previous'])
+    if not root.exists():
+        # Упали между двумя rename: старый корень уже в previous
+        os.rename(staging if staging.exists() else previous, root)
+    elif root.stat().st_ino == data['staging_ino']:
+        # Обмен прошел, осталось убрать старый корень в previous
+        if staging.exists():
+            os.rename(staging, previous)
+    elif staging.exists():
+        # Обмен не начинался - откат просто не состоялся
+        shutil.rmtree(staging)
+    journal.unlink()
+    return True
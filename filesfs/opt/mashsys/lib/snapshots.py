@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+from pathlib import Path
+from datetime import datetime
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+SNAPSHOT_PREFIX = 'mashfs_backup_'
+MANIFEST_NAME = '.mashsys-snapshot.json'
+MANIFEST_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+ARCHIVE_SUFFIXES = ('.tar.zst', '.tar.xz', '.tar.gz')
+# Недописанная копия моложе этого не удаляется, даже если ее никто не держит:
+# между созданием .partial и flock на нем есть короткое окно
+PARTIAL_GRACE = 60
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def lock_partial(fd: int) -> None:
+    """Эксклюзивный flock на недописанной копии (файл или каталог) до закрытия fd:
+    так prune отличает копию, которую еще пишут, от брошенной"""
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def partial_in_use(path: Path) -> bool:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def file_sha256(path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def format_size(size: int) -> str:
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024 or unit == 'ГБ':
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def list_snapshots(parent: Path) -> List[Path]:
+    """Каталоги резервных копий, новые первыми"""
+    return sorted((p for p in Path(parent).glob(SNAPSHOT_PREFIX + '*') if p.is_dir()), key=backup_time, reverse=True)
+
+
+def is_archive(backup: Path) -> bool:
+    return Path(backup).name.endswith(ARCHIVE_SUFFIXES)
+
+
+def backup_name(backup: Path) -> str:
+    """Метка резервной копии без префикса и расширения архива"""
+    name = Path(backup).name[len(SNAPSHOT_PREFIX):]
+    for suffix in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def backup_time(backup: Path) -> datetime:
+    try:
+        return datetime.strptime(backup_name(backup)[-15:], '%Y%m%d_%H%M%S')
+    except ValueError:
+        return datetime.fromtimestamp(Path(backup).lstat().st_mtime)
+
+
+def list_backups(parent: Path) -> List[Path]:
+    """Все резервные копии - снимки-каталоги и архивы, новые первыми"""
+    backups = [p for p in Path(parent).glob(SNAPSHOT_PREFIX + '*') if p.is_dir() or is_archive(p)]
+    return sorted(backups, key=backup_time, reverse=True)
+
+
+def load_manifest(snapshot: Path) -> Optional[Dict]:
+    """Манифест снимка; None для старых полных копий без манифеста"""
+    try:
+        with open(Path(snapshot) / MANIFEST_NAME) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _unchanged(prev: Dict, record: Dict, base_file: Path, checksum: bool) -> bool:
+    if prev['size'] != record['size'] or prev['mode'] != record['mode']:
+        return False
+    if not checksum:
+        return prev['mtime_ns'] == record['mtime_ns']
+    try:
+        return (prev.get('sha256') or file_sha256(base_file)) == record['sha256']
+    except OSError:
+        return False
+
+
+def create_snapshot(root: Path, parent: Optional[Path] = None, checksum: bool = False) -> Tuple[Path, Dict]:
+    """Создает снимок root в стиле rsync --link-dest.
+
+    Неизмененные с последнего снимка файлы (size+mtime, с checksum=True -
+    sha256) становятся жесткими ссылками на файлы предыдущего снимка,
+    копируются только измененные. Симлинки сохраняются как есть.
+    Снимок собирается во временном каталоге и появляется под своим
+    именем только целиком.
+    """
+    root = Path(root)
+    parent = Path(parent or root.parent)
+    name = SNAPSHOT_PREFIX + datetime.now().strftime('%Y%m%d_%H%M%S')
+    dest = parent / name
+    if dest.exists():
+        raise SnapshotError(f"Резервная копия {dest} уже существует")
+
+    base, base_files = None, {}
+    for snapshot in list_snapshots(parent):
+        manifest = load_manifest(snapshot)
+        if manifest is not None:
+            base, base_files = snapshot, manifest['files']
+            break
+
+    tmp = parent / f".{name}.partial"
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir()
+    tmp_fd = os.open(tmp, os.O_RDONLY)
+    lock_partial(tmp_fd)
+
+    files: Dict[str, Dict] = {}
+    symlinks: Dict[str, str] = {}
+    dirs: Dict[str, int] = {}
+    bytes_copied = 0
+    try:
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            src_dir = root / rel_dir
+            (tmp / rel_dir).mkdir(parents=True, exist_ok=True)
+            dirs[rel_dir or '.'] = os.stat(src_dir).st_mode & 0o7777
+            with os.scandir(src_dir) as it:
+                for entry in it:
+                    rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                    dst = tmp / rel
+                    if entry.is_symlink():
+                        symlinks[rel] = os.readlink(entry.path)
+                        os.symlink(symlinks[rel], dst)
+                    elif entry.is_dir():
+                        stack.append(rel)
+                    elif entry.is_file():
+                        st = entry.stat(follow_symlinks=False)
+                        record = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'mode': st.st_mode & 0o7777}
+                        if checksum:
+                            record['sha256'] = file_sha256(entry.path)
+                        prev = base_files.get(rel)
+                        if prev is not None and _unchanged(prev, record, base / rel, checksum):
+                            try:
+                                os.link(base / rel, dst)
+                                record['ino'] = os.stat(dst).st_ino
+                                files[rel] = record
+                                continue
+                            except OSError:
+                                pass
+                        shutil.copy2(entry.path, dst)
+                        record['ino'] = os.stat(dst).st_ino
+                        bytes_copied += record['size']
+                        files[rel] = record
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'source': str(root),
+            'base': base.name if base else None,
+            'checksum': checksum,
+            'bytes_total': sum(record['size'] for record in files.values()),
+            'bytes_copied': bytes_copied,
+            'files': files,
+            'symlinks': symlinks,
+            'dirs': dirs,
+        }
+        with open(tmp / MANIFEST_NAME, 'w') as f:
+            json.dump(manifest, f)
+        # Права каталогов - в конце, чтобы каталоги без w не мешали заполнению
+        for rel_dir, mode in sorted(dirs.items(), reverse=True):
+            os.chmod(tmp / rel_dir, mode)
+        os.rename(tmp, dest)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    finally:
+        os.close(tmp_fd)
+    return dest, manifest
+
+
+def snapshot_usage(parent: Path) -> Tuple[List[Dict], int]:
+    """Размеры резервных копий по манифестам, без обхода файлов.
+
+    unique - байты, которые есть только в этой копии (освободятся при ее
+    удалении); файлы, общие с другими снимками через жесткие ссылки, не
+    учитываются. Архив целиком уникален. Для старых копий без манифеста
+    размеры неизвестны (None). Второе значение - сколько места занимают
+    все копии с известным размером.
+    """
+    backups = [(backup, None if is_archive(backup) else load_manifest(backup)) for backup in list_backups(parent)]
+    refs = Counter()
+    sizes = {}
+    for _, manifest in backups:
+        if manifest is not None:
+            for record in manifest['files'].values():
+                sizes[record['ino']] = record['size']
+            refs.update({record['ino'] for record in manifest['files'].values()})
+
+    usage = []
+    archives_size = 0
+    for backup, manifest in backups:
+        if is_archive(backup):
+            size = backup.stat().st_size
+            archives_size += size
+            usage.append({'path': backup, 'archive': True, 'total': None, 'unique': size})
+            continue
+        if manifest is None:
+            usage.append({'path': backup, 'archive': False, 'total': None, 'unique': None})
+            continue
+        seen = set()
+        unique = 0
+        for record in manifest['files'].values():
+            if refs[record['ino']] == 1 and record['ino'] not in seen:
+                unique += record['size']
+                seen.add(record['ino'])
+        usage.append({
+            'path': backup,
+            'archive': False,
+            'total': manifest.get('bytes_total', 0),
+            'unique': unique,
+        })
+    return usage, sum(sizes.values()) + archives_size
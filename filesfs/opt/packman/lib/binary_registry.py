@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import copy
+import hashlib
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+REGISTRY_VERSION = 1
+# Ссылки, созданные старыми версиями packman: .../opt/packman/<enabled|packages>/<пакет>/bin/<команда>
+_LEGACY_LINK = re.compile(r'(?:^|/)opt/packman/(?:enabled|packages)/([^/]+)/bin/([^/]+)$')
+
+
+def file_sha256(path: Path) -> Optional[str]:
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+class BinaryRegistry:
+    """Реестр команд bin/: команда -> (пакет, цель, sha256, приоритет)
+
+    providers хранит всех поставщиков команды, commands - активного владельца,
+    на которого указывает ссылка bin/<команда>. При равном приоритете
+    остается пакет, зарегистрированный первым.
+    """
+
+    def __init__(self, root: Path, registry_file: Optional[Path] = None, bin_dir: Optional[Path] = None):
+        self.root = Path(root)
+        self.registry_file = registry_file or self.root / 'opt' / 'packman' / 'binaries.json'
+        self.bin_dir = bin_dir or self.root / 'bin'
+        self.providers: Dict[str, Dict[str, Dict]] = {}
+        self.commands: Dict[str, Dict] = {}
+        self.packages: Dict[str, set] = {}
+        self._seq = 0
+        self._journal = None
+        self._mtime = None
+        self.load()
+
+    def load(self) -> None:
+        try:
+            st = self.registry_file.stat()
+            with open(self.registry_file) as f:
+                data = json.load(f)
+            self._mtime = st.st_mtime_ns
+            self.providers = data.get('providers', {})
+        except FileNotFoundError:
+            self._mtime = None
+            self.providers = {}
+            self._adopt_existing_links()
+        self._rebuild()
+
+    def reload_if_changed(self) -> bool:
+        try:
+            mtime = self.registry_file.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+        self.load()
+        return True
+
+    def _adopt_existing_links(self) -> None:
+        if not self.bin_dir.is_dir():
+            return
+        for link in self.bin_dir.iterdir():
+            if not link.is_symlink():
+                continue
+            match = _LEGACY_LINK.search(os.readlink(link))
+            if not match or match.group(2) != link.name:
+                continue
+            package = match.group(1)
+            target = Path('opt') / 'packman' / 'enabled' / package / 'bin' / link.name
+            self._add_provider(link.name, package, target, 0)
+
+    def _add_provider(self, command: str, package: str, target: Path, priority: int) -> None:
+        self._seq += 1
+        self.providers.setdefault(command, {})[package] = {
+            'package': package,
+            'target': str(target),
+            'sha256': file_sha256(self.root / target),
+            'priority': priority,
+            'seq': self._seq,
+        }
+
+    def _rebuild(self) -> None:
+        self.commands = {}
+        self.packages = {}
+        for command, providers in self.providers.items():
+            for package, entry in providers.items():
+                self.packages.setdefault(package, set()).add(command)
+                self._seq = max(self._seq, entry.get('seq', 0))
+            if providers:
+                self.commands[command] = max(providers.values(), key=lambda e: (e.get('priority', 0), -e.get('seq', 0)))
+
+    def owner(self, command: str) -> Optional[Dict]:
+        return self.commands.get(command)
+
+    def target(self, command: str) -> Optional[Path]:
+        entry = self.commands.get(command)
+        return self.root / entry['target'] if entry else None
+
+    def package_commands(self, package: str) -> List[str]:
+        return sorted(self.packages.get(package, ()))
+
+    def _is_unmanaged(self, command: str) -> bool:
+        link = self.bin_dir / command
+        if command in self.commands:
+            return False
+        if link.is_symlink():
+            return not _LEGACY_LINK.search(os.readlink(link))
+        return link.exists()
+
+    def _record(self, link: Path) -> None:
+        if self._journal is None:
+            return
+        if link.name in self._journal['links']:
+            return
+        self._journal['links'][link.name] = os.readlink(link) if link.is_symlink() else None
+
+    def _sync_link(self, command: str) -> None:
+        link = self.bin_dir / command
+        entry = self.commands.get(command)
+        if entry is None:
+            if link.is_symlink():
+                self._record(link)
+                link.unlink()
+            return
+
+        target = os.path.relpath(self.root / entry['target'], self.bin_dir)
+        if link.is_symlink() and os.readlink(link) == target:
+            return
+        self._record(link)
+        tmp = self.bin_dir / f".{command}.packman-tmp"
+        if tmp.is_symlink() or tmp.exists():
+            tmp.unlink()
+        os.symlink(target, tmp)
+        os.replace(tmp, link)
+
+    def register(self, package: str, binaries: Dict[str, Path], priority: int = 0) -> List[str]:
+        """Регистрирует бинарники пакета {команда: путь} и обновляет ссылки; возвращает предупреждения о конфликтах"""
+        warnings = []
+        skipped = set()
+        self.bin_dir.mkdir(parents=True, exist_ok=True)
+        for command in set(self.packages.get(package, ())) - set(binaries):
+            self.providers[command].pop(package, None)
+        for command, path in binaries.items():
+            if self._is_unmanaged(command):
+                warnings.append(f"{command}: bin/{command} не принадлежит ни одному пакету, пропускаем {package}")
+                skipped.add(command)
+                continue
+            previous = self.providers.get(command, {}).get(package)
+            self._add_provider(command, package, Path(path).relative_to(self.root), priority)
+            if previous is not None:
+                self.providers[command][package]['seq'] = previous['seq']
+
+        stale = [command for command, providers in self.providers.items() if not providers]
+        for command in stale:
+            del self.providers[command]
+        touched = (set(binaries) - skipped) | set(self.packages.get(package, ()))
+        self._rebuild()
+
+        for command in sorted(touched):
+            owner = self.commands.get(command)
+            if owner is not None and owner['package'] != package and package in self.providers.get(command, {}):
+                warnings.append(f"{command}: предоставляется пакетом {owner['package']}, версия из {package} не связана (приоритет {priority} <= {owner.get('priority', 0)})")
+            elif owner is not None and owner['package'] == package and len(self.providers[command]) > 1:
+                others = ", ".join(sorted(p for p in self.providers[command] if p != package))
+                warnings.append(f"{command}: {package} перекрывает {others}")
+            self._sync_link(command)
+        return warnings
+
+    def unregister(self, package: str) -> List[str]:
+        """Удаляет команды пакета; если команду предоставляет другой пакет, ссылка переключается на него"""
+        commands = self.package_commands(package)
+        for command in commands:
+            self.providers[command].pop(package, None)
+            if not self.providers[command]:
+                del self.providers[command]
+        self._rebuild()
+        for command in commands:
+            self._sync_link(command)
+        return commands
+
+    def relink(self, commands: Optional[List[str]] = None) -> int:
+        """Пересоздает ссылки bin/ по реестру; возвращает число исправленных ссылок"""
+        fixed = 0
+        for command in sorted(commands if commands is not None else self.commands):
+            link = self.bin_dir / command
+            before = os.readlink(link) if link.is_symlink() else None
+            self._sync_link(command)
+            after = os.readlink(link) if link.is_symlink() else None
+            if before != after:
+                fixed += 1
+        return fixed
+
+    def save(self) -> None:
+        self.registry_file.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            'version': REGISTRY_VERSION,
+            'commands': {command: entry for command, entry in sorted(self.commands.items())},
+            'providers': self.providers,
+        }
+        tmp = self.registry_file.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.registry_file)
+        self._mtime = self.registry_file.stat().st_mtime_ns
+
+    def _rollback(self) -> None:
+        for command, target in self._journal['links'].items():
+            link = self.bin_dir / command
+            if link.is_symlink():
+                link.unlink()
+            if target is not None:
+                os.symlink(target, link)
+        self.providers = self._journal['providers']
+        self._rebuild()
+
+    @contextmanager
+    def transaction(self):
+        """Все изменения ссылок внутри блока либо сохраняются вместе с реестром, либо откатываются"""
+        if self._journal is not None:
+            yield self
+            return
+        self._journal = {'providers': copy.deepcopy(self.providers), 'links': {}}
+        try:
+            yield self
+        except BaseException:
+            self._rollback()
+            raise
+        else:
+            self.save()
+        finally:
+            self._journal = None
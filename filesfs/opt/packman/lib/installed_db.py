@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from mashfs.index import note_changed
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_WORKERS = 8
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class InstalledDB:
+    """База установленных файлов: манифест на пакет и обратный индекс путь -> пакет
+
+    Манифест opt/packman/installed/manifests/<пакет>.json хранит каталог установки
+    пакета (относительно корня) и для каждого файла size, mtime_ns и sha256.
+    installed/index.json - обратный индекс всех установленных файлов; манифесты
+    лежат отдельно, чтобы пакет с именем index не совпадал с ним.
+    """
+
+    def __init__(self, root: Path, db_dir: Path, workers: int = DEFAULT_WORKERS, read_only: bool = False):
+        self.root = Path(root)
+        self.db_dir = Path(db_dir)
+        self.index_file = self.db_dir / 'index.json'
+        self.manifests_dir = self.db_dir / 'manifests'
+        self.workers = workers
+        self.txn = None
+        self._index = None
+        self._dirty = False
+        self._migrate(read_only)
+
+    def _migrate(self, read_only: bool) -> None:
+        # Раньше манифесты лежали рядом с index.json
+        if self.manifests_dir.is_dir() or not self.db_dir.is_dir():
+            return
+        if read_only:
+            # Переносить нельзя - читаем по-старому
+            self.manifests_dir = self.db_dir
+            return
+        self.manifests_dir.mkdir()
+        for path in self.db_dir.glob('*.json'):
+            if path != self.index_file:
+                os.replace(path, self.manifests_dir / path.name)
+
+    def manifest_file(self, package: str) -> Path:
+        return self.manifests_dir / f"{package}.json"
+
+    def _write_json(self, path: Path, data: Dict) -> None:
+        payload = json.dumps(data, indent=1, sort_keys=True).encode()
+        if self.txn is not None:
+            self.txn.write_file(path, payload)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        tmp.write_bytes(payload)
+        os.replace(tmp, path)
+
+    def packages(self) -> List[str]:
+        if not self.manifests_dir.is_dir():
+            return []
+        return sorted(p.stem for p in self.manifests_dir.glob('*.json') if p != self.index_file)
+
+    def load(self, package: str) -> Optional[Dict]:
+        try:
+            with open(self.manifest_file(package)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _scan(self, package_path: Path) -> Dict[str, Dict]:
+        entries = {}
+        for dirpath, dirnames, filenames in os.walk(package_path):
+            for name in filenames:
+                path = Path(dirpath) / name
+                st = path.lstat()
+                entries[str(path.relative_to(package_path))] = {
+                    'size': st.st_size,
+                    'mtime_ns': st.st_mtime_ns,
+                    'mode': st.st_mode & 0o7777,
+                }
+        paths = list(entries)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for rel, digest in zip(paths, pool.map(lambda rel: file_sha256(package_path / rel), paths)):
+                entries[rel]['sha256'] = digest
+        return entries
+
+    def build(self, package: str, package_path: Path) -> Dict:
+        """Манифест каталога пакета: чтение и sha256 всех файлов, без записи в базу"""
+        return {
+            'package': package,
+            'location': str(Path(package_path).relative_to(self.root)),
+            'files': self._scan(Path(package_path)),
+        }
+
+    def record(self, package: str, package_path: Path, manifest: Optional[Dict] = None) -> Dict:
+        """Записывает манифест для только что установленного каталога пакета;
+        готовый манифест из build() можно передать, чтобы не хешировать файлы еще раз"""
+        if manifest is None:
+            manifest = self.build(package, package_path)
+        self._write_json(self.manifest_file(package), manifest)
+        self._update_index(package, manifest)
+        note_changed(self.root, [manifest['location']])
+        return manifest
+
+    def relocate(self, package: str, package_path: Path) -> None:
+        """Каталог пакета перемещен (enable/disable): файлы те же, меняется только location"""
+        manifest = self.load(package)
+        if manifest is None:
+            return
+        previous = manifest['location']
+        manifest['location'] = str(Path(package_path).relative_to(self.root))
+        self._write_json(self.manifest_file(package), manifest)
+        self._update_index(package, manifest)
+        note_changed(self.root, [previous, manifest['location']])
+
+    def forget(self, package: str) -> None:
+        manifest = self.load(package)
+        if manifest is not None:
+            note_changed(self.root, [manifest['location']])
+        manifest_file = self.manifest_file(package)
+        if manifest_file.exists():
+            if self.txn is not None:
+                self.txn.remove(manifest_file)
+            else:
+                manifest_file.unlink()
+        self._update_index(package, None)
+
+    def installed_paths(self, package: str) -> List[Path]:
+        manifest = self.load(package)
+        if manifest is None:
+            return []
+        base = self.root / manifest['location']
+        return [base / rel for rel in manifest['files']]
+
+    def _load_index(self) -> Dict[str, str]:
+        if self._index is None:
+            try:
+                with open(self.index_file) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+                for package in self.packages():
+                    manifest = self.load(package)
+                    if manifest is not None:
+                        for rel in manifest['files']:
+                            self._index[str(Path(manifest['location']) / rel)] = package
+        return self._index
+
+    def _update_index(self, package: str, manifest: Optional[Dict]) -> None:
+        index = {path: owner for path, owner in self._load_index().items() if owner != package}
+        if manifest is not None:
+            for rel in manifest['files']:
+                index[str(Path(manifest['location']) / rel)] = package
+        self._index = index
+        self._dirty = True
+        if self.txn is None:
+            self.flush()
+
+    def flush(self) -> None:
+        """Записывает обратный индекс; в транзакции - один раз на всю транзакцию"""
+        if self._dirty:
+            self._write_json(self.index_file, self._index)
+            self._dirty = False
+
+    def discard(self) -> None:
+        """Сбрасывает несохраненные изменения индекса (после отката транзакции)"""
+        self._index = None
+        self._dirty = False
+
+    def owner(self, rel_path: str) -> Optional[str]:
+        return self._load_index().get(str(Path(rel_path)))
+
+    def verify(self, package: str) -> List[Dict]:
+        """Сверяет файлы пакета с манифестом.
+
+        Файлы с тем же size и mtime считаются целыми без чтения; sha256
+        считается (параллельно) только для файлов с измененным mtime.
+        """
+        manifest = self.load(package)
+        if manifest is None:
+            return [{'path': None, 'problem': 'no-manifest'}]
+
+        base = self.root / manifest['location']
+        problems = []
+        suspicious = []
+        for rel, expected in manifest['files'].items():
+            path = base / rel
+            try:
+                st = path.lstat()
+            except FileNotFoundError:
+                problems.append({'path': str(path.relative_to(self.root)), 'problem': 'missing'})
+                continue
+            if st.st_size != expected['size']:
+                problems.append({'path': str(path.relative_to(self.root)), 'problem': 'modified'})
+            elif st.st_mtime_ns != expected['mtime_ns']:
+                suspicious.append((path, expected))
+
+        if suspicious:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                digests = pool.map(lambda item: file_sha256(item[0]), suspicious)
+                for (path, expected), digest in zip(suspicious, digests):
+                    if digest != expected['sha256']:
+                        problems.append({'path': str(path.relative_to(self.root)), 'problem': 'modified'})
+        return problems
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import os
+import time
+import fcntl
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Dict, List
+
+DEFAULT_TIMEOUT = 60
+POLL_INTERVAL = 0.05
+
+
+class LockError(Exception):
+    pass
+
+
+def _flock(fd: int, operation: int, what: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                raise LockError(f"{what} занят другим процессом packman")
+            time.sleep(POLL_INTERVAL)
+
+
+class PackmanLocks:
+    """fcntl-блокировки packman.
+
+    state.lock - общая блокировка состояния: читающие команды держат ее
+    в режиме LOCK_SH, фаза фиксации (ссылки bin/, реестр, индексы) - коротко
+    в режиме LOCK_EX. <пакет>.lock - эксклюзивная блокировка пакета на время
+    транзакции, поэтому независимые пакеты ставятся параллельно.
+
+    read_only - корень, в который нельзя писать (нижний слой overlay):
+    state.lock не создается, shared() берет его, только если он уже есть,
+    а эксклюзивные блокировки - LockError.
+    """
+
+    def __init__(self, lock_dir: Path, timeout: float = DEFAULT_TIMEOUT, read_only: bool = False):
+        self.lock_dir = Path(lock_dir)
+        self.read_only = read_only
+        if not read_only:
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
+        self.timeout = timeout
+        self._state_fd = None
+        self._state_mode = None
+        self._packages: Dict[str, int] = {}
+
+    def _state(self) -> int:
+        if self._state_fd is None:
+            if self.read_only:
+                self._state_fd = os.open(self.lock_dir / 'state.lock', os.O_RDONLY)
+            else:
+                self._state_fd = os.open(self.lock_dir / 'state.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        return self._state_fd
+
+    def _check_writable(self) -> None:
+        if self.read_only:
+            raise LockError("packman открыт только для чтения")
+
+    @contextmanager
+    def shared(self):
+        """Блокировка для команд, которые только читают состояние"""
+        if self._state_mode is not None:
+            yield
+            return
+        try:
+            fd = self._state()
+        except FileNotFoundError:
+            # Только чтение, и packman здесь еще ни разу не писал: блокировать нечего
+            yield
+            return
+        _flock(fd, fcntl.LOCK_SH, "packman", self.timeout)
+        self._state_mode = 'sh'
+        try:
+            yield
+        finally:
+            fcntl.flock(self._state_fd, fcntl.LOCK_UN)
+            self._state_mode = None
+
+    @contextmanager
+    def exclusive(self):
+        """Короткая глобальная блокировка фазы фиксации"""
+        self._check_writable()
+        previous = self._state_mode
+        if previous == 'ex':
+            yield
+            return
+        _flock(self._state(), fcntl.LOCK_EX, "packman", self.timeout)
+        self._state_mode = 'ex'
+        try:
+            yield
+        finally:
+            if previous == 'sh':
+                fcntl.flock(self._state_fd, fcntl.LOCK_SH)
+            else:
+                fcntl.flock(self._state_fd, fcntl.LOCK_UN)
+            self._state_mode = previous
+
+    def lock_packages(self, package_names: List[str]) -> None:
+        """Берет эксклюзивные блокировки пакетов (в отсортированном порядке) до release_packages().
+
+        Весь набор нужно брать одним вызовом. Если блокировки уже взяты, новые
+        берутся без ожидания: ожидание вне общего порядка могло бы дать взаимную
+        блокировку с другим процессом, поэтому занятый пакет - сразу LockError.
+        """
+        self._check_writable()
+        timeout = 0 if self._packages else self.timeout
+        for package_name in sorted(set(package_names) - set(self._packages)):
+            fd = os.open(self.lock_dir / f"{package_name}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                _flock(fd, fcntl.LOCK_EX, f"Пакет {package_name}", timeout)
+            except BaseException:
+                os.close(fd)
+                raise
+            self._packages[package_name] = fd
+
+    def release_packages(self) -> None:
+        for fd in self._packages.values():
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._packages = {}
+
+    @staticmethod
+    def try_lock(path: Path):
+        """Неблокирующая эксклюзивная блокировка файла; возвращает fd или None, если файл занят"""
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    @staticmethod
+    def unlock(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
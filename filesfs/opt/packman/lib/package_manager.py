@@ -3,17 +3,76 @@ import os
 import sys
 import yaml
 import json
-import shutil
 import subprocess
 import hashlib
 from pathlib import Path
 from typing import Dict, List, Optional
 import time
 import random
+import re
+import importlib.util
+import importlib.metadata
+from functools import lru_cache, wraps
+from contextlib import contextmanager, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+from remote_repo import ConnectionPool, RemoteRepo, RemoteRepoError, fetch_many, extract_archive
+from binary_registry import BinaryRegistry
+from transaction import Transaction
+from installed_db import InstalledDB
+from locks import PackmanLocks
+from mashfs.config import load_config, load_yaml
+
+@lru_cache(maxsize=None)
+def _python_dep_installed(requirement: str) -> bool:
+    """Проверяет наличие Python-зависимости без импорта модуля"""
+    name = re.split(r'[<>=!~;\[\s]', requirement.strip(), 1)[0]
+    try:
+        importlib.metadata.distribution(name)
+        return True
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    try:
+        return importlib.util.find_spec(name.replace('-', '_')) is not None
+    except (ImportError, ValueError):
+        return False
+
+class PackmanError(Exception):
+    pass
+
+class PostCommitError(PackmanError):
+    """Транзакция зафиксирована, но install-скрипт или pip после нее не выполнился"""
+    pass
+
+def transactional(method=None, *, dependencies=False):
+    """Выполняет метод PackageManager над пакетом в транзакции (или в уже открытой внешней),
+    удерживая эксклюзивную блокировку этого пакета. С dependencies=True метод сам ставит
+    зависимости: тогда до начала работы блокируется весь план установки"""
+    if method is None:
+        return lambda method: transactional(method, dependencies=dependencies)
+
+    @wraps(method)
+    def wrapper(self, package_name, *args, **kwargs):
+        with self.transaction():
+            self.locks.lock_packages(self._resolve_plan(package_name) if dependencies else [package_name])
+            return method(self, package_name, *args, **kwargs)
+    return wrapper
+
+def read_locked(method):
+    """Выполняет читающую команду под разделяемой блокировкой состояния"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.locks.shared():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class PackageManager:
-    def __init__(self, root_dir=None):
+    def __init__(self, root_dir=None, storage=None, read_only=False):
+        """storage - хранилище корня (mashfs.storage): конфигурация читается из того
+        слоя overlay, где лежит, а кэш разобранного YAML ведется в верхнем слое. read_only - корень, в который нельзя писать (нижний
+        слой overlay для читающих команд): не создаются каталоги и блокировки, не
+        откатываются транзакции и не сохраняется состояние doctor"""
         if root_dir is None:
             self.root = Path(os.environ.get('MASHFS_ROOT', 'filesfs')).absolute()
         elif isinstance(root_dir, str):
@@ -23,25 +82,238 @@ class PackageManager:
             
         self.config_dir = self.root / 'opt' / 'packman'
         self.config_file = self.config_dir / 'config.yml'
+        self.system_config_file = self.root / 'etc' / 'packman' / 'config.yml'
         self.repos_dir = self.config_dir / 'repos'
         self.packages_dir = self.config_dir / 'packages'
         self.cached_dir = self.config_dir / 'cached'
         self.enabled_dir = self.config_dir / 'enabled'
         self.disabled_dir = self.config_dir / 'disabled'
         self.bin_dir = self.root / 'bin'
+        self.doctor_state_file = self.config_dir / 'doctor.json'
+        self.transactions_dir = self.config_dir / 'transactions'
+        self.orphaned_dir = self.config_dir / 'orphaned'
+        self._txn = None
+        self._deferred = []
+        self.storage = storage
+        self.read_only = read_only
         
         self.config = self._load_config()
         self.repos = self._load_repos()
+        self.remote_repos = self._load_remote_repos()
         
-        for dir_path in [self.repos_dir, self.packages_dir, self.cached_dir, 
-                        self.enabled_dir, self.disabled_dir, self.bin_dir]:
-            dir_path.mkdir(parents=True, exist_ok=True)
+        if not read_only:
+            for dir_path in [self.repos_dir, self.packages_dir, self.cached_dir,
+                            self.enabled_dir, self.disabled_dir, self.bin_dir, self.transactions_dir]:
+                dir_path.mkdir(parents=True, exist_ok=True)
+
+        self.locks = PackmanLocks(self.config_dir / 'locks', timeout=self.config.get('lock_timeout', 60),
+                                  read_only=read_only)
+        self.registry = BinaryRegistry(self.root, self.config_dir / 'binaries.json', self.bin_dir)
+        self.installed = InstalledDB(self.root, self.config_dir / 'installed', read_only=read_only)
+        if not read_only:
+            self._recover_transactions()
+
+    def _recover_transactions(self) -> None:
+        journals = list(self.transactions_dir.glob('*.json'))
+        if not journals:
+            return
+        with self.locks.exclusive():
+            recovered = False
+            for journal in journals:
+                lock_file = journal.with_suffix('.lock')
+                fd = PackmanLocks.try_lock(lock_file)
+                if fd is None:
+                    # Транзакция еще выполняется другим процессом
+                    continue
+                try:
+                    recovered |= Transaction.recover(journal)
+                finally:
+                    lock_file.unlink(missing_ok=True)
+                    PackmanLocks.unlock(fd)
+            if recovered:
+                print("Откат незавершенной транзакции packman...")
+                self.registry.load()
+                self._reconcile_registry()
+
+    def _reconcile_registry(self) -> None:
+        with self.registry.transaction():
+            for package_name in list(self.registry.packages):
+                if not (self.enabled_dir / package_name).exists():
+                    self.registry.unregister(package_name)
+            self.registry.relink()
+
+    @contextmanager
+    def transaction(self):
+        """Одна транзакция на весь пакетный вызов: журнал файловых операций,
+        один проход связывания bin/ и одна запись реестра при фиксации"""
+        if self._txn is not None:
+            yield self._txn
+            return
+
+        txn_id = f"{os.getpid()}-{time.time_ns()}"
+        lock_file = self.transactions_dir / f"{txn_id}.lock"
+        txn_lock = PackmanLocks.try_lock(lock_file)
+        self._txn = Transaction(self.transactions_dir / f"{txn_id}.json", self.transactions_dir / txn_id)
+        self._deferred = []
+        self._txn.begin()
+        self.installed.txn = self._txn
+        try:
+            yield self._txn
+            deferred, self._deferred = self._deferred, []
+            # Манифесты (sha256 всех файлов) считаются до глобальной блокировки:
+            # каталоги пакетов защищены блокировками пакетов, под ней только запись
+            manifests = {i: self.installed.build(op[1], op[2]) for i, op in enumerate(deferred) if op[0] == 'record'}
+            with self.locks.exclusive():
+                # Другие процессы могли зафиксировать свои транзакции, пока мы копировали файлы
+                self.registry.reload_if_changed()
+                self.installed.discard()
+                with self.registry.transaction():
+                    for action, package_name in [op[:2] for op in deferred if op[0] in ('link', 'unlink')]:
+                        if action == 'unlink':
+                            self._unlink_binaries_now(package_name)
+                        else:
+                            self._link_binaries_now(package_name)
+                    for i, op in enumerate(deferred):
+                        if op[0] == 'record':
+                            self.installed.record(op[1], op[2], manifests[i])
+                        elif op[0] == 'relocate':
+                            self.installed.relocate(op[1], op[2])
+                        elif op[0] == 'forget':
+                            self.installed.forget(op[1])
+                    self.installed.flush()
+        except BaseException:
+            self._txn.rollback()
+            self.installed.discard()
+            raise
+        else:
+            self._txn.commit()
+            # Install-скрипты и pip идут после фиксации, когда файлы и ссылки bin/ уже
+            # на месте, под блокировками пакетов. Их действия журнал не откатывает,
+            # поэтому ошибка здесь не отменяет транзакцию
+            failed = []
+            for op in deferred:
+                try:
+                    if op[0] == 'script':
+                        self._run_script_now(op[1], op[2])
+                    elif op[0] == 'pip':
+                        self._install_pip_dependencies_now(op[1])
+                except (OSError, subprocess.CalledProcessError) as e:
+                    failed.append(f"{op[1]}: {e}")
+            if failed:
+                raise PostCommitError("; ".join(failed))
+        finally:
+            self.installed.txn = None
+            self._txn = None
+            self._deferred = []
+            self.locks.release_packages()
+            lock_file.unlink(missing_ok=True)
+            PackmanLocks.unlock(txn_lock)
+
+    def _dependency_closure(self, package_names: List[str]) -> List[str]:
+        closure = []
+        pending = list(package_names)
+        while pending:
+            name = pending.pop(0)
+            if name in closure:
+                continue
+            closure.append(name)
+            info = self._get_package_info(name) or {}
+            pending.extend(info.get('dependencies', []))
+        return closure
+
+    def batch(self, action: str, package_names: List[str]) -> int:
+        """add/remove/install/enable/disable для нескольких пакетов одной транзакцией"""
+        methods = {
+            'add': self.add,
+            'remove': self.remove,
+            'install': self.install,
+            'enable': self.enable,
+            'disable': self.disable,
+        }
+        method = methods[action]
+        try:
+            with self.transaction():
+                if action in ('add', 'install'):
+                    plan = []
+                    for package_name in package_names:
+                        self._resolve_plan(package_name, plan)
+                    self.locks.lock_packages(plan)
+                    self._fetch_remote(plan)
+                else:
+                    self.locks.lock_packages(package_names)
+                for package_name in package_names:
+                    if method(package_name) != 0:
+                        raise PackmanError(f"{action} {package_name} failed")
+        except PostCommitError as e:
+            print(f"Ошибка: {e}")
+            print("Пакеты установлены, но шаги после установки выполнены не полностью")
+            return 1
+        except Exception as e:
+            print(f"Ошибка: {e}")
+            print("Транзакция отменена, изменения откатены")
+            return 1
+        return 0
+
+    def _load_manifest(self, manifest_path: Path) -> List[str]:
+        if not manifest_path.exists():
+            raise FileNotFoundError(f"{manifest_path}: файл не найден")
+        data = load_yaml(manifest_path, self.root, self.storage)
+        if isinstance(data, dict):
+            data = data.get('packages', data)
+        if isinstance(data, dict):
+            data = data.get('enabled', [])
+        if not isinstance(data, list):
+            raise PackmanError(f"{manifest_path}: expected a list of packages or packages.enabled")
+        return [str(name) for name in data]
+
+    def apply(self, manifest_path: Path, dry_run: bool = False) -> int:
+        """Приводит набор включенных пакетов к списку из манифеста"""
+        try:
+            desired = self._dependency_closure(self._load_manifest(manifest_path))
+        except (OSError, yaml.YAMLError, PackmanError) as e:
+            print(f"Ошибка чтения манифеста: {e}")
+            return 1
+
+        enabled = {p.name for p in self.enabled_dir.iterdir() if p.is_dir()}
+        to_enable = [name for name in desired if name not in enabled]
+        to_disable = sorted(enabled - set(desired))
+
+        if not to_enable and not to_disable:
+            print("Набор пакетов уже соответствует манифесту")
+            return 0
+
+        for name in to_enable:
+            print(f"  + {name}")
+        for name in to_disable:
+            print(f"  - {name}")
+        if dry_run:
+            return 0
+
+        try:
+            with self.transaction():
+                self.locks.lock_packages(to_enable + to_disable)
+                for name in to_disable:
+                    if self.disable(name) != 0:
+                        raise PackmanError(f"disable {name} failed")
+                for name in reversed(to_enable):
+                    if (self.enabled_dir / name).exists():
+                        continue
+                    method = self.enable if (self.disabled_dir / name).exists() else self.add
+                    if method(name) != 0:
+                        raise PackmanError(f"{method.__name__} {name} failed")
+        except PostCommitError as e:
+            print(f"Ошибка: {e}")
+            print("Пакеты установлены, но шаги после установки выполнены не полностью")
+            return 1
+        except Exception as e:
+            print(f"Ошибка: {e}")
+            print("Транзакция отменена, изменения откатены")
+            return 1
+        return 0
 
     def _load_config(self) -> Dict:
-        if self.config_file.exists():
-            with open(self.config_file) as f:
-                return yaml.safe_load(f)
-        return {}
+        # etc/packman/config.yml, поверх него opt/packman/config.yml - через общий кэш
+        return dict(load_config(self.root, storage=self.storage).packman)
 
     def _save_config(self) -> None:
         with open(self.config_file, 'w') as f:
@@ -51,79 +323,194 @@ class PackageManager:
         repos = {}
         if self.repos_dir.exists():
             for repo_file in self.repos_dir.glob('*.yml'):
-                with open(repo_file) as f:
-                    repos[repo_file.stem] = yaml.safe_load(f)
+                repos[repo_file.stem] = load_yaml(repo_file, self.root, self.storage)
         return repos
 
+    def _load_remote_repos(self) -> Dict[str, RemoteRepo]:
+        remote_repos = {}
+        if not self.config.get('allow_remote_repos', False):
+            return remote_repos
+
+        self.pool = ConnectionPool(
+            maxsize=self.config.get('max_parallel_downloads', 8),
+            timeout=self.config.get('download_timeout', 30),
+        )
+        repos = sorted(self.config.get('repos', {}).items(), key=lambda item: item[1].get('priority', 100))
+        for repo_name, repo in repos:
+            url = repo.get('url', '')
+            if repo.get('enabled', True) and url.startswith(('http://', 'https://')):
+                remote = RemoteRepo(repo_name, url, self.cached_dir / '.remote' / repo_name, self.pool)
+                # Без записи индекс не скачать: только уже сохраненные
+                if self.read_only and not remote.index_file.exists():
+                    continue
+                remote_repos[repo_name] = remote
+        return remote_repos
+
+    def _find_remote(self, package_name: str) -> Optional[RemoteRepo]:
+        for repo in self.remote_repos.values():
+            try:
+                if repo.package_info(package_name) is not None:
+                    return repo
+            except (OSError, ValueError, RemoteRepoError) as e:
+                print(f"Warning: repository {repo.name} is unavailable: {e}")
+        return None
+
+    def _resolve_plan(self, package_name: str, plan: Optional[List[str]] = None) -> List[str]:
+        if plan is None:
+            plan = []
+        if package_name in plan:
+            return plan
+        plan.append(package_name)
+        info = self._get_package_info(package_name) or {}
+        for dep in info.get('dependencies', []):
+            if not (self.enabled_dir / dep).exists():
+                self._resolve_plan(dep, plan)
+        return plan
+
+    def _fetch_remote(self, package_names: List[str]) -> None:
+        jobs = []
+        for name in package_names:
+            if (self.packages_dir / name).exists():
+                continue
+            repo = self._find_remote(name)
+            if repo is not None:
+                jobs.append((repo, name))
+        if not jobs:
+            return
+
+        print(f"Downloading {len(jobs)} package(s)...")
+        archives = fetch_many(jobs, self.config.get('max_parallel_downloads', 8))
+        for name, archive in archives.items():
+            extract_archive(archive, self.packages_dir / name)
+
+    def update(self) -> int:
+        if not self.remote_repos:
+            print("No remote repositories configured (allow_remote_repos: false)")
+            return 0
+
+        failed = 0
+        for repo in self.remote_repos.values():
+            try:
+                changed = repo.refresh_index()
+                status = "updated" if changed else "up to date"
+                print(f"  {repo.name}: {status} ({len(repo.packages())} packages)")
+            except (OSError, ValueError, RemoteRepoError) as e:
+                print(f"  {repo.name}: error: {e}")
+                failed += 1
+        return 1 if failed else 0
+
     def _get_package_info(self, package_name: str) -> dict:
         pkg_info_path = self.packages_dir / package_name / 'package.yml'
         if pkg_info_path.exists():
             try:
-                with open(pkg_info_path, 'r') as f:
-                    return yaml.safe_load(f)
+                return load_yaml(pkg_info_path, self.root, self.storage)
+            except Exception as e:
+                print(f"Ошибка чтения информации о пакете {package_name}: {e}")
+
+        pkg_json_path = self.packages_dir / package_name / 'info.json'
+        if pkg_json_path.exists():
+            try:
+                with open(pkg_json_path, 'r') as f:
+                    return json.load(f)
             except Exception as e:
                 print(f"Ошибка чтения информации о пакете {package_name}: {e}")
                 
         for repo_name, repo in self.repos.items():
             if package_name in repo.get('packages', {}):
                 return repo['packages'][package_name]
+
+        repo = self._find_remote(package_name)
+        if repo is not None:
+            return repo.package_info(package_name)
                 
         return None
 
     def _install_pip_dependencies(self, package_path):
+        if self._txn is not None:
+            self._deferred.append(('pip', package_path))
+            return
+        self._install_pip_dependencies_now(package_path)
+
+    def _install_pip_dependencies_now(self, package_path):
         pip_deps_file = package_path / 'pip_dependencies'
         if pip_deps_file.exists():
             with open(pip_deps_file) as f:
                 for dep in f.read().splitlines():
                     if dep.strip():
-                        os.system(f"pip install {dep}")
+                        subprocess.run(['pip', 'install', dep.strip()], check=True)
 
-    def _link_binaries(self, package_name: str):
-        print(f"Linking binaries for package {package_name}")
-        package_dir = self.packages_dir / package_name
-        bin_dir = package_dir / 'bin'
-        
-        if not (package_dir.exists() and package_dir.is_dir()):
-            print(f"Warning: Package directory {package_dir} not found")
-            
-        if bin_dir.exists() and bin_dir.is_dir():
-            print(f"Found bin directory at {bin_dir}")
+    def _collect_binaries(self, package_name: str) -> Dict[str, Path]:
+        binaries = {}
+        for bin_dir in [self.packages_dir / package_name / 'bin', self.enabled_dir / package_name / 'bin']:
+            if not bin_dir.is_dir():
+                continue
             for binary in bin_dir.iterdir():
                 if binary.is_file():
-                    print(f"Processing binary: {binary}")
-                    if not os.access(binary, os.X_OK):
-                        print(f"Making {binary} executable")
-                        os.chmod(binary, 0o755)
-                        
-                    link_path = self.bin_dir / binary.name
-                    if link_path.exists() or link_path.is_symlink():
-                        print(f"Removing existing link {link_path}")
-                        os.unlink(link_path)
-                        
-                    print(f"Creating symlink: {link_path} -> {binary}")
-                    os.symlink(binary, link_path)
-        else:
-            print(f"No bin directory found at {bin_dir}")
-            
-        enabled_bin_dir = self.enabled_dir / package_name / 'bin'
-        if enabled_bin_dir.exists() and enabled_bin_dir.is_dir() and enabled_bin_dir != bin_dir:
-            print(f"Found enabled bin directory at {enabled_bin_dir}")
-            for binary in enabled_bin_dir.iterdir():
-                if binary.is_file():
-                    print(f"Processing enabled binary: {binary}")
                     if not os.access(binary, os.X_OK):
-                        print(f"Making {binary} executable")
                         os.chmod(binary, 0o755)
-                        
-                    link_path = self.bin_dir / binary.name
-                    if link_path.exists() or link_path.is_symlink():
-                        print(f"Removing existing link {link_path}")
-                        os.unlink(link_path)
-                        
-                    print(f"Creating symlink: {link_path} -> {binary}")
-                    os.symlink(binary, link_path)
+                    binaries[binary.name] = binary
+        return binaries
+
+    def _link_binaries(self, package_name: str):
+        if self._txn is not None:
+            self._deferred.append(('link', package_name))
+            return
+        self._link_binaries_now(package_name)
+
+    def _unlink_binaries(self, package_name: str):
+        if self._txn is not None:
+            self._deferred.append(('unlink', package_name))
+            return
+        self._unlink_binaries_now(package_name)
+
+    def _link_binaries_now(self, package_name: str):
+        binaries = self._collect_binaries(package_name)
+        if not binaries:
+            return
+
+        info = self._get_package_info(package_name) or {}
+        with self.registry.transaction():
+            warnings = self.registry.register(package_name, binaries, info.get('priority', 0))
+        for warning in warnings:
+            print(f"Warning: {warning}")
+        linked = [cmd for cmd in binaries if (self.registry.owner(cmd) or {}).get('package') == package_name]
+        print(f"Linked {len(linked)} binaries for package {package_name}")
+
+    def _unlink_binaries_now(self, package_name: str):
+        with self.registry.transaction():
+            removed = self.registry.unregister(package_name)
+        for command in removed:
+            owner = self.registry.owner(command)
+            if owner is not None:
+                print(f"Binary {command} now provided by {owner['package']}")
+            else:
+                print(f"Removed binary: {command}")
+
+    @read_locked
+    def which(self, command: str) -> int:
+        owner = self.registry.owner(command)
+        if owner is None:
+            print(f"{command}: не принадлежит ни одному пакету")
+            return 1
+        print(f"{command}: {owner['package']} (/{owner['target']})")
+        others = [p for p in self.registry.providers.get(command, {}) if p != owner['package']]
+        if others:
+            print(f"  также предоставляется: {', '.join(sorted(others))}")
+        return 0
+
+    def relink(self) -> int:
+        with self.locks.exclusive(), self.registry.transaction():
+            fixed = self.registry.relink()
+        print(f"Relinked {fixed} of {len(self.registry.commands)} binaries")
+        return 0
 
     def _run_script(self, package_name: str, script_type: str) -> None:
+        if self._txn is not None:
+            self._deferred.append(('script', package_name, script_type))
+            return
+        self._run_script_now(package_name, script_type)
+
+    def _run_script_now(self, package_name: str, script_type: str) -> None:
         package_dir = self.packages_dir / package_name
         script_file = package_dir / f'{script_type}.sh'
         
@@ -145,11 +532,18 @@ class PackageManager:
         for step in tqdm(steps, desc=f"Installing {package_name}"):
             time.sleep(random.uniform(0.5, 1.0))
 
+    @transactional(dependencies=True)
     def add(self, package_name: str) -> int:
         package_info = self._get_package_info(package_name)
         if not package_info:
             print(f"Package {package_name} not found in any repository")
             return 1
+
+        try:
+            self._fetch_remote(self._resolve_plan(package_name))
+        except (OSError, RemoteRepoError) as e:
+            print(f"Failed to download {package_name}: {e}")
+            return 1
             
         if 'dependencies' in package_info:
             for dep in package_info['dependencies']:
@@ -161,14 +555,15 @@ class PackageManager:
         
         package_dir = self.packages_dir / package_name
         if package_dir.exists():
-            shutil.copytree(package_dir, self.cached_dir / package_name, dirs_exist_ok=True)
+            self._txn.copytree(package_dir, self.cached_dir / package_name)
             
         enabled_path = self.enabled_dir / package_name
         if not enabled_path.exists():
             if (self.cached_dir / package_name).exists():
-                shutil.copytree(self.cached_dir / package_name, enabled_path, dirs_exist_ok=True)
+                self._txn.copytree(self.cached_dir / package_name, enabled_path)
             else:
-                shutil.copytree(package_dir, enabled_path, dirs_exist_ok=True)
+                self._txn.copytree(package_dir, enabled_path)
+            self._deferred.append(('record', package_name, enabled_path))
                 
         self._install_pip_dependencies(package_dir)
         self._link_binaries(package_name)
@@ -177,24 +572,21 @@ class PackageManager:
         print(f"Package {package_name} added and enabled successfully")
         return 0
 
+    @transactional
     def remove(self, package_name: str) -> int:
         removed = False
+        manifest = self.installed.load(package_name)
         for dir_path in [self.cached_dir, self.enabled_dir, self.disabled_dir]:
             package_path = dir_path / package_name
             if package_path.exists():
-                shutil.rmtree(package_path)
+                if manifest is not None and package_path == self.root / manifest['location']:
+                    self._remove_installed_files(package_name, package_path)
+                else:
+                    self._txn.remove(package_path)
                 removed = True
+        self._deferred.append(('forget', package_name))
                 
-        package_dir = self.packages_dir / package_name
-        if package_dir.exists():
-            bin_dir = package_dir / 'bin'
-            if bin_dir.exists() and bin_dir.is_dir():
-                for bin_file in bin_dir.iterdir():
-                    if bin_file.is_file():
-                        target_path = self.bin_dir / bin_file.name
-                        if target_path.exists() and target_path.is_symlink():
-                            target_path.unlink()
-                            print(f"Removed binary: {bin_file.name}")
+        self._unlink_binaries(package_name)
         
         if removed:
             print(f"Package {package_name} removed successfully")
@@ -203,8 +595,61 @@ class PackageManager:
             print(f"Package {package_name} not found")
             return 1
 
+    def _remove_installed_files(self, package_name: str, package_path: Path) -> None:
+        """Удаляет ровно те файлы, что были установлены; чужие файлы переносятся в orphaned/"""
+        self._txn.remove_many(self.installed.installed_paths(package_name))
+        for dirpath, dirnames, filenames in os.walk(package_path, topdown=False):
+            if not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        if package_path.exists():
+            leftovers = [str(p.relative_to(package_path)) for p in package_path.rglob('*') if not p.is_dir()]
+            orphaned_path = self.orphaned_dir / package_name
+            self._txn.move(package_path, orphaned_path)
+            print(f"Файлы, не установленные пакетом {package_name}, перенесены в {orphaned_path}:")
+            for leftover in sorted(leftovers):
+                print(f"  {leftover}")
+
+    @read_locked
+    def verify(self, package_names: Optional[List[str]] = None) -> int:
+        package_names = package_names or self.installed.packages()
+        failed = 0
+        for package_name in package_names:
+            problems = self.installed.verify(package_name)
+            if not problems:
+                print(f"{package_name}: OK")
+                continue
+            failed += 1
+            for problem in problems:
+                if problem['problem'] == 'no-manifest':
+                    print(f"{package_name}: нет манифеста установленных файлов")
+                elif problem['problem'] == 'missing':
+                    print(f"{package_name}: отсутствует /{problem['path']}")
+                else:
+                    print(f"{package_name}: изменен /{problem['path']}")
+        return 1 if failed else 0
+
+    @read_locked
+    def owns(self, path: str) -> int:
+        rel_path = path.lstrip('/')
+        owner = self.installed.owner(rel_path)
+        if owner is None and Path(rel_path).parent == Path('bin'):
+            entry = self.registry.owner(Path(rel_path).name)
+            owner = entry['package'] if entry else None
+        if owner is None:
+            print(f"/{rel_path}: не принадлежит ни одному пакету")
+            return 1
+        print(f"/{rel_path}: {owner}")
+        return 0
+
+    @transactional
     def install(self, package_name: str) -> int:
         package_dir = self.packages_dir / package_name
+        if not package_dir.exists():
+            try:
+                self._fetch_remote([package_name])
+            except (OSError, RemoteRepoError) as e:
+                print(f"Failed to download {package_name}: {e}")
+                return 1
         if not package_dir.exists():
             print(f"Package {package_name} not found")
             return 1
@@ -212,13 +657,12 @@ class PackageManager:
         self._simulate_installation(package_name)
         
         # Копируем в cached
-        shutil.copytree(package_dir, self.cached_dir / package_name, dirs_exist_ok=True)
+        self._txn.copytree(package_dir, self.cached_dir / package_name)
         
         # Копируем в enabled, чтобы активировать пакет
         enabled_path = self.enabled_dir / package_name
-        if enabled_path.exists():
-            shutil.rmtree(enabled_path)
-        shutil.copytree(package_dir, enabled_path)
+        self._txn.copytree(package_dir, enabled_path)
+        self._deferred.append(('record', package_name, enabled_path))
         
         self._install_pip_dependencies(package_dir)
         self._link_binaries(package_name)
@@ -227,25 +671,15 @@ class PackageManager:
         print(f"Package {package_name} installed successfully")
         return 0
 
+    @transactional
     def disable(self, package_name: str) -> int:
         enabled_path = self.enabled_dir / package_name
         disabled_path = self.disabled_dir / package_name
         
         if enabled_path.exists():
-            if disabled_path.exists():
-                shutil.rmtree(disabled_path)
-            shutil.move(enabled_path, disabled_path)
-            
-            package_dir = self.packages_dir / package_name
-            if package_dir.exists():
-                bin_dir = package_dir / 'bin'
-                if bin_dir.exists() and bin_dir.is_dir():
-                    for bin_file in bin_dir.iterdir():
-                        if bin_file.is_file():
-                            target_path = self.bin_dir / bin_file.name
-                            if target_path.exists() and target_path.is_symlink():
-                                target_path.unlink()
-                                print(f"Removed binary: {bin_file.name}")
+            self._txn.move(enabled_path, disabled_path)
+            self._deferred.append(('relocate', package_name, disabled_path))
+            self._unlink_binaries(package_name)
             
             print(f"Package {package_name} disabled")
             return 0
@@ -253,15 +687,15 @@ class PackageManager:
             print(f"Package {package_name} is not enabled")
             return 1
 
+    @transactional
     def enable(self, package_name: str) -> int:
         enabled_path = self.enabled_dir / package_name
         disabled_path = self.disabled_dir / package_name
         package_dir = self.packages_dir / package_name
         
         if disabled_path.exists():
-            if enabled_path.exists():
-                shutil.rmtree(enabled_path)
-            shutil.move(disabled_path, enabled_path)
+            self._txn.move(disabled_path, enabled_path)
+            self._deferred.append(('relocate', package_name, enabled_path))
             
             if package_dir.exists():
                 self._link_binaries(package_name)
@@ -269,9 +703,8 @@ class PackageManager:
             print(f"Package {package_name} enabled")
             return 0
         elif package_dir.exists():
-            if enabled_path.exists():
-                shutil.rmtree(enabled_path)
-            shutil.copytree(package_dir, enabled_path)
+            self._txn.copytree(package_dir, enabled_path)
+            self._deferred.append(('record', package_name, enabled_path))
             
             self._link_binaries(package_name)
             print(f"Package {package_name} enabled")
@@ -280,6 +713,7 @@ class PackageManager:
             print(f"Package {package_name} is not disabled or does not exist")
             return 1
 
+    @read_locked
     def list_packages(self) -> int:
         print("Доступные пакеты:")
         
@@ -289,6 +723,12 @@ class PackageManager:
         for repo_name, repo in self.repos.items():
             for pkg_name in repo.get('packages', {}):
                 all_packages.add(pkg_name)
+
+        for repo in self.remote_repos.values():
+            try:
+                all_packages.update(repo.packages())
+            except (OSError, ValueError, RemoteRepoError) as e:
+                print(f"Предупреждение: репозиторий {repo.name} недоступен: {e}")
                 
         # Локальные пакеты
         for pkg_dir in self.packages_dir.glob('*'):
@@ -313,6 +753,7 @@ class PackageManager:
             
         return 0
         
+    @read_locked
     def show_info(self, package_name: str) -> int:
         info = self._get_package_info(package_name)
         if not info:
@@ -339,94 +780,187 @@ class PackageManager:
             
         return 0
 
-    def doctor(self, fix=False):
-        print(f"Запуск диагностики пакетов...")
-        issues_found = False
-        packages_to_fix = []
-        
-        enabled_packages = [p.name for p in self.enabled_dir.iterdir() if p.is_dir()]
-        
-        for package_name in enabled_packages:
-            print(f"Проверка пакета: {package_name}")
-            package_path = self.enabled_dir / package_name
-            
-            info_path = package_path / 'info.json'
-            if not info_path.exists():
-                issues_found = True
-                print(f"  ОШИБКА: Файл info.json отсутствует для пакета {package_name}")
-                continue
-                
+    def _doctor_signature(self, package_name: str) -> str:
+        """Отпечаток пакета только по stat: info.json при этом не разбирается"""
+        package_path = self.enabled_dir / package_name
+        entries = []
+        for path in [package_path / 'info.json', package_path / 'pip_dependencies']:
+            try:
+                st = path.stat()
+                entries.append(f"{path.name}:{st.st_size}:{st.st_mtime_ns}")
+            except FileNotFoundError:
+                entries.append(f"{path.name}:-")
+
+        bin_dir = package_path / 'bin'
+        if bin_dir.is_dir():
+            with os.scandir(bin_dir) as it:
+                for entry in sorted(it, key=lambda e: e.name):
+                    entries.append(f"bin/{entry.name}:{entry.stat().st_mode:o}")
+
+        return hashlib.sha256("\n".join(entries).encode()).hexdigest()
+
+    def _load_doctor_state(self) -> Dict:
+        try:
+            with open(self.doctor_state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_doctor_state(self, state: Dict) -> None:
+        tmp = self.doctor_state_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, self.doctor_state_file)
+
+    def _check_package(self, package_name: str) -> Dict:
+        result = {
+            'name': package_name,
+            'status': 'ok',
+            'errors': [],
+            'warnings': [],
+            'missing_deps': [],
+            'missing_pip_deps': [],
+            'not_executable': [],
+            'dependencies': [],
+            'pip_dependencies': [],
+        }
+        package_path = self.enabled_dir / package_name
+
+        info_path = package_path / 'info.json'
+        if not info_path.exists():
+            result['errors'].append(f"Файл info.json отсутствует для пакета {package_name}")
+        else:
             try:
                 with open(info_path) as f:
                     info = json.load(f)
             except json.JSONDecodeError:
-                issues_found = True
-                print(f"  ОШИБКА: Файл info.json поврежден для пакета {package_name}")
-                continue
-            
-            missing_deps = []
-            if 'dependencies' in info:
-                for dep in info['dependencies']:
+                result['errors'].append(f"Файл info.json поврежден для пакета {package_name}")
+                info = None
+
+            if info is not None:
+                result['dependencies'] = list(info.get('dependencies', []))
+                for dep in result['dependencies']:
                     if not (self.enabled_dir / dep).exists():
-                        issues_found = True
-                        missing_deps.append(dep)
-                        print(f"  ОШИБКА: Зависимость '{dep}' отсутствует для пакета {package_name}")
-            
-            pip_deps_file = package_path / 'pip_dependencies'
-            missing_pip_deps = []
-            if pip_deps_file.exists():
-                with open(pip_deps_file) as f:
-                    for dep in f.read().splitlines():
-                        if dep.strip():
-                            try:
-                                __import__(dep.split('==')[0].split('>')[0].split('<')[0].strip())
-                            except ImportError:
-                                issues_found = True
-                                missing_pip_deps.append(dep)
-                                print(f"  ОШИБКА: Python-зависимость '{dep}' отсутствует для пакета {package_name}")
-            
-            bin_dir = package_path / 'bin'
-            if bin_dir.exists():
-                for script in bin_dir.iterdir():
-                    if not os.access(script, os.X_OK) and script.is_file():
-                        issues_found = True
-                        print(f"  ПРЕДУПРЕЖДЕНИЕ: Скрипт '{script.name}' не является исполняемым")
-                        if fix:
-                            os.chmod(script, 0o755)
-                            print(f"  ИСПРАВЛЕНО: Права доступа для '{script.name}' установлены на 755")
-            
-            if missing_deps or missing_pip_deps:
-                packages_to_fix.append({
-                    'name': package_name,
-                    'missing_deps': missing_deps,
-                    'missing_pip_deps': missing_pip_deps
-                })
+                        result['missing_deps'].append(dep)
+                        result['errors'].append(f"Зависимость '{dep}' отсутствует для пакета {package_name}")
+
+                pip_deps_file = package_path / 'pip_dependencies'
+                if pip_deps_file.exists():
+                    with open(pip_deps_file) as f:
+                        result['pip_dependencies'] = [dep for dep in f.read().splitlines() if dep.strip()]
+                        for dep in result['pip_dependencies']:
+                            if not _python_dep_installed(dep):
+                                result['missing_pip_deps'].append(dep)
+                                result['errors'].append(f"Python-зависимость '{dep}' отсутствует для пакета {package_name}")
+
+                bin_dir = package_path / 'bin'
+                if bin_dir.exists():
+                    for script in bin_dir.iterdir():
+                        if not os.access(script, os.X_OK) and script.is_file():
+                            result['not_executable'].append(str(script))
+                            result['warnings'].append(f"Скрипт '{script.name}' не является исполняемым")
+
+        if result['errors'] or result['warnings']:
+            result['status'] = 'error'
+        return result
+
+    def doctor(self, fix=False, as_json=False, full=False):
+        def say(msg=""):
+            if not as_json:
+                print(msg)
+
+        say("Запуск диагностики пакетов...")
+        with self.locks.shared():
+            enabled_packages = sorted(p.name for p in self.enabled_dir.glob('*') if p.is_dir())
+            state = {} if full else self._load_doctor_state()
+            signatures = {name: self._doctor_signature(name) for name in enabled_packages}
+
+            # Пакет без изменений пропускается, если его файлы те же по stat и все
+            # зависимости из прошлой проверки на месте (пакеты - в enabled/, Python-зависимости -
+            # по метаданным, без импорта): info.json разбирается только у измененных
+            def unchanged(name):
+                entry = state.get(name)
+                return (isinstance(entry, dict) and entry.get('signature') == signatures[name]
+                        and isinstance(entry.get('pip_dependencies'), list)
+                        and all((self.enabled_dir / dep).exists() for dep in entry.get('dependencies', []))
+                        and all(_python_dep_installed(dep) for dep in entry['pip_dependencies']))
+
+            to_check = [name for name in enabled_packages if not unchanged(name)]
+            results = {name: {'name': name, 'status': 'skipped', 'errors': [], 'warnings': [],
+                              'dependencies': state[name].get('dependencies', []),
+                              'pip_dependencies': state[name]['pip_dependencies']}
+                       for name in enabled_packages if name not in to_check}
+
+            if to_check:
+                with ThreadPoolExecutor(max_workers=min(8, len(to_check))) as pool:
+                    for result in pool.map(self._check_package, to_check):
+                        results[result['name']] = result
+
+            packages_to_fix = []
+            issues_found = False
+            for package_name in enabled_packages:
+                result = results[package_name]
+                if result['status'] == 'skipped':
+                    say(f"Проверка пакета: {package_name} (без изменений с последней проверки)")
+                    continue
+
+                say(f"Проверка пакета: {package_name}")
+                for error in result['errors']:
+                    say(f"  ОШИБКА: {error}")
+                for warning in result['warnings']:
+                    say(f"  ПРЕДУПРЕЖДЕНИЕ: {warning}")
+
+                if result['status'] != 'ok':
+                    issues_found = True
+                if fix:
+                    for script in result.get('not_executable', []):
+                        os.chmod(script, 0o755)
+                        say(f"  ИСПРАВЛЕНО: Права доступа для '{Path(script).name}' установлены на 755")
+                if result.get('missing_deps') or result.get('missing_pip_deps'):
+                    packages_to_fix.append(result)
+
+            clean = {name: {'signature': signatures[name], 'dependencies': results[name]['dependencies'],
+                            'pip_dependencies': results[name]['pip_dependencies']}
+                     for name in enabled_packages if results[name]['status'] in ('ok', 'skipped')}
+            if not self.read_only:
+                self._save_doctor_state(clean)
+
+        if as_json:
+            print(json.dumps({
+                'ok': not issues_found,
+                'checked': len(to_check),
+                'skipped': len(enabled_packages) - len(to_check),
+                'packages': results,
+            }, ensure_ascii=False, indent=2))
         
         if not issues_found:
-            print("Диагностика завершена. Проблем не обнаружено!")
+            say("Диагностика завершена. Проблем не обнаружено!")
             return True
         
         if fix and packages_to_fix:
-            print("\nИсправление проблем...")
-            for package_info in packages_to_fix:
-                package_name = package_info['name']
-                print(f"Исправление проблем пакета {package_name}...")
-                
-                for dep in package_info['missing_deps']:
-                    print(f"  Установка зависимости: {dep}")
-                    self.install(dep)
-                
-                for dep in package_info['missing_pip_deps']:
-                    print(f"  Установка Python-зависимости: {dep}")
-                    os.system(f"pip install {dep}")
-                
-                print(f"Исправление пакета {package_name} завершено")
+            say("\nИсправление проблем...")
+            # С --json в stdout только JSON-документ: вывод install() и pip уходит в stderr
+            with redirect_stdout(sys.stderr if as_json else sys.stdout):
+                for package_info in packages_to_fix:
+                    package_name = package_info['name']
+                    say(f"Исправление проблем пакета {package_name}...")
+
+                    for dep in package_info['missing_deps']:
+                        say(f"  Установка зависимости: {dep}")
+                        self.install(dep)
+
+                    for dep in package_info['missing_pip_deps']:
+                        say(f"  Установка Python-зависимости: {dep}")
+                        sys.stdout.flush()
+                        subprocess.run(['pip', 'install', dep], stdout=sys.stdout.fileno())
+
+                    say(f"Исправление пакета {package_name} завершено")
             
-            print("\nВсе проблемы исправлены!")
+            say("\nВсе проблемы исправлены!")
             return True
         elif fix:
-            print("\nНет проблем, требующих исправления.")
+            say("\nНет проблем, требующих исправления.")
             return True
         else:
-            print("\nДиагностика завершена с ошибками. Запустите 'packman doctor --fix' для исправления проблем.")
-            return False 
\ No newline at end of file
+            say("\nДиагностика завершена с ошибками. Запустите 'packman doctor --fix' для исправления проблем.")
+            return False
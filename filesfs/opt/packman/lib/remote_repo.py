@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+import os
+import json
+import shutil
+import hashlib
+import tarfile
+import threading
+import http.client
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 1024 * 256
+DEFAULT_WORKERS = 8
+DEFAULT_TIMEOUT = 30
+
+
+class RemoteRepoError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Пул keep-alive соединений: простаивающие соединения хранятся отдельно для каждого хоста"""
+
+    def __init__(self, maxsize: int = DEFAULT_WORKERS, timeout: float = DEFAULT_TIMEOUT):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, url: str) -> Tuple[str, str, int]:
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise RemoteRepoError(f"Unsupported URL scheme: {url}")
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        return parts.scheme, parts.hostname, port
+
+    def _connect(self, key) -> http.client.HTTPConnection:
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def release(self, key, conn, response) -> None:
+        if response is not None and response.will_close:
+            conn.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method: str, url: str, headers: Optional[Dict] = None):
+        """Отправляет запрос и возвращает (key, conn, response); ответ нужно дочитать и вернуть через release()"""
+        key = self._key(url)
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        conn, reused = self._acquire(key)
+        try:
+            conn.request(method, path, headers=headers or {})
+            return key, conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+            conn.close()
+            if not reused:
+                raise
+        # Сервер закрыл простаивающее соединение - повторяем на свежем
+        conn = self._connect(key)
+        conn.request(method, path, headers=headers or {})
+        return key, conn, conn.getresponse()
+
+    def close(self) -> None:
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+def _range_start(content_range: Optional[str]) -> Optional[int]:
+    """Начало куска из Content-Range ("bytes 1000-4095/4096"); None, если заголовок не разобрать"""
+    unit, _, spec = (content_range or '').strip().partition(' ')
+    start = spec.partition('-')[0]
+    return int(start) if unit == 'bytes' and start.isdigit() else None
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class RemoteRepo:
+    """HTTP-репозиторий пакетов: <url>/index.json и архивы пакетов рядом с ним"""
+
+    def __init__(self, name: str, url: str, cache_dir: Path, pool: ConnectionPool):
+        self.name = name
+        self.url = url.rstrip('/') + '/'
+        self.cache_dir = Path(cache_dir)
+        self.archives_dir = self.cache_dir / 'archives'
+        self.index_file = self.cache_dir / 'index.json'
+        self.meta_file = self.cache_dir / 'index.meta.json'
+        self.pool = pool
+        self._index = None
+
+    @property
+    def index(self) -> Dict:
+        if self._index is None:
+            if self.index_file.exists():
+                with open(self.index_file) as f:
+                    self._index = json.load(f)
+            else:
+                self.refresh_index()
+        return self._index
+
+    def refresh_index(self) -> bool:
+        """Обновляет index.json с учетом ETag/Last-Modified. Возвращает True, если индекс изменился"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        headers = {}
+        meta = {}
+        if self.index_file.exists() and self.meta_file.exists():
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        key, conn, resp = self.pool.request('GET', urljoin(self.url, 'index.json'), headers)
+        try:
+            body = resp.read()
+        finally:
+            self.pool.release(key, conn, resp)
+
+        if resp.status == 304:
+            if self._index is None:
+                with open(self.index_file) as f:
+                    self._index = json.load(f)
+            return False
+        if resp.status != 200:
+            raise RemoteRepoError(f"{self.name}: index.json: HTTP {resp.status}")
+
+        self._index = json.loads(body)
+        tmp = self.index_file.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_bytes(body)
+        os.replace(tmp, self.index_file)
+        with open(self.meta_file, 'w') as f:
+            json.dump({
+                'etag': resp.getheader('ETag'),
+                'last_modified': resp.getheader('Last-Modified'),
+            }, f)
+        return True
+
+    def packages(self) -> Dict:
+        return self.index.get('packages', {})
+
+    def package_info(self, package_name: str) -> Optional[Dict]:
+        return self.packages().get(package_name)
+
+    def _archive_name(self, package_name: str) -> str:
+        info = self.package_info(package_name) or {}
+        name = info.get('archive') or f"{package_name}.tar.gz"
+        # Имя приходит из удаленного индекса: это должно быть имя файла внутри кэша,
+        # а не путь вроде ../../bin/x или /etc/passwd
+        if not isinstance(name, str) or name in ('.', '..') or '\\' in name or Path(name).name != name:
+            raise RemoteRepoError(f"{self.name}: {package_name}: unsafe archive name {name!r}")
+        return name
+
+    def _is_cached(self, archive: Path, info: Dict) -> bool:
+        if not archive.exists():
+            return False
+        if 'size' in info and archive.stat().st_size != info['size']:
+            return False
+        if 'sha256' in info and _sha256(archive) != info['sha256']:
+            return False
+        return True
+
+    def fetch(self, package_name: str) -> Path:
+        """Скачивает архив пакета в кэш, докачивая частичную загрузку через Range"""
+        info = self.package_info(package_name)
+        if info is None:
+            raise RemoteRepoError(f"{self.name}: package {package_name} not found")
+
+        archive_name = self._archive_name(package_name)
+        archive = self.archives_dir / archive_name
+        if self._is_cached(archive, info):
+            return archive
+
+        self.archives_dir.mkdir(parents=True, exist_ok=True)
+        part = archive.with_name(archive.name + '.part')
+        part_meta = archive.with_name(archive.name + '.part.json')
+        headers = {}
+        offset = part.stat().st_size if part.exists() else 0
+        if offset and part_meta.exists():
+            with open(part_meta) as f:
+                validator = json.load(f)
+            headers['Range'] = f"bytes={offset}-"
+            if validator.get('etag') or validator.get('last_modified'):
+                headers['If-Range'] = validator.get('etag') or validator.get('last_modified')
+        else:
+            offset = 0
+
+        while True:
+            key, conn, resp = self.pool.request('GET', urljoin(self.url, archive_name), headers)
+            try:
+                if resp.status == 416 and offset and info.get('size') == offset:
+                    resp.read()
+                elif resp.status == 206 and _range_start(resp.getheader('Content-Range')) != offset:
+                    # Кусок не с того места: дописать его к .part нельзя, качаем заново целиком
+                    resp.read()
+                    if not headers:
+                        raise RemoteRepoError(f"{self.name}: {archive_name}: unexpected Content-Range")
+                    headers, offset = {}, 0
+                    continue
+                elif resp.status in (200, 206):
+                    mode = 'ab' if resp.status == 206 else 'wb'
+                    with open(part_meta, 'w') as f:
+                        json.dump({
+                            'etag': resp.getheader('ETag'),
+                            'last_modified': resp.getheader('Last-Modified'),
+                        }, f)
+                    with open(part, mode) as f:
+                        while True:
+                            chunk = resp.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                else:
+                    resp.read()
+                    raise RemoteRepoError(f"{self.name}: {archive_name}: HTTP {resp.status}")
+            finally:
+                self.pool.release(key, conn, resp)
+            break
+
+        size = part.stat().st_size
+        if 'size' in info and size < info['size']:
+            # Недокачанный .part остается: следующий fetch продолжит его через Range
+            raise RemoteRepoError(f"{self.name}: {archive_name}: incomplete download ({size} of {info['size']} bytes)")
+        problem = None
+        if 'size' in info and size != info['size']:
+            problem = f"size mismatch ({size} != {info['size']} bytes)"
+        elif 'sha256' in info and _sha256(part) != info['sha256']:
+            problem = "checksum mismatch"
+        if problem:
+            part.unlink()
+            part_meta.unlink(missing_ok=True)
+            raise RemoteRepoError(f"{self.name}: {archive_name}: {problem}")
+
+        os.replace(part, archive)
+        part_meta.unlink(missing_ok=True)
+        return archive
+
+
+def fetch_many(jobs: List[Tuple[RemoteRepo, str]], max_workers: int = DEFAULT_WORKERS) -> Dict[str, Path]:
+    """Параллельно скачивает архивы [(repo, package_name), ...]; возвращает {package_name: archive}"""
+    if not jobs:
+        return {}
+    results = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as pool:
+        futures = {pool.submit(repo.fetch, name): name for repo, name in jobs}
+        for future, name in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+    if errors:
+        raise RemoteRepoError("; ".join(errors))
+    return results
+
+
+def extract_archive(archive: Path, dest: Path) -> None:
+    """Распаковывает архив пакета в dest (содержимое может лежать в каталоге <name>/ или в корне)"""
+    tmp = dest.with_name(dest.name + '.extract')
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+    with tarfile.open(archive) as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(tmp, filter='data')
+        else:
+            for member in tar.getmembers():
+                if member.name.startswith('/') or '..' in Path(member.name).parts:
+                    raise RemoteRepoError(f"{archive.name}: unsafe path {member.name}")
+            tar.extractall(tmp)
+
+    entries = list(tmp.iterdir())
+    src = entries[0] if len(entries) == 1 and entries[0].is_dir() else tmp
+    if dest.exists():
+        shutil.rmtree(dest)
+    os.replace(src, dest)
+    if tmp.exists():
+        shutil.rmtree(tmp)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import os
+import json
+import shutil
+from pathlib import Path
+from typing import Dict, List
+
+
+class Transaction:
+    """Журнал файловых операций packman.
+
+    Удаляемые и перезаписываемые каталоги не удаляются сразу, а переносятся
+    в staging-каталог; до commit() любую последовательность операций можно
+    откатить, в том числе после падения процесса (см. recover()).
+    """
+
+    def __init__(self, journal_file: Path, staging_dir: Path):
+        self.journal_file = Path(journal_file)
+        self.staging_dir = Path(staging_dir)
+        self.ops: List[Dict] = []
+
+    def begin(self) -> None:
+        if self.staging_dir.exists():
+            shutil.rmtree(self.staging_dir)
+        self.staging_dir.mkdir(parents=True)
+        self._write()
+
+    def _write(self, committed: bool = False) -> None:
+        tmp = self.journal_file.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'staging': str(self.staging_dir), 'ops': self.ops, 'committed': committed}, f)
+        os.replace(tmp, self.journal_file)
+
+    def _log(self, *ops: Dict) -> None:
+        self.ops.extend(ops)
+        self._write()
+
+    def remove(self, path: Path) -> None:
+        self.remove_many([path])
+
+    def remove_many(self, paths: List[Path]) -> None:
+        """Переносит пути в staging одной записью журнала"""
+        ops = []
+        for path in map(Path, paths):
+            if path.exists() or path.is_symlink():
+                stash = self.staging_dir / str(len(self.ops) + len(ops))
+                ops.append({'op': 'stash', 'path': str(path), 'stash': str(stash)})
+        if not ops:
+            return
+        self._log(*ops)
+        for op in ops:
+            os.replace(op['path'], op['stash'])
+
+    def write_file(self, path: Path, data: bytes) -> None:
+        path = Path(path)
+        self.remove(path)
+        self._log({'op': 'create', 'path': str(path)})
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    def copytree(self, src: Path, dst: Path) -> None:
+        self.remove(dst)
+        self._log({'op': 'create', 'path': str(dst)})
+        shutil.copytree(src, dst)
+
+    def move(self, src: Path, dst: Path) -> None:
+        self.remove(dst)
+        self._log({'op': 'move', 'src': str(src), 'dst': str(dst)})
+        shutil.move(str(src), str(dst))
+
+    def rollback(self) -> None:
+        for op in reversed(self.ops):
+            if op['op'] == 'create':
+                _rmtree(Path(op['path']))
+            elif op['op'] == 'move':
+                src, dst = Path(op['src']), Path(op['dst'])
+                if dst.exists() and not src.exists():
+                    shutil.move(str(dst), str(src))
+            elif op['op'] == 'stash':
+                path, stash = Path(op['path']), Path(op['stash'])
+                if stash.exists() or stash.is_symlink():
+                    _rmtree(path)
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(stash, path)
+        self._finish()
+
+    def commit(self) -> None:
+        # Точка фиксации - отметка в журнале, а не его удаление: если процесс упадет,
+        # пока удаляется staging, recover() только доубирает, а не откатывает
+        self._write(committed=True)
+        self._finish()
+
+    def _finish(self) -> None:
+        self.ops = []
+        if self.staging_dir.exists():
+            shutil.rmtree(self.staging_dir)
+        self.journal_file.unlink(missing_ok=True)
+
+    @classmethod
+    def recover(cls, journal_file: Path) -> bool:
+        """Откатывает транзакцию, прерванную падением процесса; возвращает True, если было что откатывать.
+        Зафиксированная транзакция, упавшая при уборке staging, не откатывается"""
+        journal_file = Path(journal_file)
+        try:
+            with open(journal_file) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            data = {'staging': str(journal_file.parent / '.txn'), 'ops': []}
+        txn = cls(journal_file, Path(data['staging']))
+        if data.get('committed'):
+            txn._finish()
+            return False
+        txn.ops = data.get('ops', [])
+        txn.rollback()
+        return True
+
+
+def _rmtree(path: Path) -> None:
+    if path.is_symlink() or path.is_file():
+        path.unlink()
+    elif path.exists():
+        shutil.rmtree(path)
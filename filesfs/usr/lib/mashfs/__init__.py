@@ -0,0 +1 @@
+"""Общие модули MashFS для chrootmash.py и утилит из bin/ (каталог usr/lib добавляется в sys.path)"""
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+import os
+import copy
+import marshal
+from pathlib import Path
+from dataclasses import MISSING, dataclass, field, fields
+from typing import Any, Dict, List, Optional, Tuple, Union, get_args, get_origin
+
+
+def _yaml():
+    # PyYAML импортируется при первом промахе кэша: с теплым кэшем конфиг без него
+    import yaml
+    return yaml
+
+
+def _yaml_loader():
+    yaml = _yaml()
+    # Сишный загрузчик PyYAML в разы быстрее чисто питоновского
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+CACHE_MAGIC = b'MASHCFG1'
+CACHE_MARSHAL = b'M'
+CACHE_PICKLE = b'P'
+
+# Файлы, из которых собирается общая конфигурация (пути от корня)
+SYSTEM_CONFIG = 'etc/config.yml'
+LORE_CONFIG = 'etc/lore/config.yml'
+PACKMAN_CONFIGS = ('etc/packman/config.yml', 'opt/packman/config.yml')
+
+
+@dataclass
+class SystemConfig:
+    name: str = 'MashFS'
+    version: str = ''
+    description: str = ''
+    hostname: str = 'hardmash'
+    motd: str = ''
+    theme: str = 'cyberpunk'
+
+
+@dataclass
+class ShellConfig:
+    prompt_style: str = 'modern'
+    history_size: int = 1000
+    tab_completion: bool = True
+    prompt: Optional[str] = None
+
+
+@dataclass
+class TerminalConfig:
+    colors: bool = True
+    animated_progress: bool = True
+
+
+@dataclass
+class SecurityConfig:
+    password_auth: bool = True
+    sudo_timeout: int = 300
+
+
+@dataclass
+class UsersConfig:
+    enable_root: bool = True
+    default_user: str = 'mash'
+    accounts: Dict[str, Dict] = field(default_factory=dict)
+    groups: Dict[str, Dict] = field(default_factory=dict)
+
+
+@dataclass
+class PackagesConfig:
+    enabled: List[str] = field(default_factory=list)
+    repositories: List[Dict] = field(default_factory=list)
+
+
+@dataclass
+class BackupsConfig:
+    keep_last: int = 5
+    keep_daily: int = 7
+    keep_weekly: int = 4
+    compression: Optional[str] = None
+
+
+@dataclass
+class TrashConfig:
+    # Политика фоновой очистки корзины rm -r; 0 - без ограничения
+    max_age_days: int = 30
+    max_size_mb: int = 1024
+
+
+@dataclass
+class Config:
+    """Проверенное представление etc/config.yml + etc/lore/config.yml + конфигов packman"""
+    system: SystemConfig = field(default_factory=SystemConfig)
+    shell: ShellConfig = field(default_factory=ShellConfig)
+    terminal: TerminalConfig = field(default_factory=TerminalConfig)
+    security: SecurityConfig = field(default_factory=SecurityConfig)
+    users: UsersConfig = field(default_factory=UsersConfig)
+    packages: PackagesConfig = field(default_factory=PackagesConfig)
+    backups: BackupsConfig = field(default_factory=BackupsConfig)
+    trash: TrashConfig = field(default_factory=TrashConfig)
+    packman: Dict[str, Any] = field(default_factory=dict)
+    themes: Dict[str, Dict] = field(default_factory=dict)
+    warnings: List[str] = field(default_factory=list)
+
+
+class _YamlCache:
+    """Разобранные YAML-файлы с ключом (mtime_ns, size).
+
+    Хранится в var/cache/mashfs/config.cache: marshal, если данные
+    из простых типов, иначе pickle (например, YAML-даты). Внутри процесса
+    кэш держится в памяти, поэтому повторные вызовы стоят один stat().
+    Без cache_file (хранилище не на диске) кэш только в памяти.
+    """
+
+    def __init__(self, cache_file: Optional[Path]):
+        self.cache_file = cache_file
+        self.entries: Optional[Dict[str, Tuple[int, int, Any]]] = None
+        self.dirty = False
+
+    def _read(self) -> Dict:
+        if self.cache_file is None:
+            return {}
+        try:
+            with open(self.cache_file, 'rb') as f:
+                blob = f.read()
+        except OSError:
+            return {}
+        if not blob.startswith(CACHE_MAGIC):
+            return {}
+        kind, payload = blob[len(CACHE_MAGIC):len(CACHE_MAGIC) + 1], blob[len(CACHE_MAGIC) + 1:]
+        try:
+            if kind == CACHE_MARSHAL:
+                return marshal.loads(payload)
+            if kind == CACHE_PICKLE:
+                import pickle
+                return pickle.loads(payload)
+        except Exception:
+            pass
+        return {}
+
+    def get(self, path, storage=None) -> Any:
+        """path - путь на диске или, если задано storage, путь от корня хранилища"""
+        if self.entries is None:
+            self.entries = self._read()
+        key = str(path)
+        try:
+            st = storage.stat(path) if storage is not None else os.stat(path)
+        except OSError:
+            if self.entries.pop(key, None) is not None:
+                self.dirty = True
+            return None
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = self.entries.get(key)
+        if cached is not None and (cached[0], cached[1]) == stamp:
+            return cached[2]
+        with (storage.open(path) if storage is not None else open(path)) as f:
+            data = _yaml().load(f, Loader=_yaml_loader())
+        self.entries[key] = (stamp[0], stamp[1], data)
+        self.dirty = True
+        return data
+
+    def save(self) -> None:
+        if not self.dirty or self.cache_file is None:
+            self.dirty = False
+            return
+        try:
+            payload = CACHE_MARSHAL + marshal.dumps(self.entries)
+        except ValueError:
+            import pickle
+            payload = CACHE_PICKLE + pickle.dumps(self.entries, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_file.with_suffix(f'.{os.getpid()}.tmp')
+            tmp.write_bytes(CACHE_MAGIC + payload)
+            os.replace(tmp, self.cache_file)
+        except OSError:
+            # Кэш - только ускорение; корень может быть только для чтения
+            return
+        self.dirty = False
+
+
+# Ключ - каталог кэша на диске, для хранилищ не на диске - само хранилище
+_caches: Dict[Any, _YamlCache] = {}
+
+
+def _root_of(root: Optional[Path]) -> Path:
+    return Path(root if root is not None else os.environ.get('MASHFS_ROOT', 'filesfs')).absolute()
+
+
+def _cache(root: Path, storage=None) -> _YamlCache:
+    cache_dir = storage.cache_dir() if storage is not None else root / 'var' / 'cache' / 'mashfs'
+    key = str(cache_dir) if cache_dir is not None else storage
+    cache = _caches.get(key)
+    if cache is None:
+        cache = _caches[key] = _YamlCache(cache_dir / 'config.cache' if cache_dir is not None else None)
+    return cache
+
+
+def load_yaml(path: Path, root: Optional[Path] = None, storage=None) -> Any:
+    """YAML-файл через общий кэш; None, если файла нет. Ошибки разбора - yaml.YAMLError.
+
+    storage - хранилище сессии: кэш ведется там, где его держит storage.cache_dir(),
+    а относительный path читается через него. Возвращается копия: вызывающий
+    может менять данные, не портя кэш.
+    """
+    cache = _cache(_root_of(root), storage)
+    try:
+        if storage is not None and not Path(path).is_absolute():
+            return copy.deepcopy(cache.get(str(path), storage))
+        return copy.deepcopy(cache.get(Path(path).absolute()))
+    finally:
+        cache.save()
+
+
+def _section(data: Any, name: str) -> Dict:
+    value = data.get(name) if isinstance(data, dict) else None
+    return value if isinstance(value, dict) else {}
+
+
+def _coerce(value: Any, kind: type, default: Any, where: str, warnings: List[str]) -> Any:
+    if value is None:
+        return default
+    if kind is bool:
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in ('true', 'yes', 'on', '1'):
+            return True
+        if str(value).lower() in ('false', 'no', 'off', '0'):
+            return False
+    elif kind is int:
+        if not isinstance(value, bool):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                pass
+    elif kind is str:
+        if not isinstance(value, (dict, list)):
+            return str(value)
+    elif isinstance(value, kind):
+        return value
+    warnings.append(f"{where}: ожидалось {kind.__name__}, получено {value!r}; используется {default!r}")
+    return default
+
+
+def _field_kind(tp: Any) -> type:
+    # Optional[str] -> str, Dict[str, Dict] -> dict, List[str] -> list
+    origin = get_origin(tp)
+    if origin is Union:
+        return _field_kind(next(arg for arg in get_args(tp) if arg is not type(None)))
+    return origin or tp
+
+
+def _build(cls, raw: Dict, where: str, warnings: List[str]):
+    """Датакласс из секции YAML: известные поля приводятся к типу, неизвестные игнорируются"""
+    values = {}
+    for f in fields(cls):
+        if f.name not in raw:
+            continue
+        default = f.default if f.default is not MISSING else f.default_factory()
+        values[f.name] = _coerce(raw[f.name], _field_kind(f.type), default, f"{where}.{f.name}", warnings)
+    return cls(**values)
+
+
+def load_config(root: Optional[Path] = None, storage=None) -> Config:
+    """Собирает конфигурацию корня из всех файлов; YAML разбирается только при изменении файлов.
+
+    storage - хранилище сессии (mashfs.storage): файлы читаются через него
+    (в overlay - из того слоя, где лежат; в памяти - из самой сессии).
+    """
+    root = _root_of(root)
+    cache = _cache(root, storage)
+    warnings: List[str] = []
+    raw: Dict[str, Any] = {}
+    for rel in (SYSTEM_CONFIG, LORE_CONFIG) + PACKMAN_CONFIGS:
+        try:
+            raw[rel] = (cache.get(rel, storage) if storage is not None else cache.get(root / rel)) or {}
+        except (OSError, _yaml().YAMLError) as e:
+            warnings.append(f"{rel}: {e}")
+            raw[rel] = {}
+    cache.save()
+
+    system_cfg, lore = raw[SYSTEM_CONFIG], raw[LORE_CONFIG]
+    if not isinstance(system_cfg, dict):
+        warnings.append(f"{SYSTEM_CONFIG}: ожидался словарь")
+        system_cfg = {}
+    if not isinstance(lore, dict):
+        warnings.append(f"{LORE_CONFIG}: ожидался словарь")
+        lore = {}
+
+    # etc/lore/config.yml уточняет etc/config.yml
+    # В etc/config.yml секция исторически называется System
+    system_raw = dict(_section(system_cfg, 'system') or _section(system_cfg, 'System'), **_section(lore, 'system'))
+    shell_raw = dict(_section(system_cfg, 'shell'))
+    if _section(lore, 'system').get('shell_prompt') is not None:
+        shell_raw['prompt'] = _section(lore, 'system')['shell_prompt']
+    users_raw = dict(_section(system_cfg, 'users'))
+    users_raw['accounts'] = copy.deepcopy(_section(lore, 'users'))
+    users_raw['groups'] = copy.deepcopy(_section(lore, 'groups'))
+    packages_raw = dict(_section(system_cfg, 'packages'))
+    if 'enabled' in _section(lore, 'packages'):
+        packages_raw['enabled'] = _section(lore, 'packages')['enabled']
+
+    packman: Dict[str, Any] = {}
+    for rel in PACKMAN_CONFIGS:
+        if isinstance(raw[rel], dict):
+            packman.update(copy.deepcopy(raw[rel]))
+
+    config = Config(
+        system=_build(SystemConfig, system_raw, 'system', warnings),
+        shell=_build(ShellConfig, shell_raw, 'shell', warnings),
+        terminal=_build(TerminalConfig, _section(system_cfg, 'terminal'), 'terminal', warnings),
+        security=_build(SecurityConfig, _section(system_cfg, 'security'), 'security', warnings),
+        users=_build(UsersConfig, users_raw, 'users', warnings),
+        packages=_build(PackagesConfig, packages_raw, 'packages', warnings),
+        backups=_build(BackupsConfig, _section(system_cfg, 'backups'), 'backups', warnings),
+        trash=_build(TrashConfig, _section(system_cfg, 'trash'), 'trash', warnings),
+        packman=packman,
+        themes=copy.deepcopy(_section(lore, 'themes')),
+        warnings=warnings,
+    )
+    config.packages.enabled = [str(name) for name in config.packages.enabled]
+    return config
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import re
+import fnmatch
+import functools
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from mashfs.storage import Storage, vfs_path
+
+# Раскрытие слов командной строки в духе POSIX sh:
+# кавычки и экранирование, ~, $VAR и ${VAR}, шаблоны * ? [..] по корню MashFS.
+# Результат подстановки переменной на слова не делится (как в zsh):
+# "rm $F" удаляет ровно один файл, даже если в имени есть пробелы.
+
+GLOB_CHARS = '*?['
+LISTING_CACHE_SIZE = 64
+VAR_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+class ExpansionError(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(pattern: str):
+    """Скомпилированный шаблон одного компонента пути; одинаковые шаблоны компилируются один раз"""
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+def _escape_glob(ch: str) -> str:
+    return f"[{ch}]" if ch in GLOB_CHARS else ch
+
+
+class _Word:
+    """Слово в процессе разбора: буквальный текст и шаблон с экранированными кавычками символами"""
+
+    __slots__ = ('text', 'pattern', 'glob', 'quoted')
+
+    def __init__(self):
+        self.text: List[str] = []
+        self.pattern: List[str] = []
+        self.glob = False
+        # Были ли в слове кавычки: "" - пустой аргумент, а пустой $UNSET - ничего
+        self.quoted = False
+
+    def add(self, chars: str, quoted: bool) -> None:
+        self.text.append(chars)
+        if quoted:
+            self.pattern.append(''.join(_escape_glob(ch) for ch in chars))
+        else:
+            self.pattern.append(chars)
+            self.glob = self.glob or any(ch in GLOB_CHARS for ch in chars)
+
+    def started(self) -> bool:
+        return self.quoted or bool(self.text)
+
+
+def split_words(line: str, env: Dict[str, str], home: Callable[[str], Optional[str]]) -> List[Tuple[str, Optional[str]]]:
+    """Разбивает строку на слова: [(текст, шаблон или None)]; шаблон есть, только если в слове
+    есть незакавыченные * ? [. home(user) отдает домашний каталог для ~user."""
+    words: List[Tuple[str, Optional[str]]] = []
+    word = _Word()
+    i, n = 0, len(line)
+
+    def finish():
+        nonlocal word
+        if word.started():
+            text = ''.join(word.text)
+            words.append((text, ''.join(word.pattern) if word.glob else None))
+        word = _Word()
+
+    def variable(start: int) -> Tuple[str, int]:
+        """Значение $VAR/${VAR} с позиции после '$'; (значение, новая позиция)"""
+        if start < n and line[start] == '{':
+            end = line.find('}', start)
+            if end == -1:
+                raise ExpansionError("незакрытая ${")
+            name = line[start + 1:end]
+            if not VAR_NAME.fullmatch(name):
+                raise ExpansionError(f"${{{name}}}: неверная подстановка")
+            return env.get(name, ''), end + 1
+        match = VAR_NAME.match(line, start)
+        if match is None:
+            return '$', start
+        return env.get(match.group()), match.end()
+
+    while i < n:
+        ch = line[i]
+        if ch in ' \t\n':
+            finish()
+            i += 1
+        elif ch == '\\':
+            if i + 1 < n:
+                word.add(line[i + 1], quoted=True)
+            i += 2
+        elif ch == "'":
+            end = line.find("'", i + 1)
+            if end == -1:
+                raise ExpansionError("незакрытая кавычка '")
+            word.quoted = True
+            word.add(line[i + 1:end], quoted=True)
+            i = end + 1
+        elif ch == '"':
+            word.quoted = True
+            i += 1
+            while True:
+                if i >= n:
+                    raise ExpansionError('незакрытая кавычка "')
+                ch = line[i]
+                if ch == '"':
+                    i += 1
+                    break
+                if ch == '\\' and i + 1 < n and line[i + 1] in '"\\$`':
+                    word.add(line[i + 1], quoted=True)
+                    i += 2
+                elif ch == '$':
+                    value, i = variable(i + 1)
+                    word.add(value or '', quoted=True)
+                else:
+                    word.add(ch, quoted=True)
+                    i += 1
+        elif ch == '$':
+            value, i = variable(i + 1)
+            if value:
+                word.add(value, quoted=False)
+        elif ch == '~' and not word.started():
+            end = i + 1
+            while end < n and line[end] not in ' \t\n/':
+                end += 1
+            user = line[i + 1:end]
+            directory = home(user) if VAR_NAME.fullmatch(user or 'x') else None
+            if directory is None:
+                word.add(line[i:end], quoted=False)
+            else:
+                word.add(directory, quoted=True)
+            i = end
+        else:
+            word.add(ch, quoted=False)
+            i += 1
+    finish()
+    return words
+
+
+class GlobMatcher:
+    """Раскрытие шаблонов по хранилищу корня.
+
+    Списки каталогов кэшируются по (mtime, inode) каталога, так что rm *.tmp
+    в большом каталоге стоит один listdir, а повторные шаблоны в том же
+    каталоге - один stat.
+    """
+
+    def __init__(self, fs: Storage):
+        self.fs = fs
+        self.listings: 'OrderedDict[str, Tuple[Tuple[int, int], List[str]]]' = OrderedDict()
+
+    def listdir(self, rel_dir: str) -> List[str]:
+        try:
+            st = self.fs.stat(rel_dir)
+        except OSError:
+            return []
+        stamp = (st.st_mtime_ns, st.st_ino)
+        cached = self.listings.get(rel_dir)
+        if cached is not None and cached[0] == stamp:
+            self.listings.move_to_end(rel_dir)
+            return cached[1]
+        try:
+            names = sorted(self.fs.listdir(rel_dir))
+        except OSError:
+            return []
+        self.listings[rel_dir] = (stamp, names)
+        if len(self.listings) > LISTING_CACHE_SIZE:
+            self.listings.popitem(last=False)
+        return names
+
+    def expand(self, pattern: str, cwd: str) -> List[str]:
+        """Пути, подходящие под шаблон, в том виде, в каком их набрал пользователь"""
+        absolute = pattern.startswith('/')
+        components = [c for c in pattern.split('/') if c]
+        # (путь для вывода, путь от корня)
+        matches = [('/' if absolute else '', '' if absolute else vfs_path(cwd))]
+        for index, component in enumerate(components):
+            last = index == len(components) - 1
+            found = []
+            if not any(ch in GLOB_CHARS for ch in component):
+                for shown, rel in matches:
+                    path = vfs_path(f"{rel}/{component}")
+                    if (self.fs.exists(path) or self.fs.is_symlink(path)) if last else self.fs.is_dir(path):
+                        found.append((shown + component, path))
+            else:
+                match = compile_pattern(component)
+                hidden = component.startswith('.')
+                for shown, rel in matches:
+                    for name in self.listdir(rel):
+                        if (hidden or not name.startswith('.')) and match(name):
+                            path = vfs_path(f"{rel}/{name}")
+                            if last or self.fs.is_dir(path):
+                                found.append((shown + name, path))
+            if not last:
+                found = [(shown + '/', path) for shown, path in found]
+            matches = found
+            if not matches:
+                return []
+        if pattern.endswith('/'):
+            matches = [(shown if shown.endswith('/') else shown + '/', path)
+                       for shown, path in matches if self.fs.is_dir(path)]
+        return [shown for shown, _ in matches]
+
+
+def expand_words(line: str, env: Dict[str, str], cwd: str, globber: GlobMatcher,
+                 home: Callable[[str], Optional[str]]) -> List[str]:
+    """Строка команды -> список аргументов; шаблон без совпадений остается как есть"""
+    args: List[str] = []
+    for text, pattern in split_words(line, env, home):
+        if pattern is None:
+            args.append(text)
+            continue
+        args.extend(globber.expand(pattern, cwd) or [text])
+    return args
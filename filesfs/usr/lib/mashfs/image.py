@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+import io
+import os
+import lzma
+import mmap
+import stat
+import zlib
+import errno
+import struct
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from mashfs.storage import Storage, StatResult, SYMLINK_DEPTH, vfs_parts, _error
+
+# Образ корня MashFS одним файлом (в духе squashfs):
+#
+#   заголовок | данные файлов | таблица записей | таблица строк
+#
+# Записи лежат в порядке обхода в ширину: дети каждого каталога идут
+# подряд и отсортированы по имени, поэтому поиск - бинарный поиск
+# по каждому компоненту пути, а listdir - один диапазон записей.
+# Несжатые файлы отдаются срезами mmap без копирования; сжатые хранятся
+# блоками по block_size и распаковываются поблочно.
+
+IMAGE_MAGIC = b'MASHIMG1'
+IMAGE_VERSION = 1
+IMAGE_SUFFIX = '.mashimg'
+DEFAULT_BLOCK_SIZE = 128 * 1024
+
+# magic, версия, сжатие, размер блока, число записей, смещения таблиц записей и строк, размер строк
+HEADER = struct.Struct('<8sIIIIQQQ')
+# имя (смещение, длина), mode, флаги, mtime_ns, size, data
+# data: файл - смещение данных (или таблицы блоков), каталог - индекс первого ребенка,
+# симлинк - смещение цели в таблице строк (длина цели - size)
+ENTRY = struct.Struct('<IIIIqQQ')
+BLOCK_OFFSET = struct.Struct('<Q')
+
+FLAG_COMPRESSED = 1
+
+COMPRESSION_NONE = 0
+COMPRESSORS = {
+    'zlib': (1, lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (2, lzma.compress, lzma.decompress),
+}
+DECOMPRESSORS = {code: decompress for code, _, decompress in COMPRESSORS.values()}
+
+# Не попадают в образ: кэши пересоздаются на месте, корзина rm -r у каждого корня своя
+EXCLUDED = {'var/cache', 'var/trash'}
+
+
+class ImageError(Exception):
+    pass
+
+
+def is_image(path: Path) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(IMAGE_MAGIC)) == IMAGE_MAGIC
+    except OSError:
+        return False
+
+
+class _Packer:
+    def __init__(self, out, compression: Optional[str], block_size: int):
+        self.out = out
+        self.compression = compression
+        self.block_size = block_size
+        self.strings = bytearray()
+        self.seen: Dict[bytes, Tuple[int, int, int]] = {}
+        self.stats = {'files': 0, 'dirs': 0, 'symlinks': 0, 'bytes_total': 0, 'bytes_stored': 0}
+
+    def string(self, data: bytes) -> int:
+        offset = len(self.strings)
+        self.strings += data
+        return offset
+
+    def file(self, path: str) -> Tuple[int, int]:
+        """Пишет содержимое файла; (флаги, смещение). Одинаковые файлы хранятся один раз"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.stats['files'] += 1
+        self.stats['bytes_total'] += len(data)
+        digest = hashlib.sha256(data).digest()
+        if digest in self.seen:
+            return self.seen[digest][:2]
+
+        flags, payload = 0, data
+        if self.compression and data:
+            compress = COMPRESSORS[self.compression][1]
+            blocks = [compress(data[i:i + self.block_size]) for i in range(0, len(data), self.block_size)]
+            table_size = BLOCK_OFFSET.size * (len(blocks) + 1)
+            if table_size + sum(map(len, blocks)) < len(data):
+                # Таблица блоков: абсолютные смещения начала каждого блока и конца последнего
+                start = self.out.tell() + table_size
+                offsets = [start]
+                for block in blocks:
+                    offsets.append(offsets[-1] + len(block))
+                payload = b''.join(BLOCK_OFFSET.pack(o) for o in offsets) + b''.join(blocks)
+                flags = FLAG_COMPRESSED
+
+        offset = self.out.tell()
+        self.out.write(payload)
+        self.stats['bytes_stored'] += len(payload)
+        self.seen[digest] = (flags, offset, len(payload))
+        return flags, offset
+
+
+def pack_image(source: Path, dest: Path, compression: Optional[str] = None,
+               block_size: int = DEFAULT_BLOCK_SIZE) -> Dict:
+    """Упаковывает каталог source в образ dest; возвращает статистику.
+
+    Файл появляется под своим именем только после успешной записи.
+    """
+    source, dest = Path(source).absolute(), Path(dest).absolute()
+    if compression not in (None, 'none') and compression not in COMPRESSORS:
+        raise ImageError(f"Неизвестное сжатие: {compression} (доступны: none, {', '.join(COMPRESSORS)})")
+    compression = None if compression == 'none' else compression
+    if block_size <= 0:
+        raise ImageError("Размер блока должен быть положительным")
+
+    tmp = dest.with_name(f".{dest.name}.{os.getpid()}.partial")
+    # Образ можно писать и внутрь упаковываемого корня - себя он не содержит
+    own_files = {str(tmp), str(dest)}
+    try:
+        with open(tmp, 'wb') as out:
+            out.write(b'\0' * HEADER.size)
+            packer = _Packer(out, compression, block_size)
+            st = os.stat(source)
+            entries = [[packer.string(b''), 0, st.st_mode, 0, st.st_mtime_ns, 0, 0]]
+            queue = [('', str(source), 0)]
+            while queue:
+                next_queue = []
+                for rel_dir, host_dir, index in queue:
+                    with os.scandir(host_dir) as it:
+                        children = sorted(
+                            (entry for entry in it
+                             if entry.name != '__pycache__' and entry.path not in own_files
+                             and (f"{rel_dir}/{entry.name}" if rel_dir else entry.name) not in EXCLUDED),
+                            key=lambda entry: os.fsencode(entry.name))
+                    first = len(entries)
+                    for entry in children:
+                        name = os.fsencode(entry.name)
+                        rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                        st = entry.stat(follow_symlinks=False)
+                        record = [packer.string(name), len(name), st.st_mode, 0, st.st_mtime_ns, 0, 0]
+                        if entry.is_symlink():
+                            target = os.fsencode(os.readlink(entry.path))
+                            record[5], record[6] = len(target), packer.string(target)
+                            packer.stats['symlinks'] += 1
+                        elif entry.is_dir():
+                            next_queue.append((rel, entry.path, len(entries)))
+                            packer.stats['dirs'] += 1
+                        elif entry.is_file():
+                            record[5] = st.st_size
+                            record[3], record[6] = packer.file(entry.path)
+                        else:
+                            # Сокеты и устройства в образ не попадают
+                            continue
+                        entries.append(record)
+                    entries[index][5] = len(entries) - first
+                    entries[index][6] = first
+                queue = next_queue
+
+            index_offset = out.tell()
+            for record in entries:
+                out.write(ENTRY.pack(*record))
+            strings_offset = out.tell()
+            out.write(packer.strings)
+            code = COMPRESSORS[compression][0] if compression else COMPRESSION_NONE
+            out.seek(0)
+            out.write(HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, code, block_size, len(entries),
+                                  index_offset, strings_offset, len(packer.strings)))
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    stats = dict(packer.stats, entries=len(entries), compression=compression or 'none',
+                 image_size=dest.stat().st_size)
+    return stats
+
+
+class _ImageFile(io.RawIOBase):
+    """Файл образа на чтение: несжатые данные копируются прямо из mmap в буфер читателя"""
+
+    def __init__(self, image: 'ImageStorage', index: int):
+        super().__init__()
+        self.image = image
+        self.index = index
+        self.size = image._entry(index)[5]
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence]
+        self.pos = max(0, base + offset)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def readinto(self, buffer) -> int:
+        if self.pos >= self.size:
+            return 0
+        data = self.image._slice(self.index, self.pos, len(buffer))
+        n = len(data)
+        memoryview(buffer).cast('B')[:n] = data
+        self.pos += n
+        return n
+
+
+class ImageStorage(Storage):
+    """Образ MashFS (mashsys pack), открытый через mmap только на чтение.
+
+    Ничего не читается заранее: запись каталога и имена берутся из mmap
+    при обращении, поэтому открытие образа почти бесплатно, а страницы
+    файла делят между собой все шеллы, открывшие тот же образ.
+    """
+
+    name = 'image'
+    read_only = True
+
+    def __init__(self, path: Path):
+        self.path = Path(path).absolute()
+        with open(self.path, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ImageError(f"{self.path}: пустой файл")
+        self.view = memoryview(self._mmap)
+        if len(self.view) < HEADER.size:
+            raise ImageError(f"{self.path}: не образ MashFS")
+        (magic, version, self.compression, self.block_size, self.count,
+         self.index_offset, self.strings_offset, strings_size) = HEADER.unpack_from(self.view)
+        if magic != IMAGE_MAGIC:
+            raise ImageError(f"{self.path}: не образ MashFS")
+        if version != IMAGE_VERSION:
+            raise ImageError(f"{self.path}: неподдерживаемая версия образа {version}")
+        if self.compression != COMPRESSION_NONE and self.compression not in DECOMPRESSORS:
+            raise ImageError(f"{self.path}: неизвестное сжатие {self.compression}")
+        if self.strings_offset + strings_size > len(self.view):
+            raise ImageError(f"{self.path}: образ обрезан")
+        self._paths: Dict[str, int] = {'': 0}
+        self._block: Tuple[int, int, bytes] = (-1, -1, b'')
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        self.view.release()
+        self._mmap.close()
+
+    # --- записи ---
+
+    def _entry(self, index: int) -> Tuple[int, int, int, int, int, int, int]:
+        return ENTRY.unpack_from(self.view, self.index_offset + index * ENTRY.size)
+
+    def _name(self, entry) -> bytes:
+        start = self.strings_offset + entry[0]
+        return self.view[start:start + entry[1]].tobytes()
+
+    def _child(self, index: int, name: bytes) -> Optional[int]:
+        entry = self._entry(index)
+        lo, hi = entry[6], entry[6] + entry[5]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_name = self._name(self._entry(mid))
+            if mid_name == name:
+                return mid
+            if mid_name < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _lookup(self, path, follow_symlinks: bool = True, depth: int = 0) -> int:
+        """Индекс записи пути; симлинки разрешаются внутри образа"""
+        if depth > SYMLINK_DEPTH:
+            raise _error(errno.ELOOP, path)
+        parts = vfs_parts(path)
+        key = '/'.join(parts)
+        if follow_symlinks and key in self._paths:
+            return self._paths[key]
+        index = 0
+        for i, part in enumerate(parts):
+            if not stat.S_ISDIR(self._entry(index)[2]):
+                raise _error(errno.ENOTDIR, path)
+            child = self._child(index, os.fsencode(part))
+            if child is None:
+                raise _error(errno.ENOENT, path)
+            last = i == len(parts) - 1
+            entry = self._entry(child)
+            if stat.S_ISLNK(entry[2]) and (not last or follow_symlinks):
+                target = self._target(entry)
+                base = '/'.join(parts[:i])
+                target = target if target.startswith('/') else f"{base}/{target}"
+                rest = '/'.join(parts[i + 1:])
+                child = self._lookup(f"{target}/{rest}" if rest else target, follow_symlinks, depth + 1)
+                if follow_symlinks:
+                    self._paths[key] = child
+                return child
+            index = child
+        if follow_symlinks:
+            self._paths[key] = index
+        return index
+
+    def _target(self, entry) -> str:
+        start = self.strings_offset + entry[6]
+        return os.fsdecode(self.view[start:start + entry[5]].tobytes())
+
+    def _blocks(self, entry) -> List[int]:
+        count = -(-entry[5] // self.block_size)
+        return [BLOCK_OFFSET.unpack_from(self.view, entry[6] + i * BLOCK_OFFSET.size)[0] for i in range(count + 1)]
+
+    def _slice(self, index: int, pos: int, size: int):
+        """До size байт файла с позиции pos; несжатый файл - срез mmap без копирования"""
+        entry = self._entry(index)
+        size = max(0, min(size, entry[5] - pos))
+        if not entry[3] & FLAG_COMPRESSED:
+            return self.view[entry[6] + pos:entry[6] + pos + size]
+        block_no = pos // self.block_size
+        with self._lock:
+            cached_index, cached_no, data = self._block
+            if (cached_index, cached_no) != (index, block_no):
+                offsets = self._blocks(entry)
+                raw = self.view[offsets[block_no]:offsets[block_no + 1]]
+                data = DECOMPRESSORS[self.compression](raw)
+                self._block = (index, block_no, data)
+        start = pos - block_no * self.block_size
+        return memoryview(data)[start:start + size]
+
+    def _file_index(self, path) -> int:
+        index = self._lookup(path)
+        mode = self._entry(index)[2]
+        if stat.S_ISDIR(mode):
+            raise _error(errno.EISDIR, path)
+        return index
+
+    def view_bytes(self, path) -> memoryview:
+        """Содержимое несжатого файла как срез mmap, без копирования"""
+        index = self._file_index(path)
+        entry = self._entry(index)
+        if entry[3] & FLAG_COMPRESSED:
+            return memoryview(self.read_bytes(path))
+        return self._slice(index, 0, entry[5])
+
+    def mapping(self, path) -> Optional[Tuple[mmap.mmap, int, int]]:
+        """(mmap образа, смещение, размер) несжатого файла; None для сжатого"""
+        entry = self._entry(self._file_index(path))
+        if entry[3] & FLAG_COMPRESSED:
+            return None
+        return self._mmap, entry[6], entry[5]
+
+    # --- интерфейс Storage ---
+
+    def stat(self, path, follow_symlinks: bool = True) -> StatResult:
+        index = self._lookup(path, follow_symlinks)
+        entry = self._entry(index)
+        size = 0 if stat.S_ISDIR(entry[2]) else entry[5]
+        return StatResult(entry[2], size, entry[4], index + 1, 2 if stat.S_ISDIR(entry[2]) else 1)
+
+    def listdir(self, path) -> List[str]:
+        entry = self._entry(self._lookup(path))
+        if not stat.S_ISDIR(entry[2]):
+            raise _error(errno.ENOTDIR, path)
+        return [os.fsdecode(self._name(self._entry(i))) for i in range(entry[6], entry[6] + entry[5])]
+
+    def open(self, path, mode: str = 'r', encoding: Optional[str] = None):
+        if mode.replace('b', '').replace('t', '') != 'r':
+            raise _error(errno.EROFS, path)
+        raw = io.BufferedReader(_ImageFile(self, self._file_index(path)))
+        if 'b' in mode:
+            return raw
+        return io.TextIOWrapper(raw, encoding=encoding or 'utf-8')
+
+    def read_bytes(self, path) -> bytes:
+        index = self._file_index(path)
+        entry = self._entry(index)
+        if not entry[3] & FLAG_COMPRESSED:
+            return self._slice(index, 0, entry[5]).tobytes()
+        offsets = self._blocks(entry)
+        decompress = DECOMPRESSORS[self.compression]
+        return b''.join(decompress(self.view[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1))
+
+    def read_text(self, path, encoding: Optional[str] = None) -> str:
+        return self.read_bytes(path).decode(encoding or 'utf-8')
+
+    def readlink(self, path) -> str:
+        entry = self._entry(self._lookup(path, follow_symlinks=False))
+        if not stat.S_ISLNK(entry[2]):
+            raise _error(errno.EINVAL, path)
+        return self._target(entry)
+
+    def mkdir(self, path, parents: bool = False, exist_ok: bool = False) -> None:
+        if exist_ok and self.is_dir(path):
+            return
+        raise _error(errno.EROFS, path)
+
+    def unlink(self, path) -> None:
+        raise _error(errno.EROFS, path)
+
+    def rmdir(self, path) -> None:
+        raise _error(errno.EROFS, path)
+
+    def rename(self, src, dst) -> None:
+        raise _error(errno.EROFS, src)
+
+    def symlink(self, target: str, path) -> None:
+        raise _error(errno.EROFS, path)
+
+    def chmod(self, path, mode: int) -> None:
+        raise _error(errno.EROFS, path)
+
+    def rmtree(self, path) -> None:
+        raise _error(errno.EROFS, path)
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import stat
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from mashfs.storage import Storage, open_storage, vfs_path
+
+# Индекс метаданных корня (find, locate, du): путь, тип, размер, mtime,
+# владелец и пакет в sqlite. Утилиты, меняющие дерево, дописывают пути
+# в журнал, он применяется перед запросом; остальное находит обход по mtime.
+
+INDEX_FILE = 'var/cache/mashfs/index.sqlite'
+JOURNAL_FILE = 'var/cache/mashfs/index.journal'
+PACKAGES_INDEX = 'opt/packman/installed/index.json'
+# Не индексируются: сам индекс и кэши, корзина rm -r
+EXCLUDED = {'var/cache', 'var/trash'}
+# Раз в столько секунд запрос запускает фоновую сверку всего дерева
+SWEEP_INTERVAL = 300
+BATCH_SIZE = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT NOT NULL UNIQUE,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    owner TEXT NOT NULL,
+    package TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries(parent);
+CREATE VIRTUAL TABLE IF NOT EXISTS paths USING fts5(path, content='entries', content_rowid='rowid', tokenize='trigram');
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+"""
+# Триграммы путей (paths) обновляются триггерами; при первом построении
+# триггеры снимаются и paths заполняется одним INSERT - в разы быстрее
+TRIGGERS = {
+    'entries_ai': """CREATE TRIGGER entries_ai AFTER INSERT ON entries BEGIN
+    INSERT INTO paths(rowid, path) VALUES (new.rowid, new.path);
+END""",
+    'entries_ad': """CREATE TRIGGER entries_ad AFTER DELETE ON entries BEGIN
+    INSERT INTO paths(paths, rowid, path) VALUES ('delete', old.rowid, old.path);
+END""",
+}
+
+# Типы записей, как в find -type
+FILE, DIRECTORY, SYMLINK = 'f', 'd', 'l'
+COLUMNS = 'path, name, type, size, mtime_ns, owner, package'
+
+
+def _kind(mode: int) -> str:
+    if stat.S_ISDIR(mode):
+        return DIRECTORY
+    if stat.S_ISLNK(mode):
+        return SYMLINK
+    return FILE
+
+
+def subtree_clause(base: str) -> Tuple[str, List[str]]:
+    """WHERE для base и всего под ним: диапазон по уникальному индексу path ('0' идет сразу за '/')"""
+    if not base:
+        return "1", []
+    return "(path = ? OR (path >= ? AND path < ?))", [base, base + '/', base + '0']
+
+
+def home_owners(passwd: str) -> Callable[[str], str]:
+    """Владелец пути по etc/passwd. В MashFS у файлов нет uid:
+    владелец - пользователь, в чьем домашнем каталоге путь, иначе root"""
+    homes = []
+    for line in passwd.splitlines():
+        fields = line.split(':')
+        if len(fields) >= 6 and vfs_path(fields[5]):
+            homes.append((vfs_path(fields[5]), fields[0]))
+    homes.sort(key=lambda item: -len(item[0]))
+
+    def owner(rel: str) -> str:
+        for home, user in homes:
+            if rel == home or rel.startswith(home + '/'):
+                return user
+        return 'root'
+    return owner
+
+
+def package_owners(index_json: str) -> Dict[str, str]:
+    """Путь -> пакет из обратного индекса packman (opt/packman/installed/index.json)"""
+    try:
+        return {vfs_path(path): package for path, package in json.loads(index_json).items()}
+    except (ValueError, AttributeError):
+        return {}
+
+
+def live_entries(fs: Storage, base='') -> Iterator[Tuple]:
+    """Те же записи, что дает индекс, обходом хранилища (find --no-index, сессии в памяти)"""
+    def read(path):
+        try:
+            return fs.read_text(path)
+        except OSError:
+            return ''
+    owner, packages = home_owners(read('etc/passwd')), package_owners(read(PACKAGES_INDEX) or '{}')
+
+    def row(rel):
+        st = fs.lstat(rel)
+        return (rel, rel.rpartition('/')[2], _kind(st.st_mode), st.st_size, st.st_mtime_ns, owner(rel), packages.get(rel))
+
+    # Обход в глубину с сортировкой имен: порядок как у find по индексу
+    stack = [vfs_path(base)]
+    while stack:
+        rel = stack.pop()
+        try:
+            entry = row(rel)
+        except OSError:
+            continue
+        if rel:
+            yield entry
+        if entry[2] == DIRECTORY:
+            try:
+                names = sorted(fs.listdir(rel), reverse=True)
+            except OSError:
+                continue
+            stack.extend(f"{rel}/{name}" if rel else name for name in names)
+
+
+def note_changed(root: Path, paths: Iterable[str]) -> None:
+    """Дописывает измененные пути в журнал индекса; без индекса ничего не делает.
+
+    Одна короткая запись с O_APPEND: утилите не нужны ни sqlite, ни блокировки.
+    """
+    root = Path(root)
+    if not (root / INDEX_FILE).exists():
+        return
+    payload = ''.join(json.dumps(vfs_path(path), ensure_ascii=False) + '\n' for path in paths)
+    if not payload:
+        return
+    try:
+        fd = os.open(root / JOURNAL_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, payload.encode())
+        finally:
+            os.close(fd)
+    except OSError:
+        # Пропущенное изменение найдет очередная сверка
+        pass
+
+
+def storage_changed(fs: Storage, paths: Iterable[str]) -> None:
+    """note_changed для хранилища утилиты: индекс есть только у корня на диске"""
+    if fs.name == 'host':
+        note_changed(fs.root, paths)
+
+
+class MetadataIndex:
+    """Индекс метаданных корня на диске в var/cache/mashfs/index.sqlite"""
+
+    def __init__(self, root: Path):
+        self.root = Path(root).absolute()
+        self.db_file = self.root / INDEX_FILE
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        # sqlite3 нужен только запросам: mkdir и rm лишь дописывают журнал
+        import sqlite3
+        self.db = sqlite3.connect(self.db_file, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self._set_triggers(True)
+        self._owners: Optional[Callable[[str], str]] = None
+        self._packages: Optional[Dict[str, str]] = None
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _set_triggers(self, enabled: bool) -> None:
+        for name, sql in TRIGGERS.items():
+            self.db.execute(f"DROP TRIGGER IF EXISTS {name}")
+            if enabled:
+                self.db.execute(sql)
+
+    def _meta(self, key: str, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def _set_meta(self, key: str, value) -> None:
+        self.db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def built(self) -> bool:
+        return self._meta('swept_at') is not None
+
+    @property
+    def stale(self) -> bool:
+        return time.time() - float(self._meta('swept_at', 0)) > SWEEP_INTERVAL
+
+    def _owner(self, rel: str) -> str:
+        if self._owners is None:
+            try:
+                self._owners = home_owners((self.root / 'etc' / 'passwd').read_text())
+            except OSError:
+                self._owners = home_owners('')
+        return self._owners(rel)
+
+    def _package_map(self) -> Dict[str, str]:
+        if self._packages is None:
+            try:
+                self._packages = package_owners((self.root / PACKAGES_INDEX).read_text())
+            except OSError:
+                self._packages = {}
+        return self._packages
+
+    def _row(self, rel: str, st: os.stat_result) -> Tuple:
+        parent, _, name = rel.rpartition('/')
+        return (rel, parent, name, _kind(st.st_mode), st.st_size, st.st_mtime_ns,
+                self._owner(rel), self._package_map().get(rel))
+
+    def _delete(self, rel: str) -> None:
+        where, params = subtree_clause(rel)
+        self.db.execute(f"DELETE FROM entries WHERE {where}", params)
+
+    def _sync_dir(self, rel_dir: str, pending: List[Tuple]) -> List[str]:
+        """Сверяет детей каталога с диском; возвращает подкаталоги для обхода.
+
+        Новые и измененные записи копятся в pending для общего executemany.
+        """
+        host_dir = self.root / rel_dir if rel_dir else self.root
+        known = {name: (kind, size, mtime_ns) for name, kind, size, mtime_ns in self.db.execute(
+            "SELECT name, type, size, mtime_ns FROM entries WHERE parent = ?", (rel_dir,))}
+        subdirs = []
+        try:
+            with os.scandir(host_dir) as it:
+                children = list(it)
+        except OSError:
+            children = []
+        for child in children:
+            rel = f"{rel_dir}/{child.name}" if rel_dir else child.name
+            if rel in EXCLUDED:
+                continue
+            try:
+                st = child.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            row = self._row(rel, st)
+            old = known.pop(child.name, None)
+            if old is not None and old[0] != row[3]:
+                # Файл стал каталогом или наоборот: старое поддерево уходит целиком
+                self._delete(rel)
+                old = None
+            if old is None or old[1:] != row[4:6]:
+                pending.append(row)
+            if row[3] == DIRECTORY:
+                subdirs.append(rel)
+        for name in known:
+            self._delete(f"{rel_dir}/{name}" if rel_dir else name)
+        return subdirs
+
+    def _flush(self, pending: List[Tuple]) -> None:
+        if pending:
+            self.db.executemany(
+                "INSERT INTO entries(path, parent, name, type, size, mtime_ns, owner, package) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET type = excluded.type, size = excluded.size, "
+                "mtime_ns = excluded.mtime_ns, owner = excluded.owner, package = excluded.package", pending)
+            pending.clear()
+
+    def sweep(self, path='', recursive: bool = True) -> None:
+        """Сверка поддерева с диском: при полной сверке stat каждой записи, но
+        переписываются только изменившиеся строки"""
+        base = vfs_path(path)
+        pending: List[Tuple] = []
+        bulk = not base and recursive and not self.built
+        with self.db:
+            if bulk:
+                self._set_triggers(False)
+            if base:
+                host = self.root / base
+                try:
+                    st = host.lstat()
+                except OSError:
+                    st = None
+                if st is None or any(base == excluded or base.startswith(excluded + '/') for excluded in EXCLUDED):
+                    self._delete(base)
+                    return
+                pending.append(self._row(base, st))
+                if not stat.S_ISDIR(st.st_mode):
+                    self._flush(pending)
+                    return
+            stack = [base]
+            while stack:
+                rel_dir = stack.pop()
+                subdirs = self._sync_dir(rel_dir, pending)
+                if recursive:
+                    stack.extend(subdirs)
+                if len(pending) >= BATCH_SIZE:
+                    self._flush(pending)
+            self._flush(pending)
+            if bulk:
+                # Не 'rebuild': тот читает пути по индексу path, вразнобой по rowid,
+                # и строит триграммы в несколько раз дольше
+                self.db.execute("INSERT INTO paths(paths) VALUES ('delete-all')")
+                self.db.execute("INSERT INTO paths(rowid, path) SELECT rowid, path FROM entries ORDER BY rowid")
+                self._set_triggers(True)
+            if not base and recursive:
+                self._set_meta('swept_at', time.time())
+                self._set_meta('packages_mtime', self._packages_mtime())
+
+    def _packages_mtime(self) -> int:
+        try:
+            return (self.root / PACKAGES_INDEX).stat().st_mtime_ns
+        except OSError:
+            return 0
+
+    def _refresh_packages(self) -> None:
+        # packman переписал обратный индекс: владельцы-пакеты пересчитываются целиком
+        mtime = self._packages_mtime()
+        if mtime == self._meta('packages_mtime', 0):
+            return
+        self._packages = None
+        with self.db:
+            self.db.execute("UPDATE entries SET package = NULL WHERE package IS NOT NULL")
+            self.db.executemany("UPDATE entries SET package = ? WHERE path = ?",
+                                ((package, path) for path, package in self._package_map().items()))
+            self._set_meta('packages_mtime', mtime)
+
+    def apply_journal(self) -> None:
+        """Применяет пути, записанные note_changed: родитель сверяется без рекурсии,
+        сам путь - с поддеревом (например, каталог, восстановленный из корзины)"""
+        journal = self.root / JOURNAL_FILE
+        taken = journal.with_name(f"{journal.name}.{os.getpid()}")
+        try:
+            os.rename(journal, taken)
+        except FileNotFoundError:
+            pass
+        # Журналы, забранные процессами, которые не успели их применить
+        leftovers = sorted(journal.parent.glob(f"{journal.name}.*"))
+        paths = []
+        for taken_file in leftovers:
+            try:
+                with open(taken_file, encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            paths.append(vfs_path(json.loads(line)))
+                        except ValueError:
+                            continue
+            except OSError:
+                continue
+        for rel in dict.fromkeys(paths):
+            # mkdir -p мог создать и предков: сверка начинается с верхнего неизвестного
+            top, parent = rel, rel.rpartition('/')[0]
+            while parent and self.db.execute("SELECT 1 FROM entries WHERE path = ?", (parent,)).fetchone() is None:
+                top, parent = parent, parent.rpartition('/')[0]
+            if top:
+                self.sweep(parent, recursive=False)
+            self.sweep(top)
+        for taken_file in leftovers:
+            try:
+                taken_file.unlink()
+            except OSError:
+                pass
+
+    def refresh(self) -> None:
+        """Индекс перед запросом: журнал применяется сразу, сверка по mtime - в фоне"""
+        if not self.built:
+            self.sweep()
+            return
+        self.apply_journal()
+        self._refresh_packages()
+        if self.stale:
+            sweep_in_background(self.root)
+
+    def query(self, base: str = '', where: str = '1', params: Iterable = (), order: bool = True) -> Iterator[Tuple]:
+        """Записи (path, name, type, size, mtime_ns, owner, package) в base и под ним"""
+        subtree, subtree_params = subtree_clause(vfs_path(base))
+        sql = f"SELECT {COLUMNS} FROM entries WHERE {subtree} AND ({where})"
+        if order:
+            sql += " ORDER BY path"
+        return self.db.execute(sql, subtree_params + list(params))
+
+    def locate(self, substring: str) -> Iterator[str]:
+        """Пути, содержащие подстроку (без учета регистра). Триграммам нужно
+        от трех символов, более короткая подстрока ищется перебором"""
+        if len(substring) >= 3:
+            phrase = '"' + substring.replace('"', '""') + '"'
+            rows = self.db.execute("SELECT path FROM paths WHERE paths MATCH ? ORDER BY path", (phrase,))
+        else:
+            rows = self.db.execute("SELECT path FROM entries WHERE instr(lower(path), ?) ORDER BY path",
+                                   (substring.lower(),))
+        return (row[0] for row in rows)
+
+    def total_size(self, base: str = '') -> Tuple[int, bool]:
+        """(сумма размеров файлов и симлинков под base, есть ли base в индексе)"""
+        subtree, params = subtree_clause(vfs_path(base))
+        size, count = self.db.execute(
+            f"SELECT coalesce(sum(CASE WHEN type != 'd' THEN size END), 0), count(*) FROM entries WHERE {subtree}",
+            params).fetchone()
+        return size, count > 0 or not vfs_path(base)
+
+
+def open_index(fs: Storage) -> Optional[MetadataIndex]:
+    """Готовый к запросам индекс корня; None, если корень не на диске
+    (сессия в памяти, образ, overlay) - тогда утилиты обходят дерево сами"""
+    if fs.name != 'host':
+        return None
+    import sqlite3
+    try:
+        index = MetadataIndex(fs.root)
+        index.refresh()
+    except (OSError, sqlite3.Error):
+        return None
+    return index
+
+
+def sweep_in_background(root: Path) -> None:
+    """Сверка всего дерева отдельным процессом, как очистка корзины"""
+    import subprocess
+    lib_dir = str(Path(__file__).absolute().parents[1])
+    env = dict(os.environ, MASHFS_ROOT=str(root), MASHFS_STORAGE='host',
+               PYTHONPATH=os.pathsep.join(filter(None, [lib_dir, os.environ.get('PYTHONPATH')])))
+    try:
+        subprocess.Popen([sys.executable, '-m', 'mashfs.index', 'sweep'], env=env,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+    except OSError:
+        pass
+
+
+def main() -> int:
+    if len(sys.argv) != 2 or sys.argv[1] not in ('sweep', 'rebuild'):
+        print("Usage: python -m mashfs.index sweep|rebuild")
+        return 1
+    import fcntl
+    fs = open_storage()
+    if fs.name != 'host':
+        print("Индекс есть только у корня на диске (MASHFS_STORAGE=host)")
+        return 1
+    lock_file = fs.root / 'var' / 'cache' / 'mashfs' / 'index.lock'
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Сверка уже идет
+            return 0
+        if sys.argv[1] == 'rebuild':
+            # Новый файл строится быстрее, чем удаление всех строк по одной
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.unlink(f"{fs.root / INDEX_FILE}{suffix}")
+                except FileNotFoundError:
+                    pass
+        index = MetadataIndex(fs.root)
+        try:
+            index.apply_journal()
+            index.sweep()
+        finally:
+            index.close()
+    finally:
+        os.close(fd)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import os
+import marshal
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Снимок состояния шелла при запуске (пользователи, тема, команды bin/):
+# один marshal-файл вместо разбора etc/passwd и темы. Пароли (etc/shadow)
+# в снимок не кладутся, а сам файл доступен только владельцу.
+# Снимок годен, пока (mtime, размер, права) всех его исходных файлов те же.
+
+SNAPSHOT_FILE = 'var/cache/mashfs/shell.snapshot'
+SNAPSHOT_VERSION = 2
+
+# (путь, mtime_ns, размер, права); отметки без прав (тема) сравниваются по первым трем
+Stamp = Tuple
+
+
+def stamp(root: Path, rel: str) -> Stamp:
+    """(путь от корня, mtime_ns, размер, st_mode) с переходом по симлинку; для отсутствующего -1"""
+    try:
+        st = os.stat(os.path.join(root, rel))
+        return (rel, st.st_mtime_ns, st.st_size, st.st_mode)
+    except OSError:
+        return (rel, -1, -1, -1)
+
+
+def stamps(root: Path, sources: Iterable[str]) -> List[Stamp]:
+    return [stamp(root, rel) for rel in sources]
+
+
+def dir_stamps(root: Path, rel: str) -> List[Stamp]:
+    """Отметки каталога и каждой его записи: chmod файла не меняет mtime каталога"""
+    try:
+        names = sorted(os.listdir(os.path.join(root, rel)))
+    except OSError:
+        names = []
+    return [stamp(root, rel)] + [stamp(root, f"{rel}/{name}") for name in names]
+
+
+def load_snapshot(root: Path, key: Any) -> Optional[Dict]:
+    """Состояние из снимка; None, если его нет, он от другой версии или ключа
+    (например, другой MASHFS_THEME) или какой-то исходный файл изменился"""
+    try:
+        with open(os.path.join(root, SNAPSHOT_FILE), 'rb') as f:
+            data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != SNAPSHOT_VERSION or data.get('key') != key:
+        return None
+    for source in data['sources']:
+        if stamp(root, source[0])[:len(source)] != tuple(source):
+            return None
+    return data['state']
+
+
+def save_snapshot(root: Path, key: Any, sources: List[Stamp], state: Dict) -> None:
+    """Записывает снимок. sources снимаются до чтения файлов: изменение во время
+    чтения тогда делает снимок негодным, а не закрепляет старые данные"""
+    path = os.path.join(root, SNAPSHOT_FILE)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        # Список пользователей и конфигурация - не для всех: файл создается сразу 0600
+        with os.fdopen(os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600), 'wb') as f:
+            marshal.dump({'version': SNAPSHOT_VERSION, 'key': key, 'sources': [tuple(s) for s in sources],
+                          'state': state}, f)
+        os.replace(tmp, path)
+    except (OSError, ValueError):
+        # Снимок - только ускорение; корень может быть только для чтения
+        pass
@@ -0,0 +1,878 @@
+#!/usr/bin/env python3
+import io
+import os
+import abc
+import stat
+import errno
+import shutil
+import itertools
+import threading
+import time
+from pathlib import Path
+from collections import namedtuple
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Что видят вызывающие: подмножество os.stat_result
+StatResult = namedtuple('StatResult', ['st_mode', 'st_size', 'st_mtime_ns', 'st_ino', 'st_nlink'])
+
+SYMLINK_DEPTH = 40
+
+
+def vfs_parts(path) -> List[str]:
+    """Путь внутри MashFS ('/etc/passwd', 'home/mash/../x') -> список компонентов от корня.
+
+    '..' не поднимается выше корня, так что из MashFS не выйти.
+    """
+    parts: List[str] = []
+    for part in str(path).replace('\\', '/').split('/'):
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            if parts:
+                parts.pop()
+            continue
+        parts.append(part)
+    return parts
+
+
+def vfs_path(path) -> str:
+    """Нормализованный путь от корня без ведущего '/' ('' - сам корень)"""
+    return '/'.join(vfs_parts(path))
+
+
+def _error(code: int, path) -> OSError:
+    return OSError(code, os.strerror(code), f"/{vfs_path(path)}")
+
+
+class Storage(abc.ABC):
+    """Хранилище корня MashFS: все пути - от корня виртуальной ФС.
+
+    Ошибки - обычные OSError (FileNotFoundError, IsADirectoryError...),
+    поэтому код, написанный под pathlib/os, переносится без новых except.
+    Реализация обязана дать все абстрактные методы; остальное выводится из них.
+    """
+
+    name = ''
+    # True, если пути хранилища - реальные файлы, доступные внешним процессам
+    on_disk = False
+    # True, если любая запись заканчивается EROFS (образ mashsys pack)
+    read_only = False
+
+    @abc.abstractmethod
+    def stat(self, path, follow_symlinks: bool = True) -> StatResult:
+        raise NotImplementedError
+
+    def lstat(self, path) -> StatResult:
+        return self.stat(path, follow_symlinks=False)
+
+    @abc.abstractmethod
+    def listdir(self, path) -> List[str]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def open(self, path, mode: str = 'r', encoding: Optional[str] = None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def mkdir(self, path, parents: bool = False, exist_ok: bool = False) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def unlink(self, path) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def rmdir(self, path) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def rename(self, src, dst) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def symlink(self, target: str, path) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def readlink(self, path) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def chmod(self, path, mode: int) -> None:
+        raise NotImplementedError
+
+    def host_path(self, path) -> Optional[Path]:
+        """Реальный путь на диске (для внешних программ); None, если файла на диске нет"""
+        return None
+
+    def escapes_root(self, path) -> bool:
+        """True, если путь (через симлинки) ведет за пределы корня"""
+        return False
+
+    def cache_dir(self) -> Optional[Path]:
+        """Каталог на диске для кэшей mashfs (конфиг, тема); None - кэши живут только в памяти процесса"""
+        return None
+
+    def exists(self, path) -> bool:
+        try:
+            self.stat(path)
+            return True
+        except OSError:
+            return False
+
+    def is_dir(self, path) -> bool:
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, path) -> bool:
+        try:
+            return stat.S_ISREG(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self, path) -> bool:
+        try:
+            return stat.S_ISLNK(self.lstat(path).st_mode)
+        except OSError:
+            return False
+
+    def is_executable(self, path) -> bool:
+        try:
+            st = self.stat(path)
+        except OSError:
+            return False
+        return stat.S_ISREG(st.st_mode) and bool(st.st_mode & 0o111)
+
+    def read_text(self, path, encoding: Optional[str] = None) -> str:
+        with self.open(path, 'r', encoding=encoding) as f:
+            return f.read()
+
+    def write_text(self, path, data: str, encoding: Optional[str] = None) -> None:
+        with self.open(path, 'w', encoding=encoding) as f:
+            f.write(data)
+
+    def read_bytes(self, path) -> bytes:
+        with self.open(path, 'rb') as f:
+            return f.read()
+
+    def write_bytes(self, path, data: bytes) -> None:
+        with self.open(path, 'wb') as f:
+            f.write(data)
+
+    def walk(self, path='') -> Iterator[Tuple[str, List[str], List[str]]]:
+        """Как os.walk сверху вниз, без захода в симлинки на каталоги; пути от корня"""
+        stack = [vfs_path(path)]
+        while stack:
+            rel_dir = stack.pop()
+            dirs, files = [], []
+            try:
+                names = self.listdir(rel_dir)
+            except OSError:
+                continue
+            for name in names:
+                rel = f"{rel_dir}/{name}" if rel_dir else name
+                try:
+                    mode = self.lstat(rel).st_mode
+                except OSError:
+                    continue
+                (dirs if stat.S_ISDIR(mode) else files).append(name)
+            yield rel_dir, dirs, files
+            stack.extend(f"{rel_dir}/{name}" if rel_dir else name for name in reversed(dirs))
+
+    def rmtree(self, path) -> None:
+        for rel_dir, dirs, files in list(self.walk(path))[::-1]:
+            for name in files:
+                self.unlink(f"{rel_dir}/{name}")
+            self.rmdir(rel_dir)
+
+
+class HostStorage(Storage):
+    """Каталог на диске (обычный режим: MASHFS_ROOT)"""
+
+    name = 'host'
+    on_disk = True
+
+    def __init__(self, root: Path):
+        self.root = Path(root).absolute()
+        self.real_root = os.path.realpath(self.root)
+
+    def escapes_root(self, path) -> bool:
+        real = os.path.realpath(self._host(path))
+        return real != self.real_root and not real.startswith(self.real_root + os.sep)
+
+    def _host(self, path) -> Path:
+        rel = vfs_path(path)
+        return self.root / rel if rel else self.root
+
+    def host_path(self, path) -> Optional[Path]:
+        return self._host(path)
+
+    def cache_dir(self) -> Optional[Path]:
+        return self.root / 'var' / 'cache' / 'mashfs'
+
+    def stat(self, path, follow_symlinks: bool = True) -> StatResult:
+        st = os.stat(self._host(path), follow_symlinks=follow_symlinks)
+        return StatResult(st.st_mode, st.st_size, st.st_mtime_ns, st.st_ino, st.st_nlink)
+
+    def listdir(self, path) -> List[str]:
+        return os.listdir(self._host(path))
+
+    def open(self, path, mode: str = 'r', encoding: Optional[str] = None):
+        return open(self._host(path), mode, encoding=None if 'b' in mode else encoding)
+
+    def mkdir(self, path, parents: bool = False, exist_ok: bool = False) -> None:
+        self._host(path).mkdir(parents=parents, exist_ok=exist_ok)
+
+    def unlink(self, path) -> None:
+        os.unlink(self._host(path))
+
+    def rmdir(self, path) -> None:
+        os.rmdir(self._host(path))
+
+    def rename(self, src, dst) -> None:
+        os.rename(self._host(src), self._host(dst))
+
+    def symlink(self, target: str, path) -> None:
+        os.symlink(target, self._host(path))
+
+    def readlink(self, path) -> str:
+        return os.readlink(self._host(path))
+
+    def chmod(self, path, mode: int) -> None:
+        os.chmod(self._host(path), mode)
+
+    def rmtree(self, path) -> None:
+        shutil.rmtree(self._host(path))
+
+
+class _Node:
+    __slots__ = ('mode', 'ino', 'mtime_ns', 'size', 'data', 'children', 'target', 'source')
+
+    def __init__(self, mode: int, ino: int, mtime_ns: int, source: Optional[str] = None, size: int = 0):
+        self.mode = mode
+        self.ino = ino
+        self.mtime_ns = mtime_ns
+        self.size = size
+        # Путь на диске, откуда лениво подгружается содержимое файла или каталога
+        self.source = source
+        self.data: Optional[bytes] = b'' if stat.S_ISREG(mode) and source is None else None
+        self.children: Optional[Dict[str, '_Node']] = {} if stat.S_ISDIR(mode) and source is None else None
+        self.target: Optional[str] = None
+
+
+class _MemoryFile(io.BytesIO):
+    """Открытый на запись файл: содержимое попадает в узел при flush и закрытии"""
+
+    def __init__(self, storage: 'MemoryStorage', node: _Node, initial: bytes, append: bool):
+        super().__init__(initial)
+        self.storage = storage
+        self.node = node
+        if append:
+            self.seek(0, io.SEEK_END)
+
+    def flush(self) -> None:
+        super().flush()
+        if not self.closed:
+            self.storage._store(self.node, self.getvalue())
+
+    def close(self) -> None:
+        if not self.closed:
+            self.storage._store(self.node, self.getvalue())
+        super().close()
+
+
+class MemoryStorage(Storage):
+    """Корень целиком в памяти: для одноразовых сессий и тестов.
+
+    Засевается из снимка на диске (каталог filesfs, резервная копия
+    mashsys, tar-архив или образ mashsys pack). Каталог и образ читаются
+    лениво: список каталога - при первом обращении, содержимое файла -
+    при первом открытии. Изменения на диск не попадают никогда.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._ino = itertools.count(1)
+        self._lock = threading.RLock()
+        self.tree = _Node(stat.S_IFDIR | 0o755, next(self._ino), time.time_ns())
+        # Образ, из которого засеяно дерево: тогда source узлов - пути внутри образа
+        self.image = None
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Path) -> 'MemoryStorage':
+        from mashfs.image import ImageStorage, is_image
+
+        storage = cls()
+        snapshot = Path(snapshot)
+        if is_image(snapshot):
+            storage.image = ImageStorage(snapshot)
+            st = storage.image.stat('')
+            storage.tree = _Node(st.st_mode, next(storage._ino), st.st_mtime_ns, source='')
+        elif snapshot.is_dir():
+            st = snapshot.stat()
+            storage.tree = _Node(stat.S_IFDIR | (st.st_mode & 0o7777), next(storage._ino), st.st_mtime_ns,
+                                 source=str(snapshot))
+        else:
+            import tarfile
+            if not tarfile.is_tarfile(snapshot):
+                raise ValueError(f"{snapshot}: ожидался каталог или tar-архив")
+            storage._load_tar(snapshot)
+        return storage
+
+    def _load_tar(self, archive: Path) -> None:
+        import tarfile
+        with tarfile.open(archive, 'r:*') as tar:
+            for member in tar:
+                rel = vfs_path(member.name)
+                if not rel or rel.split('/')[-1] == '.mashsys-snapshot.json':
+                    continue
+                parent = self._dir_node(vfs_parts(rel)[:-1], create=True)
+                name = vfs_parts(rel)[-1]
+                mtime_ns = int(member.mtime * 1e9)
+                if member.isdir():
+                    node = parent.children.get(name)
+                    if node is None:
+                        node = parent.children[name] = _Node(stat.S_IFDIR, next(self._ino), mtime_ns)
+                    node.mode = stat.S_IFDIR | member.mode
+                elif member.issym():
+                    node = parent.children[name] = _Node(stat.S_IFLNK | 0o777, next(self._ino), mtime_ns)
+                    node.target = member.linkname
+                elif member.isfile():
+                    node = parent.children[name] = _Node(stat.S_IFREG | member.mode, next(self._ino), mtime_ns)
+                    node.data = tar.extractfile(member).read()
+                    node.size = len(node.data)
+
+    # --- узлы ---
+
+    def _children(self, node: _Node) -> Dict[str, _Node]:
+        if node.children is None:
+            node.children = {}
+            if self.image is not None:
+                for name in self.image.listdir(node.source):
+                    rel = f"{node.source}/{name}" if node.source else name
+                    st = self.image.lstat(rel)
+                    child = _Node(st.st_mode, next(self._ino), st.st_mtime_ns, source=rel, size=st.st_size)
+                    if stat.S_ISLNK(st.st_mode):
+                        child.target = self.image.readlink(rel)
+                    node.children[name] = child
+                return node.children
+            with os.scandir(node.source) as it:
+                for entry in it:
+                    st = entry.stat(follow_symlinks=False)
+                    child = _Node(st.st_mode, next(self._ino), st.st_mtime_ns, source=entry.path, size=st.st_size)
+                    if entry.is_symlink():
+                        child.target = os.readlink(entry.path)
+                    node.children[entry.name] = child
+        return node.children
+
+    def _dir_node(self, parts: List[str], create: bool = False) -> _Node:
+        node = self.tree
+        for part in parts:
+            children = self._children(node)
+            child = children.get(part)
+            if child is None:
+                if not create:
+                    raise _error(errno.ENOENT, '/'.join(parts))
+                child = children[part] = _Node(stat.S_IFDIR | 0o755, next(self._ino), time.time_ns())
+            node = child
+        return node
+
+    def _lookup(self, path, follow_symlinks: bool = True, depth: int = 0) -> Tuple[Optional[_Node], Optional[_Node], str]:
+        """(родитель, узел или None, имя) с разрешением симлинков внутри MashFS"""
+        if depth > SYMLINK_DEPTH:
+            raise _error(errno.ELOOP, path)
+        parts = vfs_parts(path)
+        if not parts:
+            return None, self.tree, ''
+        node = self.tree
+        for i, part in enumerate(parts):
+            if not stat.S_ISDIR(node.mode):
+                raise _error(errno.ENOTDIR, path)
+            parent = node
+            child = self._children(parent).get(part)
+            last = i == len(parts) - 1
+            if child is None:
+                if last:
+                    return parent, None, part
+                raise _error(errno.ENOENT, path)
+            if stat.S_ISLNK(child.mode) and (not last or follow_symlinks):
+                base = '/'.join(parts[:i])
+                target = child.target if child.target.startswith('/') else f"{base}/{child.target}"
+                rest = '/'.join(parts[i + 1:])
+                return self._lookup(f"{target}/{rest}" if rest else target, follow_symlinks, depth + 1)
+            node = child
+        return parent, node, parts[-1]
+
+    def _existing(self, path, follow_symlinks: bool = True) -> _Node:
+        _, node, _ = self._lookup(path, follow_symlinks)
+        if node is None:
+            raise _error(errno.ENOENT, path)
+        return node
+
+    def _load(self, node: _Node) -> bytes:
+        if node.data is None:
+            if self.image is not None:
+                node.data = self.image.read_bytes(node.source)
+                node.size = len(node.data)
+                return node.data
+            with open(node.source, 'rb') as f:
+                node.data = f.read()
+            node.size = len(node.data)
+        return node.data
+
+    def _store(self, node: _Node, data: bytes) -> None:
+        with self._lock:
+            node.data = bytes(data)
+            node.size = len(node.data)
+            node.source = None
+            node.mtime_ns = time.time_ns()
+
+    # --- интерфейс Storage ---
+
+    def stat(self, path, follow_symlinks: bool = True) -> StatResult:
+        with self._lock:
+            node = self._existing(path, follow_symlinks)
+            nlink = 2 if stat.S_ISDIR(node.mode) else 1
+            return StatResult(node.mode, node.size, node.mtime_ns, node.ino, nlink)
+
+    def listdir(self, path) -> List[str]:
+        with self._lock:
+            node = self._existing(path)
+            if not stat.S_ISDIR(node.mode):
+                raise _error(errno.ENOTDIR, path)
+            return list(self._children(node))
+
+    def open(self, path, mode: str = 'r', encoding: Optional[str] = None):
+        binary = 'b' in mode
+        kind = mode.replace('b', '').replace('t', '')
+        with self._lock:
+            parent, node, name = self._lookup(path)
+            if node is not None and stat.S_ISDIR(node.mode):
+                raise _error(errno.EISDIR, path)
+            if kind in ('r', 'r+'):
+                if node is None:
+                    raise _error(errno.ENOENT, path)
+                data = self._load(node)
+                raw = io.BytesIO(data) if kind == 'r' else _MemoryFile(self, node, data, append=False)
+            elif kind in ('w', 'a', 'x', 'w+', 'a+'):
+                if node is None:
+                    if parent is None or not stat.S_ISDIR(parent.mode):
+                        raise _error(errno.ENOENT, path)
+                    node = self._children(parent)[name] = _Node(stat.S_IFREG | 0o644, next(self._ino), time.time_ns())
+                    parent.mtime_ns = node.mtime_ns
+                elif kind == 'x':
+                    raise _error(errno.EEXIST, path)
+                initial = self._load(node) if kind.startswith('a') else b''
+                raw = _MemoryFile(self, node, initial, append=kind.startswith('a'))
+                if not kind.startswith('a'):
+                    self._store(node, b'')
+            else:
+                raise ValueError(f"неподдерживаемый режим: {mode}")
+        if binary:
+            return raw
+        return io.TextIOWrapper(raw, encoding=encoding or 'utf-8')
+
+    def mkdir(self, path, parents: bool = False, exist_ok: bool = False) -> None:
+        with self._lock:
+            try:
+                parent, node, name = self._lookup(path)
+            except FileNotFoundError:
+                if not parents:
+                    raise
+                self.mkdir(vfs_path(path).rpartition('/')[0], parents=True, exist_ok=True)
+                parent, node, name = self._lookup(path)
+            if node is not None:
+                if exist_ok and stat.S_ISDIR(node.mode):
+                    return
+                raise _error(errno.EEXIST, path)
+            self._children(parent)[name] = _Node(stat.S_IFDIR | 0o755, next(self._ino), time.time_ns())
+            parent.mtime_ns = time.time_ns()
+
+    def _remove(self, path, want_dir: bool) -> None:
+        with self._lock:
+            parent, node, name = self._lookup(path, follow_symlinks=False)
+            if node is None or parent is None:
+                raise _error(errno.ENOENT if node is None else errno.EBUSY, path)
+            is_dir = stat.S_ISDIR(node.mode)
+            if want_dir and not is_dir:
+                raise _error(errno.ENOTDIR, path)
+            if not want_dir and is_dir:
+                raise _error(errno.EISDIR, path)
+            if want_dir and self._children(node):
+                raise _error(errno.ENOTEMPTY, path)
+            del self._children(parent)[name]
+            parent.mtime_ns = time.time_ns()
+
+    def unlink(self, path) -> None:
+        self._remove(path, want_dir=False)
+
+    def rmdir(self, path) -> None:
+        self._remove(path, want_dir=True)
+
+    def rename(self, src, dst) -> None:
+        with self._lock:
+            src_parent, node, src_name = self._lookup(src, follow_symlinks=False)
+            if node is None or src_parent is None:
+                raise _error(errno.ENOENT, src)
+            dst_parent, existing, dst_name = self._lookup(dst, follow_symlinks=False)
+            if dst_parent is None:
+                raise _error(errno.EBUSY, dst)
+            if stat.S_ISDIR(node.mode) and (vfs_path(dst) + '/').startswith(vfs_path(src) + '/'):
+                raise _error(errno.EINVAL, dst)
+            if existing is not None and existing is not node:
+                if stat.S_ISDIR(existing.mode):
+                    if not stat.S_ISDIR(node.mode):
+                        raise _error(errno.EISDIR, dst)
+                    if self._children(existing):
+                        raise _error(errno.ENOTEMPTY, dst)
+                elif stat.S_ISDIR(node.mode):
+                    raise _error(errno.ENOTDIR, dst)
+            del self._children(src_parent)[src_name]
+            self._children(dst_parent)[dst_name] = node
+            src_parent.mtime_ns = dst_parent.mtime_ns = time.time_ns()
+
+    def symlink(self, target: str, path) -> None:
+        with self._lock:
+            parent, node, name = self._lookup(path, follow_symlinks=False)
+            if node is not None:
+                raise _error(errno.EEXIST, path)
+            if parent is None:
+                raise _error(errno.ENOENT, path)
+            link = self._children(parent)[name] = _Node(stat.S_IFLNK | 0o777, next(self._ino), time.time_ns())
+            link.target = str(target)
+            link.size = len(link.target)
+            parent.mtime_ns = link.mtime_ns
+
+    def readlink(self, path) -> str:
+        with self._lock:
+            node = self._existing(path, follow_symlinks=False)
+            if not stat.S_ISLNK(node.mode):
+                raise _error(errno.EINVAL, path)
+            return node.target
+
+    def chmod(self, path, mode: int) -> None:
+        with self._lock:
+            node = self._existing(path)
+            node.mode = stat.S_IFMT(node.mode) | (mode & 0o7777)
+
+    def host_path(self, path) -> Optional[Path]:
+        # Нетронутый засеянный файл можно отдать внешней программе на чтение
+        with self._lock:
+            try:
+                node = self._existing(path)
+            except OSError:
+                return None
+            if stat.S_ISREG(node.mode) and node.source is not None and node.data is None and self.image is None:
+                return Path(node.source)
+            return None
+
+
+WHITEOUT_PREFIX = '.wh.'
+OPAQUE_MARKER = '.wh..wh..opq'
+
+
+class OverlayStorage(Storage):
+    """Общий нижний корень только для чтения + верхний каталог сессии.
+
+    Чтение проваливается в нижний слой, запись сначала копирует файл
+    наверх (copy-up), удаление пути из нижнего слоя оставляет наверху
+    маркер .wh.<имя>. Каталог, пересозданный поверх удаленного, получает
+    маркер .wh..wh..opq и больше не смешивается с нижним слоем. Новая
+    сессия - это один пустой верхний каталог.
+    """
+
+    name = 'overlay'
+    on_disk = True
+
+    def __init__(self, lower: Path, upper: Path):
+        self.lower = HostStorage(lower)
+        self.upper = HostStorage(upper)
+        self.root = self.lower.root
+        self.upper.root.mkdir(parents=True, exist_ok=True)
+
+    def _visible(self, parts: List[str]) -> Tuple[bool, bool]:
+        """(не удален ли путь, виден ли для него нижний слой)"""
+        lower_visible = True
+        for i, name in enumerate(parts):
+            upper_dir = self.upper._host('/'.join(parts[:i]))
+            if not os.path.isdir(upper_dir):
+                # Выше по дереву сессия ничего не меняла - маркеров глубже нет
+                break
+            if os.path.lexists(upper_dir / OPAQUE_MARKER):
+                lower_visible = False
+            if os.path.lexists(upper_dir / (WHITEOUT_PREFIX + name)):
+                return False, False
+        return True, lower_visible
+
+    def _layer(self, path) -> Optional[HostStorage]:
+        parts = vfs_parts(path)
+        if any(part.startswith(WHITEOUT_PREFIX) for part in parts):
+            return None
+        visible, lower_visible = self._visible(parts)
+        if not visible:
+            return None
+        if os.path.lexists(self.upper._host(path)):
+            return self.upper
+        if lower_visible and os.path.lexists(self.lower._host(path)):
+            return self.lower
+        return None
+
+    def _in_lower(self, path) -> bool:
+        parts = vfs_parts(path)
+        visible, lower_visible = self._visible(parts)
+        return visible and lower_visible and os.path.lexists(self.lower._host(path))
+
+    def _whiteout(self, path) -> Path:
+        parent, _, name = vfs_path(path).rpartition('/')
+        return self.upper._host(parent) / (WHITEOUT_PREFIX + name)
+
+    def _copy_up_dirs(self, rel_dir: str) -> None:
+        """Создает наверху цепочку каталогов rel_dir с правами из нижнего слоя"""
+        parts = vfs_parts(rel_dir)
+        for i in range(1, len(parts) + 1):
+            rel = '/'.join(parts[:i])
+            target = self.upper._host(rel)
+            if os.path.isdir(target):
+                continue
+            layer = self._layer(rel)
+            if layer is None or not layer.is_dir(rel):
+                raise _error(errno.ENOENT, rel_dir)
+            os.mkdir(target)
+            os.chmod(target, layer.stat(rel).st_mode & 0o7777)
+
+    def _copy_up(self, path) -> None:
+        rel = vfs_path(path)
+        self._copy_up_dirs(rel.rpartition('/')[0])
+        if os.path.lexists(self.upper._host(rel)):
+            return
+        src = self.lower._host(rel)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), self.upper._host(rel))
+        elif os.path.isdir(src):
+            os.mkdir(self.upper._host(rel))
+            os.chmod(self.upper._host(rel), os.stat(src).st_mode & 0o7777)
+        else:
+            shutil.copy2(src, self.upper._host(rel))
+
+    def _prepare_new(self, path) -> bool:
+        """Готовит место под новый путь наверху; True, если он перекрывает удаленный"""
+        rel = vfs_path(path)
+        parent = rel.rpartition('/')[0]
+        if not self.is_dir(parent):
+            raise _error(errno.ENOENT, path)
+        self._copy_up_dirs(parent)
+        whiteout = self._whiteout(rel)
+        if os.path.lexists(whiteout):
+            os.unlink(whiteout)
+            return True
+        return False
+
+    def host_path(self, path) -> Optional[Path]:
+        layer = self._layer(path)
+        return layer._host(path) if layer is not None else None
+
+    def escapes_root(self, path) -> bool:
+        layer = self._layer(path)
+        return layer.escapes_root(path) if layer is not None else False
+
+    def cache_dir(self) -> Optional[Path]:
+        # Кэши сессии пишутся в ее верхний слой: нижний корень общий и не меняется
+        return self.upper.cache_dir()
+
+    def stat(self, path, follow_symlinks: bool = True) -> StatResult:
+        layer = self._layer(path)
+        if layer is None:
+            raise _error(errno.ENOENT, path)
+        return layer.stat(path, follow_symlinks)
+
+    def listdir(self, path) -> List[str]:
+        if not self.is_dir(path):
+            raise _error(errno.ENOTDIR if self.exists(path) else errno.ENOENT, path)
+        names = set()
+        hidden = set()
+        lower_visible = self._visible(vfs_parts(path))[1]
+        upper_dir = self.upper._host(path)
+        if os.path.isdir(upper_dir):
+            for name in os.listdir(upper_dir):
+                if name == OPAQUE_MARKER:
+                    lower_visible = False
+                elif name.startswith(WHITEOUT_PREFIX):
+                    hidden.add(name[len(WHITEOUT_PREFIX):])
+                else:
+                    names.add(name)
+        if lower_visible and self.lower.is_dir(path):
+            names.update(name for name in self.lower.listdir(path) if name not in hidden)
+        return sorted(names)
+
+    def open(self, path, mode: str = 'r', encoding: Optional[str] = None):
+        kind = mode.replace('b', '').replace('t', '')
+        if kind == 'r':
+            layer = self._layer(path)
+            if layer is None:
+                raise _error(errno.ENOENT, path)
+            return layer.open(path, mode, encoding)
+        if self.is_dir(path):
+            raise _error(errno.EISDIR, path)
+        if self._layer(path) is self.lower:
+            self._copy_up(path)
+        elif not os.path.lexists(self.upper._host(path)):
+            if kind.startswith('r'):
+                raise _error(errno.ENOENT, path)
+            self._prepare_new(path)
+        return self.upper.open(path, mode, encoding)
+
+    def mkdir(self, path, parents: bool = False, exist_ok: bool = False) -> None:
+        rel = vfs_path(path)
+        if self.exists(rel):
+            if exist_ok and self.is_dir(rel):
+                return
+            raise _error(errno.EEXIST, path)
+        parent = rel.rpartition('/')[0]
+        if parents and not self.exists(parent):
+            self.mkdir(parent, parents=True, exist_ok=True)
+        replaced = self._prepare_new(rel)
+        os.mkdir(self.upper._host(rel))
+        if replaced:
+            # Содержимое удаленного нижнего каталога не должно проступить снова
+            open(self.upper._host(rel) / OPAQUE_MARKER, 'w').close()
+
+    def _drop(self, rel: str, in_lower: bool) -> None:
+        upper = self.upper._host(rel)
+        if os.path.isdir(upper) and not os.path.islink(upper):
+            shutil.rmtree(upper)
+        elif os.path.lexists(upper):
+            os.unlink(upper)
+        if in_lower:
+            self._copy_up_dirs(rel.rpartition('/')[0])
+            open(self._whiteout(rel), 'w').close()
+
+    def unlink(self, path) -> None:
+        rel = vfs_path(path)
+        if self._layer(rel) is None:
+            raise _error(errno.ENOENT, path)
+        if self.is_dir(rel) and not self.is_symlink(rel):
+            raise _error(errno.EISDIR, path)
+        self._drop(rel, self._in_lower(rel))
+
+    def rmdir(self, path) -> None:
+        rel = vfs_path(path)
+        if not rel:
+            raise _error(errno.EBUSY, path)
+        if not self.is_dir(rel) or self.is_symlink(rel):
+            raise _error(errno.ENOTDIR if self.exists(rel) else errno.ENOENT, path)
+        if self.listdir(rel):
+            raise _error(errno.ENOTEMPTY, path)
+        self._drop(rel, self._in_lower(rel))
+
+    def rmtree(self, path) -> None:
+        # Нижний слой закрывается одним маркером, сколько бы в нем ни было файлов
+        rel = vfs_path(path)
+        if not rel:
+            raise _error(errno.EBUSY, path)
+        if self._layer(rel) is None:
+            raise _error(errno.ENOENT, path)
+        self._drop(rel, self._in_lower(rel))
+
+    def untouched(self, path) -> bool:
+        """True, если сессия не меняла ни сам путь, ни что-либо под ним:
+        тогда нижний слой показывает его в точности"""
+        rel = vfs_path(path)
+        visible, lower_visible = self._visible(vfs_parts(rel))
+        return visible and lower_visible and not os.path.lexists(self.upper._host(rel))
+
+    def materialize(self, path) -> None:
+        """Копирует поддерево наверх целиком и делает его непрозрачным.
+
+        Нужно программам, работающим с верхним каталогом напрямую (packman).
+        """
+        rel = vfs_path(path)
+        if not self.is_dir(rel) or os.path.lexists(self.upper._host(rel) / OPAQUE_MARKER):
+            return
+        self._copy_up_dirs(rel)
+        for rel_dir, dirs, files in self.walk(rel):
+            for name in dirs + files:
+                self._copy_up(f"{rel_dir}/{name}")
+        open(self.upper._host(rel) / OPAQUE_MARKER, 'w').close()
+        # Маркеры удаления под непрозрачным каталогом больше не нужны
+        for dirpath, _, filenames in os.walk(self.upper._host(rel)):
+            for name in filenames:
+                if name.startswith(WHITEOUT_PREFIX) and name != OPAQUE_MARKER:
+                    os.unlink(os.path.join(dirpath, name))
+
+    def rename(self, src, dst) -> None:
+        src, dst = vfs_path(src), vfs_path(dst)
+        if self._layer(src) is None:
+            raise _error(errno.ENOENT, src)
+        if self.is_dir(src) and not self.is_symlink(src):
+            if self.exists(dst) and (not self.is_dir(dst) or self.listdir(dst)):
+                raise _error(errno.ENOTEMPTY, dst)
+            if (dst + '/').startswith(src + '/'):
+                raise _error(errno.EINVAL, dst)
+            # Каталог переносится вместе со смешанным содержимым
+            self.materialize(src)
+            if self.exists(dst):
+                self._drop(dst, self._in_lower(dst))
+            replaced = self._prepare_new(dst)
+            os.rename(self.upper._host(src), self.upper._host(dst))
+            if not replaced and not self._in_lower(dst):
+                os.unlink(self.upper._host(dst) / OPAQUE_MARKER)
+        else:
+            if self.is_dir(dst) and not self.is_symlink(dst):
+                raise _error(errno.EISDIR, dst)
+            self._copy_up(src)
+            self._prepare_new(dst)
+            os.replace(self.upper._host(src), self.upper._host(dst))
+        if self._in_lower(src):
+            self._copy_up_dirs(src.rpartition('/')[0])
+            open(self._whiteout(src), 'w').close()
+
+    def symlink(self, target: str, path) -> None:
+        if self.exists(path) or self.is_symlink(path):
+            raise _error(errno.EEXIST, path)
+        self._prepare_new(path)
+        os.symlink(target, self.upper._host(path))
+
+    def readlink(self, path) -> str:
+        layer = self._layer(path)
+        if layer is None:
+            raise _error(errno.ENOENT, path)
+        return layer.readlink(path)
+
+    def chmod(self, path, mode: int) -> None:
+        if self._layer(path) is None:
+            raise _error(errno.ENOENT, path)
+        self._copy_up(path)
+        self.upper.chmod(path, mode)
+
+
+_default: Optional[Storage] = None
+
+
+def set_default_storage(storage: Optional[Storage]) -> None:
+    """Хранилище, которое open_storage() отдает утилитам, запущенным внутри процесса шелла"""
+    global _default
+    _default = storage
+
+
+def open_storage(root: Optional[Path] = None, spec: Optional[str] = None) -> Storage:
+    """Хранилище корня по MASHFS_STORAGE: host (по умолчанию), memory, memory:<снимок>,
+    image:<образ> (только чтение) или overlay:<каталог сессии> (MASHFS_ROOT - общий нижний слой)"""
+    if _default is not None and root is None and spec is None:
+        return _default
+    root = Path(root if root is not None else os.environ.get('MASHFS_ROOT', 'filesfs')).absolute()
+    spec = spec or os.environ.get('MASHFS_STORAGE') or 'host'
+    if spec == 'host':
+        return HostStorage(root)
+    if spec == 'memory':
+        return MemoryStorage.from_snapshot(root)
+    if spec.startswith('memory:'):
+        return MemoryStorage.from_snapshot(Path(spec[len('memory:'):]).expanduser())
+    if spec.startswith('image:'):
+        from mashfs.image import ImageStorage
+        return ImageStorage(Path(spec[len('image:'):]).expanduser())
+    if spec.startswith('overlay:'):
+        return OverlayStorage(root, Path(spec[len('overlay:'):]).expanduser().absolute())
+    raise ValueError(f"Неизвестное хранилище: {spec} (ожидалось host, memory[:<снимок>], image:<образ> или overlay:<каталог>)")
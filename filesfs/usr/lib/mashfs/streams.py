@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import os
+import sys
+import mmap
+import stat
+from typing import BinaryIO, Iterator, Optional
+
+from mashfs.storage import Storage
+
+# Общие части потоковых утилит (cat, head, tail, wc, grep): файлы читаются
+# блоками или через mmap, поэтому память не зависит от размера файла.
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def resolve(arg: str, cwd: str) -> str:
+    """Путь аргумента внутри MashFS: абсолютный - от корня, иначе от MASHFS_CWD"""
+    return arg if arg.startswith('/') else f"{cwd}/{arg}"
+
+
+def stdout() -> BinaryIO:
+    """Байтовый stdout; текст, уже выведенный через print, сбрасывается первым"""
+    sys.stdout.flush()
+    return sys.stdout.buffer
+
+
+class MappedFile:
+    """Файл, отображенный в память: data - memoryview ровно на его байты.
+
+    data годится для re и срезов, find/rfind работают прямо по mmap
+    (хоста или образа mashsys pack) без копирования файла.
+    """
+
+    def __init__(self, buffer: Optional[mmap.mmap], offset: int, size: int, owned: bool):
+        self.buffer = buffer
+        self.offset = offset
+        self.size = size
+        self.owned = owned
+        self.data = memoryview(buffer)[offset:offset + size] if buffer is not None else memoryview(b'')
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __enter__(self) -> 'MappedFile':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.data.release()
+        if self.owned and self.buffer is not None:
+            self.buffer.close()
+
+    def find(self, sub: bytes, start: int = 0, end: Optional[int] = None) -> int:
+        if self.buffer is None:
+            return -1
+        end = self.size if end is None else end
+        pos = self.buffer.find(sub, self.offset + start, self.offset + end)
+        return pos - self.offset if pos != -1 else -1
+
+    def rfind(self, sub: bytes, start: int = 0, end: Optional[int] = None) -> int:
+        if self.buffer is None:
+            return -1
+        end = self.size if end is None else end
+        pos = self.buffer.rfind(sub, self.offset + start, self.offset + end)
+        return pos - self.offset if pos != -1 else -1
+
+    def chunks(self, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        end = self.size if end is None else end
+        for pos in range(start, end, CHUNK_SIZE):
+            yield self.data[pos:min(pos + CHUNK_SIZE, end)].tobytes()
+
+
+def open_mapped(fs: Storage, path: str) -> Optional[MappedFile]:
+    """mmap файла на диске или несжатого файла образа; None, если отобразить нельзя
+    (корень в памяти, сжатый образ) - тогда файл читается блоками"""
+    host = fs.host_path(path) if fs.on_disk else None
+    if host is not None:
+        with open(host, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return MappedFile(None, 0, 0, owned=False)
+            return MappedFile(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), 0, size, owned=True)
+    mapping = getattr(fs, 'mapping', None)
+    if mapping is not None:
+        found = mapping(path)
+        if found is not None:
+            return MappedFile(found[0], found[1], found[2], owned=False)
+    return None
+
+
+def read_chunks(fs: Storage, path: str) -> Iterator[bytes]:
+    """Содержимое файла блоками по CHUNK_SIZE"""
+    mapped = open_mapped(fs, path)
+    if mapped is not None:
+        with mapped:
+            yield from mapped.chunks()
+        return
+    with fs.open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def read_line_blocks(fs: Storage, path: str) -> Iterator[bytes]:
+    """Содержимое файла блоками около CHUNK_SIZE, разрезанными по концам строк:
+    строка целиком попадает в один блок"""
+    mapped = open_mapped(fs, path)
+    if mapped is not None:
+        with mapped:
+            pos, size = 0, len(mapped)
+            while pos < size:
+                end = min(pos + CHUNK_SIZE, size)
+                if end < size:
+                    cut = mapped.rfind(b'\n', pos, end)
+                    if cut == -1:
+                        # Строка длиннее блока: ищем ее конец вперед
+                        cut = mapped.find(b'\n', end)
+                    end = size if cut == -1 else cut + 1
+                yield mapped.data[pos:end].tobytes()
+                pos = end
+        return
+    carry = b''
+    with fs.open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk = carry + chunk
+            cut = chunk.rfind(b'\n') + 1
+            carry = chunk[cut:]
+            if cut:
+                yield chunk[:cut]
+    if carry:
+        yield carry
+
+
+def _sendfile_target(out: BinaryIO) -> Optional[int]:
+    # sendfile только в обычный файл или канал: терминалу данные отдаются блоками
+    try:
+        fd = out.fileno()
+        mode = os.fstat(fd).st_mode
+    except (OSError, ValueError, AttributeError):
+        return None
+    return fd if stat.S_ISREG(mode) or stat.S_ISFIFO(mode) else None
+
+
+def copy_file(fs: Storage, path: str, out: BinaryIO) -> None:
+    """Копирует файл в out: os.sendfile, если можно, иначе блоками"""
+    host = fs.host_path(path) if fs.on_disk else None
+    out_fd = _sendfile_target(out) if host is not None and hasattr(os, 'sendfile') else None
+    if out_fd is not None:
+        out.flush()
+        with open(host, 'rb') as f:
+            offset, size = 0, os.fstat(f.fileno()).st_size
+            try:
+                while offset < size:
+                    sent = os.sendfile(out_fd, f.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return
+            except OSError:
+                # Файловая система не умеет sendfile - дописываем остаток блоками
+                f.seek(offset)
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    out.write(chunk)
+    for chunk in read_chunks(fs, path):
+        out.write(chunk)
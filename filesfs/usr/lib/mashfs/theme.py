@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+import os
+import re
+import marshal
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+RESET = '\x1b[0m'
+CACHE_VERSION = 2
+DEFAULT_PROMPT = "\x1b[1;32m%s\x1b[0m@\x1b[1;34m%s\x1b[0m:\x1b[1;36m%s\x1b[0m$ "
+DEFAULT_COLORS = {
+    'error': ("\x1b[1;31m", RESET),
+    'success': ("\x1b[1;32m", RESET),
+    'info': ("\x1b[1;36m", RESET),
+    'warning': ("\x1b[1;33m", RESET),
+}
+
+COLOR_NAMES = ['black', 'red', 'green', 'yellow', 'blue', 'magenta', 'cyan', 'white']
+ATTRIBUTES = {'bold': 1, 'dim': 2, 'italic': 3, 'underline': 4, 'blink': 5, 'reverse': 7, 'strike': 9}
+
+
+@dataclass
+class Theme:
+    """Скомпилированная тема: готовые ANSI-обрамления и стили rich для каждой роли"""
+    name: str
+    prompt: str = DEFAULT_PROMPT
+    ansi: Dict[str, Tuple[str, str]] = field(default_factory=lambda: dict(DEFAULT_COLORS))
+    styles: Dict[str, str] = field(default_factory=dict)
+
+    def paint(self, role: str, text: str) -> str:
+        prefix, suffix = self.ansi.get(role, ('', ''))
+        return f"{prefix}{text}{suffix}"
+
+    def style(self, role: str, default: str = '') -> str:
+        return self.styles.get(role, default)
+
+    def sgr(self, role: str) -> str:
+        """Параметры SGR роли без ESC[ и m (для MASHFS_COLOR_* в .mashrc)"""
+        prefix = self.ansi.get(role, ('', ''))[0]
+        return ';'.join(re.findall(r'\x1b\[([0-9;]*)m', prefix))
+
+
+def _color_sgr(name: str, background: bool) -> List[str]:
+    base = 40 if background else 30
+    if name.startswith('#') and len(name) == 7:
+        try:
+            r, g, b = (int(name[i:i + 2], 16) for i in (1, 3, 5))
+        except ValueError:
+            return []
+        return [str(base + 8), '2', str(r), str(g), str(b)]
+    if name.startswith('bright_') and name[7:] in COLOR_NAMES:
+        return [str(base + 60 + COLOR_NAMES.index(name[7:]))]
+    if name in COLOR_NAMES:
+        return [str(base + COLOR_NAMES.index(name))]
+    return []
+
+
+def style_to_ansi(style: str) -> str:
+    """Стиль rich ("bold cyan", "#ff00ff on black", "dim") -> префикс ESC[...m"""
+    codes: List[str] = []
+    words = style.lower().split()
+    i = 0
+    while i < len(words):
+        word = words[i]
+        if word == 'on' and i + 1 < len(words):
+            codes += _color_sgr(words[i + 1], background=True)
+            i += 2
+            continue
+        if word in ATTRIBUTES:
+            codes.append(str(ATTRIBUTES[word]))
+        else:
+            codes += _color_sgr(word, background=False)
+        i += 1
+    return f"\x1b[{';'.join(codes)}m" if codes else ''
+
+
+def ansi_to_style(prefix: str) -> str:
+    """Обратное преобразование для ролей, заданных ANSI-строками в etc/theme.yml"""
+    names = {code: name for name, code in ATTRIBUTES.items()}
+    words = []
+    for params in re.findall(r'\x1b\[([0-9;]*)m', prefix):
+        for code in (int(c) for c in params.split(';') if c.isdigit()):
+            if code in names:
+                words.append(names[code])
+            elif 30 <= code <= 37:
+                words.append(COLOR_NAMES[code - 30])
+            elif 90 <= code <= 97:
+                words.append('bright_' + COLOR_NAMES[code - 90])
+            elif 40 <= code <= 47:
+                words += ['on', COLOR_NAMES[code - 40]]
+    return ' '.join(words)
+
+
+# Файлы темы (пути от корня)
+THEME_YML = 'etc/theme.yml'
+THEMES_DIR = 'etc/omm/themes'
+CURRENT_THEME = 'etc/omm/current_theme'
+
+
+def themes_dir(root: Path) -> Path:
+    return Path(root) / THEMES_DIR
+
+
+def current_theme_file(root: Path) -> Path:
+    return Path(root) / CURRENT_THEME
+
+
+def _fs(root: Path, storage):
+    # Без хранилища сессии тема читается прямо с диска корня
+    if storage is not None:
+        return storage
+    from mashfs.storage import HostStorage
+    return HostStorage(root)
+
+
+def active_theme_name(root: Path, storage=None) -> str:
+    """etc/omm/current_theme (пишет omm theme), иначе MASHFS_THEME, иначе system.theme"""
+    try:
+        name = _fs(root, storage).read_text(CURRENT_THEME).strip()
+        if name:
+            return name
+    except OSError:
+        pass
+    if os.environ.get('MASHFS_THEME'):
+        return os.environ['MASHFS_THEME']
+    # Конфиг (и PyYAML) нужен только при сборке темы: шелл из снимка запуска его не грузит
+    from mashfs.config import load_config
+    return load_config(root, storage).system.theme
+
+
+def list_theme_names(root: Path, storage=None) -> List[str]:
+    try:
+        names = _fs(root, storage).listdir(THEMES_DIR)
+    except OSError:
+        return []
+    return sorted(name[:-len('.theme')] for name in names if name.endswith('.theme'))
+
+
+def _read_theme_file(fs, rel: str) -> Dict[str, str]:
+    colors = {}
+    with fs.open(rel) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            colors[key.strip()] = value.strip()
+    return colors
+
+
+def compile_theme(root: Path, name: str, storage=None) -> Theme:
+    """Собирает тему: ANSI-строки из etc/theme.yml, поверх них цвета etc/omm/themes/<name>.theme"""
+    from mashfs.config import load_yaml
+    root = Path(root)
+    fs = _fs(root, storage)
+    theme = Theme(name=name)
+    try:
+        data = load_yaml(THEME_YML, root, fs) or {}
+    except Exception:
+        data = {}
+    for section in ('colors', 'styles'):
+        for role, value in (data.get(section) or {}).items():
+            value = str(value).replace('\\033', '\x1b').replace('\\e', '\x1b')
+            if role == 'prompt':
+                if value.count('%s') == 3:
+                    theme.prompt = value
+                continue
+            prefix, _, suffix = value.partition('%s')
+            theme.ansi[role] = (prefix, suffix)
+            theme.styles[role] = ansi_to_style(prefix)
+
+    try:
+        colors = _read_theme_file(fs, f"{THEMES_DIR}/{name}.theme")
+    except OSError:
+        colors = {}
+    for role, style in colors.items():
+        theme.styles[role] = style
+        prefix = style_to_ansi(style)
+        if prefix:
+            theme.ansi[role] = (prefix, RESET)
+    if 'prompt' in colors:
+        prompt, path = theme.ansi.get('prompt', ('', '')), theme.ansi.get('path', ('', ''))
+        theme.prompt = f"{prompt[0]}%s@%s{prompt[1]}:{path[0]}%s{path[1]}$ "
+    return theme
+
+
+def _stamp(fs, rel: str) -> Tuple[str, int, int]:
+    try:
+        st = fs.stat(rel)
+        return (rel, st.st_mtime_ns, st.st_size)
+    except OSError:
+        return (rel, -1, -1)
+
+
+class ThemeEngine:
+    """Активная тема с горячей перезагрузкой.
+
+    Скомпилированная тема хранится в var/cache/mashfs/theme.cache вместе
+    с (mtime, размер) исходных файлов. reload_if_changed() делает только
+    stat() этих файлов и пересобирает тему, когда они изменились
+    (например, после omm theme в соседнем терминале). Файлы читаются через
+    storage; если у него нет кэша на диске, скомпилированные темы остаются
+    в памяти движка.
+    """
+
+    def __init__(self, root: Path, name: Optional[str] = None, storage=None):
+        self.root = Path(root)
+        self.fixed_name = name
+        self.fs = _fs(self.root, storage)
+        cache_dir = self.fs.cache_dir()
+        self.cache_file = cache_dir / 'theme.cache' if cache_dir is not None else None
+        self._memory_cache: Dict = {}
+        self.stamps = None
+        self.theme = None
+        self.reload_if_changed()
+
+    def _current_stamps(self, name: str) -> List[Tuple[str, int, int]]:
+        sources = [THEME_YML, f"{THEMES_DIR}/{name}.theme"]
+        if self.fixed_name is None:
+            sources.append(CURRENT_THEME)
+        return [_stamp(self.fs, rel) for rel in sources]
+
+    def _read_cache(self) -> Dict:
+        if self.cache_file is None:
+            return self._memory_cache
+        try:
+            with open(self.cache_file, 'rb') as f:
+                data = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return {}
+        return data if isinstance(data, dict) and data.get('version') == CACHE_VERSION else {}
+
+    def _write_cache(self, cache: Dict) -> None:
+        if self.cache_file is None:
+            self._memory_cache = cache
+            return
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_file.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp, 'wb') as f:
+                marshal.dump(cache, f)
+            os.replace(tmp, self.cache_file)
+        except OSError:
+            pass
+
+    def reload_if_changed(self) -> bool:
+        """Перечитывает тему, если изменились ее файлы; True, если тема сменилась"""
+        if self.theme is not None and self._current_stamps(self.theme.name) == self.stamps:
+            return False
+
+        name = self.fixed_name or active_theme_name(self.root, self.fs)
+        stamps = self._current_stamps(name)
+        cache = self._read_cache()
+        entry = cache.get('themes', {}).get(name)
+        if entry is not None and [tuple(s) for s in entry['stamps']] == stamps[:2]:
+            theme = Theme(name=name, prompt=entry['prompt'],
+                          ansi={role: tuple(pair) for role, pair in entry['ansi'].items()},
+                          styles=entry['styles'])
+        else:
+            theme = compile_theme(self.root, name, self.fs)
+            cache.setdefault('themes', {})[name] = {
+                'stamps': stamps[:2],
+                'prompt': theme.prompt,
+                'ansi': theme.ansi,
+                'styles': theme.styles,
+            }
+            cache['version'] = CACHE_VERSION
+            self._write_cache(cache)
+
+        self.stamps = stamps
+        changed = self.theme is not None and self.theme != theme
+        self.theme = theme
+        return changed
+
+
+def load_theme(root: Path, name: Optional[str] = None, storage=None) -> Theme:
+    """Активная (или названная) тема из кэша; компилируется, только если ее файлы изменились"""
+    return ThemeEngine(root, name, storage).theme
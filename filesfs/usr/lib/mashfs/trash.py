@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import subprocess
+from pathlib import Path
+from dataclasses import dataclass
+from typing import List, Optional
+
+from mashfs.storage import Storage, open_storage, vfs_path
+
+# Корзина rm -r: каталог переносится в нее одним rename, а удаляется
+# в фоне отдельным процессом (mashfs.trash purge), так что rm не ждет rmtree.
+
+TRASH_DIR = 'var/trash'
+
+
+class TrashError(Exception):
+    pass
+
+
+@dataclass
+class TrashEntry:
+    id: str
+    # Исходный путь от корня MashFS
+    path: str
+    deleted_at: float
+    is_dir: bool
+    # Байт в записи; считает фоновая очистка, до нее None
+    size: Optional[int] = None
+
+
+class Trash:
+    """Корзина пользователя: var/trash/<user>/files - удаленное, info - откуда и когда,
+    purging - то, что уже выброшено и ждет фоновой очистки"""
+
+    def __init__(self, fs: Storage, user: str):
+        self.fs = fs
+        self.user = user
+        self.base = f"{TRASH_DIR}/{user}"
+
+    @property
+    def supported(self) -> bool:
+        # В overlay rename каталога нижнего слоя - это копирование вверх, а удаление -
+        # дешевый whiteout; образ только для чтения
+        return self.fs.name in ('host', 'memory')
+
+    @staticmethod
+    def covers(path) -> bool:
+        """True, если путь - корзина или лежит внутри нее, либо содержит ее:
+        такое удаляется сразу, а не переносится в корзину"""
+        rel = vfs_path(path)
+        return (rel + '/').startswith(TRASH_DIR + '/') or (TRASH_DIR + '/').startswith(rel + '/')
+
+    def _prepare(self) -> None:
+        for sub in ('files', 'info', 'purging'):
+            self.fs.mkdir(f"{self.base}/{sub}", parents=True, exist_ok=True)
+
+    def _write_info(self, entry: TrashEntry) -> None:
+        data = {'path': entry.path, 'deleted_at': entry.deleted_at, 'dir': entry.is_dir, 'size': entry.size}
+        tmp = f"{self.base}/info/.{entry.id}.{os.getpid()}.tmp"
+        self.fs.write_text(tmp, json.dumps(data, ensure_ascii=False))
+        self.fs.rename(tmp, f"{self.base}/info/{entry.id}.json")
+
+    def put(self, path) -> TrashEntry:
+        """Переносит путь в корзину одним rename"""
+        path = vfs_path(path)
+        self._prepare()
+        stamp = time.time_ns()
+        name = path.rpartition('/')[2]
+        while True:
+            entry_id = f"{stamp:x}-{name}"
+            if not self.fs.exists(f"{self.base}/info/{entry_id}.json"):
+                break
+            stamp += 1
+        is_dir = self.fs.is_dir(path) and not self.fs.is_symlink(path)
+        entry = TrashEntry(entry_id, path, stamp / 1e9, is_dir)
+        # Сначала описание: запись без файла безвредна, файл без описания не восстановить
+        self._write_info(entry)
+        try:
+            self.fs.rename(path, f"{self.base}/files/{entry_id}")
+        except OSError:
+            self.fs.unlink(f"{self.base}/info/{entry_id}.json")
+            raise
+        return entry
+
+    def entries(self) -> List[TrashEntry]:
+        """Записи корзины от старых к новым"""
+        try:
+            names = self.fs.listdir(f"{self.base}/info")
+        except OSError:
+            return []
+        result = []
+        for name in names:
+            if not name.endswith('.json') or name.startswith('.'):
+                continue
+            entry_id = name[:-len('.json')]
+            try:
+                data = json.loads(self.fs.read_text(f"{self.base}/info/{name}"))
+                entry = TrashEntry(entry_id, data['path'], float(data['deleted_at']), bool(data['dir']), data.get('size'))
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            if self.fs.exists(f"{self.base}/files/{entry_id}") or self.fs.is_symlink(f"{self.base}/files/{entry_id}"):
+                result.append(entry)
+        return sorted(result, key=lambda entry: entry.deleted_at)
+
+    def find(self, key: str) -> TrashEntry:
+        """Запись по id или по исходному пути (самая свежая из удаленных по нему)"""
+        entries = self.entries()
+        for entry in entries:
+            if entry.id == key:
+                return entry
+        for entry in reversed(entries):
+            if entry.path == vfs_path(key):
+                return entry
+        raise TrashError(f"в корзине нет {key}")
+
+    def restore(self, entry: TrashEntry, dest: Optional[str] = None) -> str:
+        """Возвращает запись на место (или в dest); существующее не перезаписывается"""
+        dest = vfs_path(dest if dest is not None else entry.path)
+        if self.fs.exists(dest) or self.fs.is_symlink(dest):
+            raise TrashError(f"/{dest} уже существует")
+        parent = dest.rpartition('/')[0]
+        if parent:
+            self.fs.mkdir(parent, parents=True, exist_ok=True)
+        self.fs.rename(f"{self.base}/files/{entry.id}", dest)
+        self.fs.unlink(f"{self.base}/info/{entry.id}.json")
+        return dest
+
+    def discard(self, entry: TrashEntry) -> None:
+        """Выбрасывает запись: она сразу пропадает из корзины, удаляет ее очистка"""
+        self._prepare()
+        self.fs.rename(f"{self.base}/files/{entry.id}", f"{self.base}/purging/{entry.id}")
+        self.fs.unlink(f"{self.base}/info/{entry.id}.json")
+
+    def empty(self) -> int:
+        entries = self.entries()
+        for entry in entries:
+            self.discard(entry)
+        return len(entries)
+
+    def _remove(self, path: str) -> None:
+        if self.fs.is_dir(path) and not self.fs.is_symlink(path):
+            self.fs.rmtree(path)
+        else:
+            self.fs.unlink(path)
+
+    def _size(self, path: str) -> int:
+        if not self.fs.is_dir(path) or self.fs.is_symlink(path):
+            return self.fs.lstat(path).st_size
+        total = 0
+        for rel_dir, _, files in self.fs.walk(path):
+            for name in files:
+                try:
+                    total += self.fs.lstat(f"{rel_dir}/{name}").st_size
+                except OSError:
+                    pass
+        return total
+
+    def purge(self, max_age_days: int, max_size_mb: int, now: Optional[float] = None) -> int:
+        """Удаляет выброшенное, затем записи старше max_age_days и самые старые,
+        пока корзина больше max_size_mb (0 - без ограничения). Возвращает число записей"""
+        removed = 0
+        try:
+            purging = self.fs.listdir(f"{self.base}/purging")
+        except OSError:
+            purging = []
+        for name in purging:
+            self._remove(f"{self.base}/purging/{name}")
+            removed += 1
+
+        now = time.time() if now is None else now
+        entries = self.entries()
+        kept = []
+        for entry in entries:
+            if max_age_days and now - entry.deleted_at > max_age_days * 86400:
+                self.discard(entry)
+                self._remove(f"{self.base}/purging/{entry.id}")
+                removed += 1
+                continue
+            if entry.size is None:
+                entry.size = self._size(f"{self.base}/files/{entry.id}")
+                self._write_info(entry)
+            kept.append(entry)
+
+        total = sum(entry.size for entry in kept)
+        limit = max_size_mb * 1024 * 1024
+        for entry in kept:
+            if not max_size_mb or total <= limit:
+                break
+            self.discard(entry)
+            self._remove(f"{self.base}/purging/{entry.id}")
+            total -= entry.size
+            removed += 1
+        return removed
+
+
+def purge_in_background(trash: Trash) -> None:
+    """Запускает очистку корзины: на диске - отдельным процессом, который переживет
+    утилиту; в памяти удаление - это снятие узлов, оно делается сразу"""
+    if not trash.fs.on_disk:
+        purge_now(trash)
+        return
+    lib_dir = str(Path(__file__).absolute().parents[1])
+    env = dict(os.environ, MASHFS_ROOT=str(trash.fs.root), MASHFS_STORAGE='host',
+               PYTHONPATH=os.pathsep.join(filter(None, [lib_dir, os.environ.get('PYTHONPATH')])))
+    try:
+        subprocess.Popen([sys.executable, '-m', 'mashfs.trash', 'purge', trash.user], env=env,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+    except OSError:
+        # Не запустилось - выброшенное удалит следующая очистка
+        pass
+
+
+def purge_now(trash: Trash, wait: bool = True) -> int:
+    """Очистка по политике trash из etc/config.yml. На диске идет под flock:
+    без wait, если очистка уже идет, сразу возвращает 0"""
+    from mashfs.config import load_config
+    policy = load_config(getattr(trash.fs, 'root', None), trash.fs).trash
+    lock_file = trash.fs.host_path(f"{trash.base}/.purge.lock") if trash.fs.on_disk else None
+    if lock_file is None:
+        return trash.purge(policy.max_age_days, policy.max_size_mb)
+    import fcntl
+    trash._prepare()
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return 0
+        removed = 0
+        while True:
+            # rm, который выбросил что-то во время очистки, застал блокировку занятой
+            step = trash.purge(policy.max_age_days, policy.max_size_mb)
+            if not step:
+                return removed
+            removed += step
+    finally:
+        os.close(fd)
+
+
+def main() -> int:
+    if len(sys.argv) != 3 or sys.argv[1] != 'purge':
+        print("Usage: python -m mashfs.trash purge <user>")
+        return 1
+    try:
+        purge_now(Trash(open_storage(), sys.argv[2]), wait=False)
+    except OSError:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+import os
+import stat
+import time
+import errno
+import select
+import struct
+import ctypes
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from mashfs.storage import Storage, vfs_path
+
+# Лента изменений корня: inotify через ctypes (Linux, корень на диске),
+# иначе опрос stat через хранилище. Шелл по событиям помечает кэши
+# устаревшими, команда watch печатает события как есть.
+
+CREATED, MODIFIED, DELETED = 'created', 'modified', 'deleted'
+# Очередь inotify переполнилась: изменилось неизвестно что
+OVERFLOW = 'overflow'
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT_HEADER = struct.Struct('iIII')
+
+# После пробуждения inotify ждет хвост пачки: MODIFY и CLOSE_WRITE одной записи
+# приходят порознь и без паузы печатались бы дважды
+COALESCE_DELAY = 0.05
+# Опрос: не чаще раза в столько секунд (каждый опрос - stat всех путей)
+POLL_INTERVAL = 1.0
+
+
+class ChangeEvent(NamedTuple):
+    # Путь от корня MashFS; для OVERFLOW - пустой
+    path: str
+    kind: str
+    is_dir: bool
+
+
+class WatchError(Exception):
+    pass
+
+
+def _kind(mask: int) -> str:
+    if mask & (IN_CREATE | IN_MOVED_TO):
+        return CREATED
+    if mask & (IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF | IN_MOVE_SELF):
+        return DELETED
+    return MODIFIED
+
+
+def _unique(events: Iterable[ChangeEvent]) -> List[ChangeEvent]:
+    # write() кусками дает пачку одинаковых MODIFY: оставляем по одному
+    return list(dict.fromkeys(events))
+
+
+class InotifyWatcher:
+    """Каталоги корня на диске под inotify, рекурсивно: новые подкаталоги
+    получают наблюдение сразу по событию создания"""
+
+    backend = 'inotify'
+
+    def __init__(self, fs: Storage, paths: Iterable[str]):
+        try:
+            # libc уже загружена в интерпретатор: ctypes.util.find_library
+            # запускал бы ldconfig на каждом старте шелла
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise WatchError(f"inotify недоступен: {e}")
+        self.fs = fs
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError(f"inotify_init1: {os.strerror(ctypes.get_errno())}")
+        self.dirs: Dict[int, str] = {}
+        self.trees: List[str] = []
+        # Отдельные файлы (watch etc/passwd) наблюдаются через свой каталог
+        self.files: List[str] = []
+        try:
+            for path in paths:
+                rel = vfs_path(path)
+                if fs.is_dir(rel) and not fs.is_symlink(rel):
+                    self.trees.append(rel)
+                    self._add_tree(rel)
+                elif fs.exists(rel) or fs.is_symlink(rel):
+                    self.files.append(rel)
+                    self._add(rel.rpartition('/')[0])
+                else:
+                    raise WatchError(f"/{rel}: No such file or directory")
+        except BaseException:
+            self.close()
+            raise
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def _add(self, rel: str) -> None:
+        host = self.fs.host_path(rel)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(host), WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code in (errno.ENOENT, errno.ENOTDIR):
+                # Каталог исчез между listdir и add_watch
+                return
+            raise WatchError(f"inotify_add_watch /{rel}: {os.strerror(code)}"
+                             + (" (увеличьте fs.inotify.max_user_watches)" if code == errno.ENOSPC else ""))
+        self.dirs[wd] = rel
+
+    def _add_tree(self, rel: str) -> List[ChangeEvent]:
+        """Наблюдение за каталогом и всеми подкаталогами; возвращает то, что уже
+        лежит внутри: созданное до add_watch своих событий не даст"""
+        found = []
+        for rel_dir, dirs, files in self.fs.walk(rel):
+            self._add(rel_dir)
+            prefix = f"{rel_dir}/" if rel_dir else ''
+            found += [ChangeEvent(prefix + name, CREATED, True) for name in dirs]
+            found += [ChangeEvent(prefix + name, CREATED, False) for name in files]
+        return found
+
+    def _in_tree(self, rel: str) -> bool:
+        return any(not tree or rel == tree or rel.startswith(tree + '/') for tree in self.trees)
+
+    def _wanted(self, rel: str) -> bool:
+        # Каталог файла наблюдается только ради него: соседи не нужны
+        return rel in self.files or self._in_tree(rel)
+
+    def events(self) -> List[ChangeEvent]:
+        """Накопившиеся события, без ожидания"""
+        result = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    result.append(ChangeEvent('', OVERFLOW, False))
+                    continue
+                parent = self.dirs.get(wd)
+                if parent is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.dirs[wd]
+                    continue
+                if name:
+                    decoded = os.fsdecode(name)
+                    rel = f"{parent}/{decoded}" if parent else decoded
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF) and parent in self.trees:
+                    rel = parent
+                    mask |= IN_ISDIR
+                else:
+                    # Остальные события самого каталога дублируют события в родителе
+                    continue
+                is_dir = bool(mask & IN_ISDIR)
+                if self._wanted(rel):
+                    result.append(ChangeEvent(rel, _kind(mask), is_dir))
+                if is_dir and mask & (IN_CREATE | IN_MOVED_TO) and self._in_tree(rel):
+                    result += self._add_tree(rel)
+        return _unique(result)
+
+    def wait(self, timeout: Optional[float] = None) -> List[ChangeEvent]:
+        """События, дождавшись первого не дольше timeout секунд"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        time.sleep(COALESCE_DELAY)
+        return self.events()
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    """Тот же интерфейс опросом stat через хранилище: без inotify и для корня в памяти"""
+
+    backend = 'polling'
+
+    def __init__(self, fs: Storage, paths: Iterable[str], interval: float = POLL_INTERVAL):
+        self.fs = fs
+        self.paths = [vfs_path(path) for path in paths]
+        self.interval = interval
+        for rel in self.paths:
+            if not fs.exists(rel) and not fs.is_symlink(rel):
+                raise WatchError(f"/{rel}: No such file or directory")
+        self.snapshot = self._scan()
+        self.polled_at = time.monotonic()
+
+    def fileno(self) -> Optional[int]:
+        return None
+
+    def _scan(self) -> Dict[str, Tuple[bool, int, int, int]]:
+        snapshot = {}
+        for top in self.paths:
+            try:
+                st = self.fs.lstat(top)
+            except OSError:
+                continue
+            snapshot[top] = (stat.S_ISDIR(st.st_mode), st.st_mtime_ns, st.st_size, st.st_ino)
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            for rel_dir, dirs, files in self.fs.walk(top):
+                for name in dirs + files:
+                    rel = f"{rel_dir}/{name}" if rel_dir else name
+                    try:
+                        st = self.fs.lstat(rel)
+                    except OSError:
+                        continue
+                    snapshot[rel] = (stat.S_ISDIR(st.st_mode), st.st_mtime_ns, st.st_size, st.st_ino)
+        return snapshot
+
+    def events(self) -> List[ChangeEvent]:
+        if time.monotonic() - self.polled_at < self.interval:
+            return []
+        current = self._scan()
+        self.polled_at = time.monotonic()
+        result = []
+        for rel, state in current.items():
+            old = self.snapshot.get(rel)
+            if old is None or old[0] != state[0] or old[3] != state[3]:
+                # Замена через rename меняет inode: это новое создание, как у inotify
+                result.append(ChangeEvent(rel, CREATED, state[0]))
+            elif old != state and not state[0]:
+                result.append(ChangeEvent(rel, MODIFIED, False))
+        result += [ChangeEvent(rel, DELETED, state[0]) for rel, state in self.snapshot.items() if rel not in current]
+        self.snapshot = current
+        return result
+
+    def wait(self, timeout: Optional[float] = None) -> List[ChangeEvent]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            pause = self.interval - (time.monotonic() - self.polled_at)
+            if deadline is not None:
+                pause = min(pause, deadline - time.monotonic())
+            if pause > 0:
+                time.sleep(pause)
+            found = self.events()
+            if found or (deadline is not None and time.monotonic() >= deadline):
+                return found
+
+    def close(self) -> None:
+        self.snapshot = {}
+
+
+def open_watcher(fs: Storage, paths: Iterable[str], polling: bool = False):
+    """Наблюдатель за путями корня: inotify, если корень на диске и ядро его дает,
+    иначе опрос. Несуществующий путь - WatchError"""
+    paths = list(paths)
+    if not polling and fs.name == 'host':
+        try:
+            return InotifyWatcher(fs, paths)
+        except WatchError as e:
+            if 'No such file' in str(e):
+                raise
+    return PollingWatcher(fs, paths)
+
+
+class ChangeFeed:
+    """Подписки на изменения: событие под префиксом помечает ключ устаревшим,
+    а перечитывает данные тот, кто их использует (stale/take)"""
+
+    def __init__(self, watcher, subscriptions: Dict[str, Iterable[str]]):
+        self.watcher = watcher
+        self.subscriptions = {key: [vfs_path(prefix) for prefix in prefixes] for key, prefixes in subscriptions.items()}
+        self.pending = set()
+
+    def poll(self) -> None:
+        if self.watcher is None:
+            return
+        for event in self.watcher.events():
+            if event.kind == OVERFLOW:
+                self.pending.update(self.subscriptions)
+                continue
+            for key, prefixes in self.subscriptions.items():
+                if any(event.path == prefix or event.path.startswith(prefix + '/') for prefix in prefixes):
+                    self.pending.add(key)
+
+    def take(self, key: str) -> bool:
+        """True один раз после изменения данных ключа"""
+        if key in self.pending:
+            self.pending.discard(key)
+            return True
+        return False
+
+    def close(self) -> None:
+        if self.watcher is not None:
+            self.watcher.close()
@@ -0,0 +1,48 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'filesfs' / 'usr' / 'lib'))
+
+from mashfs.config import load_config  # noqa: E402
+from mashfs.storage import MemoryStorage, OverlayStorage  # noqa: E402
+from mashfs.theme import ThemeEngine  # noqa: E402
+
+
+def _seed(root):
+    (root / 'etc' / 'omm' / 'themes').mkdir(parents=True)
+    (root / 'etc' / 'config.yml').write_text('system:\n  hostname: disk\n  theme: plain\n')
+    (root / 'etc' / 'omm' / 'themes' / 'plain.theme').write_text('error = red\n')
+    (root / 'etc' / 'omm' / 'themes' / 'loud.theme').write_text('error = bold magenta\n')
+    return root
+
+
+def test_memory_session_reads_its_own_config(tmp_path):
+    root = _seed(tmp_path / 'root')
+    fs = MemoryStorage.from_snapshot(root)
+    fs.write_text('etc/config.yml', 'system:\n  hostname: session\n')
+    assert load_config(root, fs).system.hostname == 'session'
+    assert not (root / 'var').exists()
+    assert load_config(root).system.hostname == 'disk'
+
+
+def test_memory_session_theme_stays_in_memory(tmp_path):
+    root = _seed(tmp_path / 'root')
+    fs = MemoryStorage.from_snapshot(root)
+    engine = ThemeEngine(root, storage=fs)
+    assert engine.theme.name == 'plain' and engine.theme.style('error') == 'red'
+
+    fs.write_text('etc/omm/current_theme', 'loud\n')
+    assert engine.reload_if_changed()
+    assert engine.theme.style('error') == 'bold magenta'
+    assert not (root / 'etc' / 'omm' / 'current_theme').exists()
+    assert not (root / 'var').exists()
+
+
+def test_overlay_caches_go_to_the_session(tmp_path):
+    root = _seed(tmp_path / 'root')
+    fs = OverlayStorage(root, tmp_path / 'upper')
+    assert load_config(root, fs).system.hostname == 'disk'
+    assert ThemeEngine(root, storage=fs).theme.name == 'plain'
+    assert not (root / 'var').exists()
+    assert sorted(p.name for p in (tmp_path / 'upper' / 'var' / 'cache' / 'mashfs').iterdir()) == \
+        ['config.cache', 'theme.cache']
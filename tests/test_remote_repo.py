@@ -0,0 +1,169 @@
+import sys
+import json
+import hashlib
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'filesfs' / 'opt' / 'packman' / 'lib'))
+
+from remote_repo import ConnectionPool, RemoteRepo, RemoteRepoError  # noqa: E402
+
+ARCHIVE = bytes(range(256)) * 4096
+ETAG = '"v1"'
+
+
+class RepoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    files = {}
+    connections = 0
+    requests = []
+    # Неисправный сервер: кусок не с того места, что просили, и обрыв в конце ответа
+    range_shift = 0
+    truncate = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        type(self).requests.append((self.path, dict(self.headers)))
+        body = self.files.get(self.path.lstrip('/'))
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start = 0
+        byte_range = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if byte_range and (if_range is None or if_range == ETAG):
+            start = int(byte_range.split('=')[1].rstrip('-')) + self.range_shift
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header('ETag', ETAG)
+        body = body[:len(body) - self.truncate]
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def server():
+    RepoHandler.connections = 0
+    RepoHandler.requests = []
+    RepoHandler.range_shift = RepoHandler.truncate = 0
+    index = {'packages': {
+        'hello': {'sha256': hashlib.sha256(ARCHIVE).hexdigest(), 'size': len(ARCHIVE)},
+        'world': {'archive': 'world-1.0.tar.gz'},
+        'sized': {'archive': 'hello.tar.gz', 'size': len(ARCHIVE)},
+        'evil': {'archive': '../../bin/x'},
+        'abs': {'archive': '/etc/passwd'},
+    }}
+    RepoHandler.files = {
+        'index.json': json.dumps(index).encode(),
+        'hello.tar.gz': ARCHIVE,
+        'world-1.0.tar.gz': b'world',
+    }
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RepoHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def repo(server, tmp_path):
+    pool = ConnectionPool()
+    yield RemoteRepo('test', server, tmp_path / 'cache', pool)
+    pool.close()
+
+
+def test_keep_alive_reuses_one_connection(repo):
+    assert repo.refresh_index()
+    assert repo.fetch('hello').read_bytes() == ARCHIVE
+    assert repo.fetch('world').read_bytes() == b'world'
+    # Повторное обновление индекса - условный запрос с ответом 304
+    assert not repo.refresh_index()
+    assert RepoHandler.connections == 1
+    assert len(RepoHandler.requests) == 4
+
+
+def test_resume_with_matching_if_range(repo):
+    repo.refresh_index()
+    archive = repo.archives_dir / 'hello.tar.gz'
+    archive.parent.mkdir(parents=True)
+    archive.with_name('hello.tar.gz.part').write_bytes(ARCHIVE[:1000])
+    archive.with_name('hello.tar.gz.part.json').write_text(json.dumps({'etag': ETAG}))
+
+    assert repo.fetch('hello').read_bytes() == ARCHIVE
+    path, headers = RepoHandler.requests[-1]
+    assert headers['Range'] == 'bytes=1000-'
+    assert headers['If-Range'] == ETAG
+    assert not archive.with_name('hello.tar.gz.part').exists()
+
+
+def test_stale_if_range_restarts_download(repo):
+    repo.refresh_index()
+    archive = repo.archives_dir / 'hello.tar.gz'
+    archive.parent.mkdir(parents=True)
+    # Частичная загрузка от старой версии архива: сервер отвечает 200 и все целиком
+    archive.with_name('hello.tar.gz.part').write_bytes(b'x' * 1000)
+    archive.with_name('hello.tar.gz.part.json').write_text(json.dumps({'etag': '"old"'}))
+
+    assert repo.fetch('hello').read_bytes() == ARCHIVE
+    assert RepoHandler.requests[-1][1]['If-Range'] == '"old"'
+
+
+def test_misaligned_range_restarts_download(repo):
+    repo.refresh_index()
+    archive = repo.archives_dir / 'hello.tar.gz'
+    archive.parent.mkdir(parents=True)
+    archive.with_name('hello.tar.gz.part').write_bytes(ARCHIVE[:1000])
+    archive.with_name('hello.tar.gz.part.json').write_text(json.dumps({'etag': ETAG}))
+    RepoHandler.range_shift = 10
+
+    # У пакета в индексе только size: без проверки Content-Range кусок лег бы со сдвигом
+    assert repo.fetch('sized').read_bytes() == ARCHIVE
+    assert 'Range' not in RepoHandler.requests[-1][1]
+
+
+def test_short_download_is_not_cached(repo):
+    repo.refresh_index()
+    RepoHandler.truncate = 100
+    with pytest.raises(RemoteRepoError, match='incomplete download'):
+        repo.fetch('sized')
+    archive = repo.archives_dir / 'hello.tar.gz'
+    assert not archive.exists()
+
+    RepoHandler.truncate = 0
+    assert repo.fetch('sized').read_bytes() == ARCHIVE
+    assert RepoHandler.requests[-1][1]['Range'] == f"bytes={len(ARCHIVE) - 100}-"
+
+
+def test_cached_archive_is_not_downloaded_again(repo):
+    repo.fetch('hello')
+    count = len(RepoHandler.requests)
+    repo.fetch('hello')
+    assert len(RepoHandler.requests) == count
+
+
+@pytest.mark.parametrize('package', ['evil', 'abs'])
+def test_archive_name_cannot_escape_cache(repo, tmp_path, package):
+    with pytest.raises(RemoteRepoError, match='unsafe archive name'):
+        repo.fetch(package)
+    assert not (tmp_path / 'bin').exists()
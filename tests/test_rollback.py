@@ -0,0 +1,101 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / 'filesfs' / 'usr' / 'lib'))
+sys.path.insert(0, str(ROOT / 'filesfs' / 'opt' / 'mashsys' / 'lib'))
+
+import rollback  # noqa: E402
+from rollback import recover_swap, swap_root  # noqa: E402
+
+
+class Crash(Exception):
+    pass
+
+
+def _exchange(a, b):
+    # renameat2 есть не везде: обмен тремя переименованиями, для теста этого достаточно
+    tmp = a.with_name(a.name + '.x')
+    os.replace(a, tmp)
+    os.replace(b, a)
+    os.replace(tmp, b)
+    return True
+
+
+@pytest.fixture
+def trees(tmp_path):
+    root, staging, previous = tmp_path / 'root', tmp_path / 'staging', tmp_path / 'previous'
+    for path, text in ((root, 'old'), (staging, 'new')):
+        path.mkdir()
+        (path / 'version').write_text(text)
+    return root, staging, previous
+
+
+def _crash_at(step, monkeypatch):
+    """Ломает swap_root на шаге step, как если бы процесс упал именно там"""
+    def crash(*args, **kwargs):
+        raise Crash(step)
+
+    if step == 'exchange':
+        monkeypatch.setattr(rollback, 'exchange_paths', crash)
+    elif step == 'after-exchange':
+        monkeypatch.setattr(rollback, 'exchange_paths', _exchange)
+        monkeypatch.setattr(rollback.os, 'rename', crash)
+    elif step == 'between-renames':
+        monkeypatch.setattr(rollback, 'exchange_paths', lambda a, b: False)
+        rename = os.rename
+        calls = []
+
+        def rename_once(src, dst):
+            calls.append(src)
+            if len(calls) > 1:
+                raise Crash(step)
+            rename(src, dst)
+        monkeypatch.setattr(rollback.os, 'rename', rename_once)
+    elif step == 'journal':
+        monkeypatch.setattr(rollback, 'exchange_paths', _exchange)
+        monkeypatch.setattr(Path, 'unlink', crash)
+
+
+@pytest.mark.parametrize('step, swapped', [
+    ('exchange', False),
+    ('after-exchange', True),
+    ('between-renames', True),
+    ('journal', True),
+])
+def test_recover_interrupted_swap(trees, monkeypatch, step, swapped):
+    root, staging, previous = trees
+    _crash_at(step, monkeypatch)
+    with pytest.raises(Crash):
+        swap_root(root, staging, previous)
+    monkeypatch.undo()
+
+    assert recover_swap(root)
+    assert (root / 'version').read_text() == ('new' if swapped else 'old')
+    if swapped:
+        assert (previous / 'version').read_text() == 'old'
+    else:
+        assert not previous.exists()
+    assert not staging.exists()
+    assert not rollback._journal_file(root).exists()
+    assert not recover_swap(root)
+
+
+def test_swap_without_crash(trees):
+    root, staging, previous = trees
+    swap_root(root, staging, previous)
+    assert (root / 'version').read_text() == 'new'
+    assert (previous / 'version').read_text() == 'old'
+    assert not staging.exists()
+    assert not recover_swap(root)
+
+
+def test_corrupt_journal_is_dropped(trees):
+    root = trees[0]
+    rollback._journal_file(root).write_text('{')
+    assert not recover_swap(root)
+    assert not rollback._journal_file(root).exists()
+    assert (root / 'version').read_text() == 'old'
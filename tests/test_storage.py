@@ -0,0 +1,180 @@
+import sys
+import errno
+import tarfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'filesfs' / 'usr' / 'lib'))
+
+from mashfs.storage import HostStorage, MemoryStorage, OverlayStorage, Storage, vfs_path  # noqa: E402
+
+
+@pytest.fixture(params=['memory', 'host'])
+def fs(request, tmp_path):
+    # Общий контракт проверяется и на памяти, и на диске: поведение должно совпадать
+    if request.param == 'memory':
+        return MemoryStorage()
+    root = tmp_path / 'root'
+    root.mkdir()
+    return HostStorage(root)
+
+
+@pytest.fixture
+def seed(tmp_path):
+    root = tmp_path / 'seed'
+    (root / 'etc').mkdir(parents=True)
+    (root / 'etc' / 'passwd').write_text('root:x:0:0\n')
+    (root / 'bin').mkdir()
+    (root / 'bin' / 'tool').write_text('#!/bin/sh\n')
+    (root / 'bin' / 'tool').chmod(0o755)
+    (root / 'etc' / 'link').symlink_to('passwd')
+    return root
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+    class Partial(Storage):
+        def stat(self, path, follow_symlinks=True):
+            raise NotImplementedError
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_vfs_path_cannot_leave_root():
+    assert vfs_path('/home/mash/../../../etc//passwd') == 'etc/passwd'
+    assert vfs_path('/') == ''
+
+
+def test_write_read_and_stat(fs):
+    fs.mkdir('home/mash', parents=True)
+    fs.write_text('/home/mash/note', 'hello\n')
+    assert fs.read_text('home/mash/note') == 'hello\n'
+    assert fs.stat('home/mash/note').st_size == 6
+    assert fs.listdir('home/mash') == ['note']
+    assert fs.is_dir('home') and fs.is_file('home/mash/note')
+
+    with fs.open('home/mash/note', 'a') as f:
+        f.write('more\n')
+    assert fs.read_bytes('home/mash/note') == b'hello\nmore\n'
+
+
+@pytest.mark.parametrize('action, code', [
+    (lambda fs: fs.read_text('missing'), errno.ENOENT),
+    (lambda fs: fs.open('dir', 'r'), errno.EISDIR),
+    (lambda fs: fs.mkdir('dir'), errno.EEXIST),
+    (lambda fs: fs.open('dir/file', 'x'), errno.EEXIST),
+    (lambda fs: fs.rmdir('dir'), errno.ENOTEMPTY),
+    (lambda fs: fs.unlink('dir'), (errno.EISDIR, errno.EPERM)),
+    (lambda fs: fs.write_text('nowhere/file', ''), errno.ENOENT),
+])
+def test_errors_are_oserrors(fs, action, code):
+    fs.mkdir('dir')
+    fs.write_text('dir/file', 'x')
+    with pytest.raises(OSError) as info:
+        action(fs)
+    assert info.value.errno in (code if isinstance(code, tuple) else (code,))
+
+
+def test_symlinks(fs):
+    fs.mkdir('etc')
+    fs.write_text('etc/passwd', 'root\n')
+    fs.symlink('passwd', 'etc/relative')
+    fs.symlink('/etc/passwd', 'etc/absolute')
+    assert fs.read_text('etc/relative') == 'root\n'
+    assert fs.readlink('etc/relative') == 'passwd'
+    assert fs.is_symlink('etc/absolute') and not fs.is_symlink('etc/passwd')
+    fs.unlink('etc/relative')
+    assert fs.exists('etc/passwd')
+
+
+def test_rename_and_rmtree(fs):
+    fs.mkdir('a/b', parents=True)
+    fs.write_text('a/b/f', 'x')
+    fs.rename('a', 'c')
+    assert fs.read_text('c/b/f') == 'x'
+    assert not fs.exists('a')
+    with pytest.raises(OSError) as info:
+        fs.rename('c', 'c/b/inside')
+    assert info.value.errno == errno.EINVAL
+    fs.rmtree('c')
+    assert fs.listdir('') == []
+
+
+def test_walk_and_chmod(fs):
+    fs.mkdir('bin/sub', parents=True)
+    fs.write_text('bin/tool', '')
+    fs.write_text('bin/sub/other', '')
+    fs.chmod('bin/tool', 0o755)
+    assert fs.is_executable('bin/tool') and not fs.is_executable('bin/sub/other')
+    walked = {rel: (sorted(dirs), sorted(files)) for rel, dirs, files in fs.walk('bin')}
+    assert walked == {'bin': (['sub'], ['tool']), 'bin/sub': ([], ['other'])}
+
+
+def test_memory_symlink_loop():
+    fs = MemoryStorage()
+    fs.symlink('b', 'a')
+    fs.symlink('a', 'b')
+    with pytest.raises(OSError) as info:
+        fs.stat('a')
+    assert info.value.errno == errno.ELOOP
+
+
+def test_memory_symlink_stays_inside_root():
+    fs = MemoryStorage()
+    fs.mkdir('etc')
+    fs.write_text('etc/passwd', 'inside\n')
+    fs.symlink('../../../../etc/passwd', 'escape')
+    assert fs.read_text('escape') == 'inside\n'
+
+
+def test_memory_seeded_from_directory_never_writes_back(seed):
+    fs = MemoryStorage.from_snapshot(seed)
+    assert sorted(fs.listdir('')) == ['bin', 'etc']
+    assert fs.read_text('etc/link') == 'root:x:0:0\n'
+    assert fs.is_executable('bin/tool')
+
+    fs.write_text('etc/passwd', 'changed\n')
+    fs.unlink('bin/tool')
+    fs.mkdir('tmp')
+    assert fs.read_text('etc/passwd') == 'changed\n'
+    assert (seed / 'etc' / 'passwd').read_text() == 'root:x:0:0\n'
+    assert (seed / 'bin' / 'tool').exists()
+    assert not (seed / 'tmp').exists()
+
+
+def test_memory_seed_is_lazy(seed):
+    fs = MemoryStorage.from_snapshot(seed)
+    # Содержимое читается при первом открытии, а не при засеве
+    (seed / 'etc' / 'passwd').write_text('later\n')
+    assert fs.read_text('etc/passwd') == 'later\n'
+    # Нетронутый файл можно отдать внешней программе, измененный - нет
+    assert fs.host_path('bin/tool') == seed / 'bin' / 'tool'
+    fs.write_text('bin/tool', '')
+    assert fs.host_path('bin/tool') is None
+
+
+def test_memory_seeded_from_tar(seed, tmp_path):
+    archive = tmp_path / 'root.tar.gz'
+    with tarfile.open(archive, 'w:gz') as tar:
+        for entry in sorted(seed.iterdir()):
+            tar.add(entry, arcname=entry.name)
+    fs = MemoryStorage.from_snapshot(archive)
+    assert fs.read_text('etc/passwd') == 'root:x:0:0\n'
+    assert fs.readlink('etc/link') == 'passwd'
+    assert fs.is_executable('bin/tool')
+    assert fs.host_path('etc/passwd') is None
+
+
+def test_overlay_untouched(seed, tmp_path):
+    fs = OverlayStorage(seed, tmp_path / 'upper')
+    assert fs.untouched('bin') and fs.untouched('etc')
+    fs.write_text('etc/passwd', 'changed\n')
+    assert not fs.untouched('etc') and not fs.untouched('etc/passwd')
+    assert fs.untouched('bin')
+    fs.unlink('bin/tool')
+    assert not fs.untouched('bin/tool')
+    assert (seed / 'etc' / 'passwd').read_text() == 'root:x:0:0\n'
@@ -0,0 +1,152 @@
+import sys
+import json
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / 'filesfs' / 'usr' / 'lib'))
+sys.path.insert(0, str(ROOT / 'filesfs' / 'opt' / 'packman' / 'lib'))
+
+import transaction  # noqa: E402
+from transaction import Transaction  # noqa: E402
+from package_manager import PackageManager  # noqa: E402
+
+
+def _tree(path):
+    """{относительный путь: содержимое или симлинк} для сравнения деревьев"""
+    result = {}
+    for entry in sorted(Path(path).rglob('*')):
+        rel = str(entry.relative_to(path))
+        if entry.is_symlink():
+            result[rel] = ('->', str(entry.readlink()))
+        elif entry.is_file():
+            result[rel] = entry.read_bytes()
+    return result
+
+
+@pytest.fixture
+def txn_dir(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    (data / 'keep.txt').write_text('old\n')
+    (data / 'pkg').mkdir()
+    (data / 'pkg' / 'file').write_text('pkg\n')
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'new').write_text('new\n')
+    return tmp_path
+
+
+def _run_ops(txn, base):
+    txn.begin()
+    txn.write_file(base / 'data' / 'keep.txt', b'replaced\n')
+    txn.copytree(base / 'src', base / 'data' / 'copied')
+    txn.move(base / 'data' / 'pkg', base / 'data' / 'moved')
+    txn.remove(base / 'data' / 'copied' / 'new')
+
+
+def test_rollback_restores_everything(txn_dir):
+    before = _tree(txn_dir / 'data')
+    txn = Transaction(txn_dir / 'txn.json', txn_dir / 'staging')
+    _run_ops(txn, txn_dir)
+    assert _tree(txn_dir / 'data') != before
+
+    txn.rollback()
+    assert _tree(txn_dir / 'data') == before
+    assert not (txn_dir / 'txn.json').exists() and not (txn_dir / 'staging').exists()
+
+
+def test_recover_rolls_back_crashed_transaction(txn_dir):
+    before = _tree(txn_dir / 'data')
+    # Процесс упал посреди транзакции: остались журнал и staging
+    _run_ops(Transaction(txn_dir / 'txn.json', txn_dir / 'staging'), txn_dir)
+
+    assert Transaction.recover(txn_dir / 'txn.json')
+    assert _tree(txn_dir / 'data') == before
+    assert not (txn_dir / 'txn.json').exists() and not (txn_dir / 'staging').exists()
+
+
+def test_recover_keeps_transaction_crashed_mid_commit(txn_dir, monkeypatch):
+    txn = Transaction(txn_dir / 'txn.json', txn_dir / 'staging')
+    _run_ops(txn, txn_dir)
+    after = _tree(txn_dir / 'data')
+
+    def crash(path, *args, **kwargs):
+        raise KeyboardInterrupt
+    # Падение, пока commit() убирает staging: журнал уже отмечен как зафиксированный
+    monkeypatch.setattr(transaction.shutil, 'rmtree', crash)
+    with pytest.raises(KeyboardInterrupt):
+        txn.commit()
+    monkeypatch.undo()
+    assert json.loads((txn_dir / 'txn.json').read_text())['committed']
+
+    assert not Transaction.recover(txn_dir / 'txn.json')
+    assert _tree(txn_dir / 'data') == after
+    assert not (txn_dir / 'txn.json').exists() and not (txn_dir / 'staging').exists()
+
+
+def test_recover_without_journal(tmp_path):
+    assert not Transaction.recover(tmp_path / 'missing.json')
+
+
+def _package(root, name, dependencies=()):
+    package = root / 'opt' / 'packman' / 'packages' / name
+    (package / 'bin').mkdir(parents=True)
+    (package / 'info.json').write_text(json.dumps({'version': '1', 'dependencies': list(dependencies)}))
+    (package / 'bin' / name).write_text(f'#!/bin/sh\necho {name}\n')
+    (package / 'bin' / name).chmod(0o755)
+
+
+@pytest.fixture
+def pm(tmp_path, monkeypatch):
+    root = tmp_path / 'root'
+    _package(root, 'base')
+    _package(root, 'good', ['base'])
+    _package(root, 'other')
+    monkeypatch.setattr(PackageManager, '_simulate_installation', lambda self, name: None)
+    manager = PackageManager(root)
+    assert manager.batch('add', ['base']) == 0
+    return manager
+
+
+def _state(pm):
+    packman = pm.root / 'opt' / 'packman'
+    return {
+        'enabled': _tree(packman / 'enabled'),
+        'disabled': _tree(packman / 'disabled'),
+        'bin': _tree(pm.root / 'bin'),
+        'binaries': (packman / 'binaries.json').read_bytes(),
+        'installed': _tree(packman / 'installed'),
+    }
+
+
+def test_batch_add_commits_and_links(pm):
+    assert pm.batch('add', ['good', 'other']) == 0
+    assert sorted(p.name for p in pm.enabled_dir.iterdir()) == ['base', 'good', 'other']
+    assert (pm.root / 'bin' / 'good').resolve() == (pm.enabled_dir / 'good' / 'bin' / 'good').resolve()
+    assert not list(pm.transactions_dir.glob('*.json'))
+
+
+def test_failing_package_rolls_back_whole_batch(pm, capsys):
+    before = _state(pm)
+    assert pm.batch('add', ['good', 'missing']) == 1
+    assert 'Транзакция отменена' in capsys.readouterr().out
+    assert _state(pm) == before
+    assert not list(pm.transactions_dir.glob('*.json'))
+
+
+def test_apply_failure_rolls_back(pm, tmp_path):
+    before = _state(pm)
+    manifest = tmp_path / 'manifest.yml'
+    manifest.write_text('packages:\n  enabled: [good, missing]\n')
+    assert pm.apply(manifest) == 1
+    assert _state(pm) == before
+
+
+def test_apply_reaches_manifest(pm, tmp_path):
+    manifest = tmp_path / 'manifest.yml'
+    manifest.write_text('- other\n')
+    assert pm.apply(manifest) == 0
+    assert sorted(p.name for p in pm.enabled_dir.iterdir()) == ['other']
+    assert sorted(p.name for p in pm.disabled_dir.iterdir()) == ['base']
+    assert sorted(p.name for p in (pm.root / 'bin').iterdir()) == ['other']